@@ -57,11 +57,33 @@ based on the data obtained from CloudStack API:
 }
 
 
-usage: cloudstack-routers.py [--list] [--host HOST]
+Only routers in state 'Running' are listed by default, use --include-states to
+list routers in other states, e.g. 'Running,Starting' or 'all'. The state
+filter is applied by the CloudStack API and the routers are fetched page by
+page, see --page-size.
+
+With --watch, the script keeps polling the routers every --interval seconds
+and prints a JSON line for each router whose state or redundant state changed,
+and for each redundant router pair whose MASTER changed, e.g.:
+
+{"event": "router", "name": "r-1234-VM", "network": "...", "state": "Running",
+ "previous_state": "Running", "redundant_state": "BACKUP",
+ "previous_redundant_state": "MASTER", "timestamp": 1432800000}
+{"event": "redundant_pair", "network": "...", "master": ["r-1235-VM"],
+ "previous_master": ["r-1234-VM"], "timestamp": 1432800000}
+
+The watch lists routers in all states unless --include-states is given. API and
+network errors are logged to stderr and the routers are polled again on the
+next interval.
+
+usage: cloudstack-routers.py [--list] [--host HOST] [--include-states STATES]
+                             [--page-size PAGE_SIZE] [--watch]
+                             [--interval SECONDS]
 """
 
 import os
 import sys
+import time
 import argparse
 
 try:
@@ -78,13 +100,29 @@ except ImportError:
 
 
 class CloudStackInventory(object):
-    def __init__(self):
+    def __init__(self, cs=None, include_states='Running', page_size=500):
+
+        # used by cloudstack.py --all, which owns the API client and the output
+        if cs:
+            self.cs = cs
+            self.include_states = self.parse_states(include_states)
+            self.page_size = page_size
+            return
 
         parser = argparse.ArgumentParser()
         parser.add_argument('--host')
         parser.add_argument('--list', action='store_true')
+        parser.add_argument('--include-states', default=None)
+        parser.add_argument('--page-size', type=int, default=500)
+        parser.add_argument('--watch', action='store_true')
+        parser.add_argument('--interval', type=int, default=60)
 
         options = parser.parse_args()
+        include_states = options.include_states
+        if include_states is None:
+            include_states = 'all' if options.watch else 'Running'
+        self.include_states = self.parse_states(include_states)
+        self.page_size = options.page_size
         try:
             self.cs = CloudStack(**read_config())
         except CloudStackException, e:
@@ -97,11 +135,52 @@ class CloudStackInventory(object):
         elif options.list:
             data = self.get_list()
             print json.dumps(data, indent=2)
+
+        elif options.watch:
+            self.watch(options.interval)
         else:
-            print >> sys.stderr, "usage: --list | --host <hostname>"
+            print >> sys.stderr, "usage: --list | --host <hostname> | --watch [--interval <seconds>] [--include-states <states>] [--page-size <size>]"
             sys.exit(1)
 
 
+    def parse_states(self, states):
+        # 'all' disables the state filter
+        states = [ s.strip() for s in states.split(',') if s.strip() ]
+        if 'all' in [ s.lower() for s in states ]:
+            return []
+        return states
+
+
+    def list_routers(self, states=None, name=None):
+        # filter by state on the API side, one listing per state, and fetch
+        # page by page so only one page of routers is held at a time.
+        if not states:
+            states = [ None ]
+
+        for state in states:
+            for scope in [ { 'projectid': -1 }, {} ]:
+                args = {}
+                args.update(scope)
+                args['listall'] = True
+                args['pagesize'] = self.page_size
+                if state:
+                    args['state'] = state
+                if name:
+                    args['name'] = name
+
+                page = 1
+                while True:
+                    args['page'] = page
+                    routers = self.cs.listRouters(**args)
+                    if not routers or 'router' not in routers:
+                        break
+                    for router in routers['router']:
+                        yield router
+                    if len(routers['router']) < self.page_size:
+                        break
+                    page += 1
+
+
     def add_group(self, data, group_name, router_name):
         if group_name not in data:
             data[group_name] = {
@@ -111,19 +190,95 @@ class CloudStackInventory(object):
         return data
 
 
-    def get_host(self, name):
-        routers = []
-
-        routers_projects = self.cs.listRouters(projectid=-1, listall=True)
-        if routers_projects and 'router' in routers_projects:
-            routers = routers + routers_projects['router']
+    def get_router_states(self):
+        states = {}
+        for router in self.list_routers(states=self.include_states):
+            states[router['id']] = {
+                'name': router['name'],
+                'network': router.get('vpcid') or router.get('guestnetworkid'),
+                'state': router['state'],
+                'redundant_state': router.get('redundantstate'),
+            }
+        return states
+
+
+    def get_masters(self, states):
+        masters = {}
+        for router in states.values():
+            if router['redundant_state'] in [ 'MASTER', 'BACKUP' ]:
+                masters.setdefault(router['network'], [])
+                if router['redundant_state'] == 'MASTER':
+                    masters[router['network']].append(router['name'])
+        for network in masters:
+            masters[network].sort()
+        return masters
+
+
+    def get_changes(self, previous, current):
+        now = int(time.time())
+        events = []
+        for router_id in sorted(set(previous) | set(current)):
+            old = previous.get(router_id, {})
+            new = current.get(router_id, {})
+            if old.get('state') == new.get('state') \
+               and old.get('redundant_state') == new.get('redundant_state'):
+                continue
+            events.append({
+                'event': 'router',
+                'name': new.get('name') or old.get('name'),
+                'network': new.get('network') or old.get('network'),
+                'state': new.get('state'),
+                'previous_state': old.get('state'),
+                'redundant_state': new.get('redundant_state'),
+                'previous_redundant_state': old.get('redundant_state'),
+                'timestamp': now,
+            })
+
+        previous_masters = self.get_masters(previous)
+        current_masters = self.get_masters(current)
+        for network in sorted(set(previous_masters) | set(current_masters)):
+            old = previous_masters.get(network, [])
+            new = current_masters.get(network, [])
+            if old != new:
+                events.append({
+                    'event': 'redundant_pair',
+                    'network': network,
+                    'master': new,
+                    'previous_master': old,
+                    'timestamp': now,
+                })
+        return events
+
+
+    def watch(self, interval):
+        # the first poll only builds the index, afterwards only changes are printed
+        states = None
+        try:
+            while True:
+                started = time.time()
+                try:
+                    current = self.get_router_states()
+                except (CloudStackException, IOError), e:
+                    # network errors of requests and socket are IOErrors,
+                    # the routers are polled again on the next interval.
+                    print >> sys.stderr, "Error: %s" % str(e)
+                    current = None
+
+                if current is not None:
+                    if states is not None:
+                        for event in self.get_changes(states, current):
+                            print json.dumps(event)
+                        sys.stdout.flush()
+                    states = current
+
+                time.sleep(max(0, interval - (time.time() - started)))
+        except KeyboardInterrupt:
+            pass
 
-        routers_accounts = self.cs.listRouters(listall=True)
-        if routers_accounts and 'router' in routers_accounts:
-            routers = routers + routers_accounts['router']
 
+    def get_host(self, name):
         data = {}
-        for router in routers:
+        for router in self.list_routers(name=name):
             router_name = router['name']
             if name == router_name:
                 data['zone'] = router['zonename']
@@ -160,19 +315,7 @@ class CloudStackInventory(object):
                 },
             }
 
-        routers = []
-
-        routers_projects = self.cs.listRouters(projectid=-1, listall=True)
-        if routers_projects and 'router' in routers_projects:
-            routers = routers + routers_projects['router']
-
-        routers_accounts = self.cs.listRouters(listall=True)
-        if routers_accounts and 'router' in routers_accounts:
-            routers = routers + routers_accounts['router']
-
-        for router in routers:
-            if router['state'] != 'Running':
-                continue
+        for router in self.list_routers(states=self.include_states):
             router_name = router['name']
             data['all']['hosts'].append(router_name)
             # Make a group per domain
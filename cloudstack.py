@@ -67,12 +67,31 @@ based on the data obtained from CloudStack API:
   }
 
 
-usage: cloudstack.py [--list] [--host HOST] [--project PROJECT]
+With --all, the routers of cloudstack-routers.py are fetched together with the
+virtual machines, concurrently and over the same API client, and a merged
+inventory is returned having the parent groups 'instances' and 'routers'. Both
+results are cached in one cache file (--cache-file) with a separate max age per
+kind (--cache-max-age-instances, --cache-max-age-routers), --refresh-cache
+ignores the cache. The cache file is written to a temp file and renamed, so
+a concurrent or interrupted run never leaves a truncated cache.
+
+The virtual machines and the routers are fetched page by page, see
+--page-size.
+
+usage: cloudstack.py [--list] [--host HOST] [--project PROJECT] [--all]
+                     [--include-states STATES] [--cache-file CACHE_FILE]
+                     [--cache-max-age-instances SECONDS]
+                     [--cache-max-age-routers SECONDS] [--refresh-cache]
+                     [--page-size PAGE_SIZE]
 """
 
 import os
 import sys
+import imp
+import time
 import argparse
+import tempfile
+import threading
 
 try:
     import json
@@ -94,8 +113,16 @@ class CloudStackInventory(object):
         parser.add_argument('--host')
         parser.add_argument('--list', action='store_true')
         parser.add_argument('--project')
+        parser.add_argument('--all', action='store_true')
+        parser.add_argument('--include-states', default='Running')
+        parser.add_argument('--cache-file', default=os.path.expanduser('~/.ansible-cloudstack.cache'))
+        parser.add_argument('--cache-max-age-instances', type=int, default=300)
+        parser.add_argument('--cache-max-age-routers', type=int, default=60)
+        parser.add_argument('--refresh-cache', action='store_true')
+        parser.add_argument('--page-size', type=int, default=500)
 
         options = parser.parse_args()
+        self.page_size = options.page_size
         try:
             self.cs = CloudStack(**read_config())
         except CloudStackException, e:
@@ -105,7 +132,13 @@ class CloudStackInventory(object):
         if options.project:
             project_id = self.get_project_id(options.project)
 
-        if options.host:
+        if options.all and (options.host or options.list):
+            data = self.get_all(options, project_id)
+            if options.host:
+                data = data['_meta']['hostvars'].get(options.host, {})
+            print json.dumps(data, indent=2)
+
+        elif options.host:
             data = self.get_host(options.host)
             print json.dumps(data, indent=2)
 
@@ -113,9 +146,127 @@ class CloudStackInventory(object):
             data = self.get_list()
             print json.dumps(data, indent=2)
         else:
-            print >> sys.stderr, "usage: --list | --host <hostname> [--project <project>]"
+            print >> sys.stderr, "usage: --list | --host <hostname> [--project <project>] [--all]"
+            sys.exit(1)
+
+
+    def get_router_inventory(self, include_states):
+        path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cloudstack-routers.py')
+        cloudstack_routers = imp.load_source('cloudstack_routers', path)
+        return cloudstack_routers.CloudStackInventory(cs=self.cs, include_states=include_states, page_size=self.page_size)
+
+
+    def read_cache(self, cache_file):
+        try:
+            with open(cache_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+    def write_cache(self, cache_file, cache):
+        # write to a temp file and rename, other runs may read it
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file) or '.')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.rename(tmp_path, cache_file)
+        except (IOError, OSError):
+            pass
+
+
+    def is_cache_valid(self, entry, max_age, key):
+        return entry \
+               and entry.get('key') == key \
+               and entry.get('timestamp', 0) + max_age > time.time()
+
+
+    def get_all(self, options, project_id=''):
+        routers = self.get_router_inventory(options.include_states)
+
+        kinds = {
+            'instances': {
+                'fetch': lambda: self.get_list(project_id),
+                'max_age': options.cache_max_age_instances,
+                'key': project_id,
+            },
+            'routers': {
+                'fetch': routers.get_list,
+                'max_age': options.cache_max_age_routers,
+                'key': options.include_states,
+            },
+        }
+
+        cache = {}
+        if not options.refresh_cache:
+            cache = self.read_cache(options.cache_file)
+
+        stale = []
+        for kind, spec in kinds.items():
+            if not self.is_cache_valid(cache.get(kind), spec['max_age'], spec['key']):
+                stale.append(kind)
+
+        # fetch the outdated kinds concurrently, sharing the API client
+        results = {}
+        errors = []
+        def fetch(kind):
+            try:
+                results[kind] = kinds[kind]['fetch']()
+            except Exception, e:
+                errors.append(e)
+
+        threads = [ threading.Thread(target=fetch, args=(kind,)) for kind in stale ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            print >> sys.stderr, "Error: %s" % errors[0]
             sys.exit(1)
 
+        if stale:
+            for kind in stale:
+                cache[kind] = {
+                    'key': kinds[kind]['key'],
+                    'timestamp': time.time(),
+                    'data': results[kind],
+                }
+            self.write_cache(options.cache_file, cache)
+
+        return self.merge_inventories(cache['instances']['data'], cache['routers']['data'])
+
+
+    def merge_inventories(self, instances, routers):
+        data = {
+            'all': {
+                'hosts': [],
+                },
+            '_meta': {
+                'hostvars': {},
+                },
+            }
+
+        for inventory in [ instances, routers ]:
+            for group_name, group in inventory.items():
+                if group_name == '_meta':
+                    data['_meta']['hostvars'].update(group['hostvars'])
+                    continue
+                if group_name not in data:
+                    data[group_name] = {
+                            'hosts': []
+                        }
+                data[group_name]['hosts'].extend(group['hosts'])
+
+        # parent groups per kind of host
+        for group_name, inventory in [ ('instances', instances), ('routers', routers) ]:
+            if group_name not in data:
+                data[group_name] = {
+                        'hosts': []
+                    }
+            data[group_name]['hosts'].extend(inventory['all']['hosts'])
+        return data
+
 
     def get_project_id(self, project):
         projects = self.cs.listProjects()
@@ -127,13 +278,27 @@ class CloudStackInventory(object):
         sys.exit(1)
 
 
-    def get_host(self, name, project_id=''):
-        hosts = self.cs.listVirtualMachines(projectid=project_id)
-        if not hosts:
-            return {}
+    def list_instances(self, project_id=''):
+        # fetch page by page so only one page of VMs is held at a time.
+        args = {}
+        args['projectid'] = project_id
+        args['pagesize'] = self.page_size
+        page = 1
+        while True:
+            args['page'] = page
+            hosts = self.cs.listVirtualMachines(**args)
+            if not hosts or 'virtualmachine' not in hosts:
+                break
+            for host in hosts['virtualmachine']:
+                yield host
+            if len(hosts['virtualmachine']) < self.page_size:
+                break
+            page += 1
+
 
+    def get_host(self, name, project_id=''):
         data = {}
-        for host in hosts['virtualmachine']:
+        for host in self.list_instances(project_id):
             host_name = host['displayname']
             if name == host_name:
                 data['zone'] = host['zonename']
@@ -185,47 +350,45 @@ class CloudStackInventory(object):
                             'hosts': []
                         }
 
-        hosts = self.cs.listVirtualMachines(projectid=project_id)
-        if hosts:
-            for host in hosts['virtualmachine']:
-                host_name = host['displayname']
-                data['all']['hosts'].append(host_name)
-                data['_meta']['hostvars'][host_name] = {}
-                data['_meta']['hostvars'][host_name]['zone'] = host['zonename']
-                if 'group' in host:
-                    data['_meta']['hostvars'][host_name]['group'] = host['group']
-                data['_meta']['hostvars'][host_name]['state'] = host['state']
-                data['_meta']['hostvars'][host_name]['service_offering'] = host['serviceofferingname']
-                data['_meta']['hostvars'][host_name]['affinity_group'] = host['affinitygroup']
-                data['_meta']['hostvars'][host_name]['security_group'] = host['securitygroup']
-                data['_meta']['hostvars'][host_name]['cpu_number'] = host['cpunumber']
-                data['_meta']['hostvars'][host_name]['cpu_speed'] = host['cpuspeed']
-                if 'cpuused' in host:
-                    data['_meta']['hostvars'][host_name]['cpu_used'] = host['cpuused']
-                data['_meta']['hostvars'][host_name]['memory'] = host['memory']
-                data['_meta']['hostvars'][host_name]['tags'] = host['tags']
-                data['_meta']['hostvars'][host_name]['hypervisor'] = host['hypervisor']
-                data['_meta']['hostvars'][host_name]['created'] = host['created']
-                data['_meta']['hostvars'][host_name]['nic'] = []
-                for nic in host['nic']:
-                    data['_meta']['hostvars'][host_name]['nic'].append({
-                        'ip': nic['ipaddress'],
-                        'mac': nic['macaddress'],
-                        'netmask': nic['netmask'],
-                        'gateway': nic['gateway'],
-                        'type': nic['type'],
-                        })
-                    if nic['isdefault']:
-                        data['_meta']['hostvars'][host_name]['default_ip'] = nic['ipaddress']
+        for host in self.list_instances(project_id):
+            host_name = host['displayname']
+            data['all']['hosts'].append(host_name)
+            data['_meta']['hostvars'][host_name] = {}
+            data['_meta']['hostvars'][host_name]['zone'] = host['zonename']
+            if 'group' in host:
+                data['_meta']['hostvars'][host_name]['group'] = host['group']
+            data['_meta']['hostvars'][host_name]['state'] = host['state']
+            data['_meta']['hostvars'][host_name]['service_offering'] = host['serviceofferingname']
+            data['_meta']['hostvars'][host_name]['affinity_group'] = host['affinitygroup']
+            data['_meta']['hostvars'][host_name]['security_group'] = host['securitygroup']
+            data['_meta']['hostvars'][host_name]['cpu_number'] = host['cpunumber']
+            data['_meta']['hostvars'][host_name]['cpu_speed'] = host['cpuspeed']
+            if 'cpuused' in host:
+                data['_meta']['hostvars'][host_name]['cpu_used'] = host['cpuused']
+            data['_meta']['hostvars'][host_name]['memory'] = host['memory']
+            data['_meta']['hostvars'][host_name]['tags'] = host['tags']
+            data['_meta']['hostvars'][host_name]['hypervisor'] = host['hypervisor']
+            data['_meta']['hostvars'][host_name]['created'] = host['created']
+            data['_meta']['hostvars'][host_name]['nic'] = []
+            for nic in host['nic']:
+                data['_meta']['hostvars'][host_name]['nic'].append({
+                    'ip': nic['ipaddress'],
+                    'mac': nic['macaddress'],
+                    'netmask': nic['netmask'],
+                    'gateway': nic['gateway'],
+                    'type': nic['type'],
+                    })
+                if nic['isdefault']:
+                    data['_meta']['hostvars'][host_name]['default_ip'] = nic['ipaddress']
 
-                group_name = ''
-                if 'group' in host:
-                    group_name = host['group']
+            group_name = ''
+            if 'group' in host:
+                group_name = host['group']
 
-                #Modify code to show IP addresses instead of VM names
-                if group_name and group_name in data:
-                    #data[group_name]['hosts'].append(host_name)
-                    data[group_name]['hosts'].append(nic['ipaddress'])
+            #Modify code to show IP addresses instead of VM names
+            if group_name and group_name in data:
+                #data[group_name]['hosts'].append(host_name)
+                data[group_name]['hosts'].append(nic['ipaddress'])
         return data
 
 
@@ -28,7 +28,9 @@ options:
   ip_address:
     description:
       - Public IP address the rule is assigned to.
-    required: true
+      - Required unless all C(rules) have an C(ip_address).
+    required: false
+    default: null
   state:
     description:
       - State of the firewall rule.
@@ -43,9 +45,27 @@ options:
     choices: [ 'tcp', 'udp', 'icmp' ]
   cidr:
     description:
-      - CIDR (full notation) to be used for firewall rule.
+      - CIDR (full notation) to be used for firewall rule, a comma separated list of CIDRs is supported.
     required: false
     default: '0.0.0.0/0'
+  optimize:
+    description:
+      - Whether to collapse the CIDRs of C(cidr) into their minimal supernets before applying the rule, the access granted stays the same. Only used with C(state=present).
+      - If C(rules) is used, contiguous or overlapping port ranges of the same CIDRs are merged and rules of the same ports are merged into one having the collapsed CIDRs. The number of rules saved is returned as C(rules_saved).
+      - A rule is not created if existing rules of the IP address already grant its access, e.g. one rule per CIDR of the collapsed CIDRs. Existing rules are never removed, aggregating them requires to remove them first.
+    required: false
+    default: false
+  rules:
+    description:
+      - List of firewall rules to be applied in one task, each a dict having the keys C(ip_address), C(protocol), C(cidr), C(start_port) or C(port), C(end_port), C(icmp_type) and C(icmp_code). Keys not set default to the options of the same name. The firewall rules are listed once and only the missing rules are created, or with C(state=absent) the existing rules are removed. The rules changed are returned as C(rules_added) and C(rules_removed).
+      - If the rules are related to more than one IP address, the public IP addresses and the firewall rules of the project are listed once each and indexed by IP address.
+    required: false
+    default: null
+  concurrency:
+    description:
+      - Max number of jobs running at the same time if C(rules) is used.
+    required: false
+    default: 10
   start_port:
     description:
       - Start port for this rule. Considered if C(protocol=tcp) or C(protocol=udp).
@@ -71,6 +91,11 @@ options:
       - Name of the project.
     required: false
     default: null
+  poll_async:
+    description:
+      - Poll async jobs until job has finished. If C(false), the id of the job is returned as C(job_id), or the ids of the jobs as C(job_ids) if C(rules) is used, see M(cs_job).
+    required: false
+    default: true
 '''
 
 EXAMPLES = '''
@@ -104,8 +129,44 @@ EXAMPLES = '''
     end_port: 8888
     cidr: 17.0.0.0/8
     state: absent
+
+
+# Allow inbound port 443/tcp from a generated list of networks, collapsed to 10.0.0.0/23
+- local_action:
+    module: cs_firewall
+    ip_address: 4.3.2.1
+    start_port: 443
+    end_port: 443
+    cidr: 10.0.0.0/24,10.0.1.0/24
+    optimize: true
+
+
+# Allow a set of rules to 4.3.2.1 in one task
+- local_action:
+    module: cs_firewall
+    ip_address: 4.3.2.1
+    rules:
+    - { port: 22, cidr: 10.0.0.0/8 }
+    - { port: 80 }
+    - { port: 443 }
+    - { protocol: udp, start_port: 60000, end_port: 61000 }
+    - { protocol: icmp, icmp_type: 8 }
+
+
+# Allow rules to many IP addresses of a project, reconciled by two list calls in total
+- local_action:
+    module: cs_firewall
+    project: web
+    rules:
+    - { ip_address: 4.3.2.1, port: 80 }
+    - { ip_address: 4.3.2.1, port: 443 }
+    - { ip_address: 4.3.2.2, port: 80 }
+    - { ip_address: 4.3.2.3, port: 22, cidr: 10.0.0.0/8 }
 '''
 
+import time
+import threading
+
 try:
     from cs import CloudStack, CloudStackException, read_config
     has_lib_cs = True
@@ -196,7 +257,7 @@ class AnsibleCloudStack:
         vms = self.cs.listVirtualMachines(**args)
         if vms:
             for v in vms['virtualmachine']:
-                if vm in [ v['name'], v['displaytext'] v['id'] ]:
+                if vm in [ v['name'], v['displayname'], v['id'] ]:
                     self.vm_id = v['id']
                     return self.vm_id
         self.module.fail_json(msg="Virtual machine '%s' not found" % vm)
@@ -222,6 +283,31 @@ class AnsibleCloudStack:
         self.module.fail_json(msg="zone '%s' not found" % zone)
 
 
+    def get_zones(self):
+        # Zones given by param zones, all zones if it contains 'all'. Without
+        # zones, the zone of param zone or the first zone found is used.
+        res = self.cs.listZones()
+        all_zones = []
+        if res and 'zone' in res:
+            all_zones = res['zone']
+
+        zones = self.module.params.get('zones')
+        if not zones:
+            if not self.module.params.get('zone'):
+                return all_zones[:1]
+            zones = [ self.module.params.get('zone') ]
+        elif 'all' in zones:
+            return all_zones
+
+        result = []
+        for zone in zones:
+            found = [ z for z in all_zones if zone in [ z['name'], z['id'] ] ]
+            if not found:
+                self.module.fail_json(msg="zone '%s' not found" % zone)
+            result.append(found[0])
+        return result
+
+
     def get_os_type_id(self):
         if self.os_type_id:
             return self.os_type_id
@@ -258,20 +344,271 @@ class AnsibleCloudStack:
         self.module.fail_json(msg="Hypervisor '%s' not found" % hypervisor)
 
 
+    def _list_all(self, method, key, page_size=500, **args):
+        # All pages of a list API call, the API returns at most pagesize
+        # items a call. Returns the items of the response key.
+        args['pagesize'] = page_size
+        items = []
+        page = 1
+        while True:
+            args['page'] = page
+            res = getattr(self.cs, method)(**args)
+            if not res or key not in res:
+                break
+            items.extend(res[key])
+            if len(res[key]) < page_size:
+                break
+            page += 1
+        return items
+
+
     def _poll_job(self, job=None, key=None):
         if 'jobid' in job:
             while True:
                 res = self.cs.queryAsyncJobResult(jobid=job['jobid'])
-                if res['jobstatus'] != 0 and 'jobresult' in res:
-                    if 'errortext' in res['jobresult']:
-                        self.module.fail_json(msg="Failed: '%s'" % res['jobresult']['errortext'])
-                    if key and key in res['jobresult']:
-                        job = res['jobresult'][key]
+                if res['jobstatus'] != 0:
+                    job_result = self._get_job_result(job['jobid'], res)
+                    if 'errortext' in job_result:
+                        self.module.fail_json(msg="Failed: '%s'" % job_result['errortext'])
+                    if key and key in job_result:
+                        job = job_result[key]
                     break
                 time.sleep(2)
         return job
 
 
+    def _get_job_result(self, jobid, res, key=None):
+        # The result of a finished job, a failed job (jobstatus 2) as dict
+        # having 'errortext', even if the API gives none.
+        job_result = res.get('jobresult', {})
+        if res['jobstatus'] == 2 or 'errortext' in job_result:
+            errortext = job_result.get('errortext') or "job failed with result code %s" % res.get('jobresultcode')
+            return { 'jobid': jobid, 'errortext': errortext }
+        if key and key in job_result:
+            return job_result[key]
+        return job_result
+
+
+    def _poll_jobs(self, jobs, key=None, timeout=None):
+        # Polls the async jobs together, one query per running job and round.
+        # Returns the results in order of the jobs, a failed job as dict
+        # having 'errortext' and a job still running after timeout as given.
+        # The timeout defaults to the module param, without one the jobs are
+        # waited for until done; a timeout of 0 queries them once.
+        if timeout is None:
+            timeout = self.module.params.get('timeout')
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        results = list(jobs)
+        running = {}
+        for i, job in enumerate(jobs):
+            if job and 'jobid' in job:
+                running[job['jobid']] = i
+
+        while running:
+            for jobid, i in running.items():
+                res = self.cs.queryAsyncJobResult(jobid=jobid)
+                if res['jobstatus'] != 0:
+                    del running[jobid]
+                    results[i] = self._get_job_result(jobid, res, key)
+
+            if not running:
+                break
+            delay = 2
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                delay = min(delay, remaining)
+            time.sleep(delay)
+        return results
+
+
+    def _run_jobs(self, calls, key=None, concurrency=10, poll_async=None):
+        # Submits the (api method, args) calls keeping at most concurrency
+        # jobs running, polled together. Returns the results in order of the
+        # calls, failures as dict having 'errortext'. Without poll_async all
+        # calls are submitted and the jobs are returned as given, poll_async
+        # defaults to the module param.
+        if poll_async is None:
+            poll_async = self.module.params.get('poll_async', True)
+        results = [ None ] * len(calls)
+        queued = list(enumerate(calls))
+        running = {}
+        while queued or running:
+            while queued and (len(running) < concurrency or not poll_async):
+                i, (method, args) = queued.pop(0)
+                try:
+                    res = method(**args)
+                except CloudStackException, e:
+                    res = { 'errortext': str(e) }
+                results[i] = res
+                if poll_async and 'jobid' in res and 'errortext' not in res:
+                    running[res['jobid']] = i
+
+            for jobid, i in running.items():
+                res = self.cs.queryAsyncJobResult(jobid=jobid)
+                if res['jobstatus'] != 0:
+                    del running[jobid]
+                    results[i] = self._get_job_result(jobid, res, key)
+            if running:
+                time.sleep(2)
+        return results
+
+
+    def _run_calls(self, calls, concurrency=10):
+        # Runs the synchronous (api method, args) calls in up to concurrency
+        # threads. Returns the results in order of the calls, failures as
+        # dict having 'errortext'.
+        results = [ None ] * len(calls)
+        queued = list(enumerate(calls))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                lock.acquire()
+                try:
+                    if not queued:
+                        return
+                    i, (method, args) = queued.pop(0)
+                finally:
+                    lock.release()
+                try:
+                    results[i] = method(**args)
+                except Exception, e:
+                    results[i] = { 'errortext': str(e) }
+
+        threads = [ threading.Thread(target=worker) for i in range(min(concurrency, len(calls))) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+
+    def _parse_cidr(self, cidr):
+        # Returns the IPv4 CIDR as (network, prefix length) or None if it is
+        # not an IPv4 network in full notation.
+        try:
+            address, prefix = cidr.strip().split('/')
+            octets = [ int(o) for o in address.split('.') ]
+            prefix = int(prefix)
+        except (AttributeError, ValueError):
+            return None
+        if len(octets) != 4 or [ o for o in octets if not 0 <= o <= 255 ] or not 0 <= prefix <= 32:
+            return None
+
+        network = (octets[0] << 24) + (octets[1] << 16) + (octets[2] << 8) + octets[3]
+        if network & ((1 << (32 - prefix)) - 1):
+            return None
+        return (network, prefix)
+
+
+    def _format_cidr(self, network, prefix):
+        octets = [ str((network >> shift) & 255) for shift in [24, 16, 8, 0] ]
+        return '%s/%d' % ('.'.join(octets), prefix)
+
+
+    def _collapse_cidrs(self, cidrs):
+        # Collapses the CIDRs into the minimal list of networks covering the
+        # same addresses, networks contained in others are dropped and
+        # adjacent siblings are merged into their supernet. CIDRs not being
+        # IPv4 networks are kept as given.
+        networks = []
+        others = []
+        for cidr in cidrs:
+            network = self._parse_cidr(cidr)
+            if network:
+                networks.append(network)
+            elif cidr not in others:
+                others.append(cidr)
+
+        collapsed = []
+        for network, prefix in sorted(networks):
+            if collapsed:
+                last_network, last_prefix = collapsed[-1]
+                if network >> (32 - last_prefix) == last_network >> (32 - last_prefix):
+                    continue
+            collapsed.append((network, prefix))
+
+            while len(collapsed) > 1:
+                (lower, lower_prefix), (upper, upper_prefix) = collapsed[-2:]
+                size = 1 << (32 - upper_prefix)
+                if lower_prefix != upper_prefix or lower & size or lower + size != upper:
+                    break
+                collapsed[-2:] = [ (lower, lower_prefix - 1) ]
+
+        return [ self._format_cidr(n, p) for n, p in collapsed ] + others
+
+
+    def _is_cidr_covered(self, cidr, cidrs):
+        # Whether the addresses of the CIDR are all in the CIDRs given, by one
+        # network containing it or by the networks within it collapsing into
+        # it. CIDRs not being IPv4 networks must be given as they are.
+        network = self._parse_cidr(cidr)
+        if not network:
+            return cidr in cidrs
+        address, prefix = network
+
+        inner = []
+        for other in cidrs:
+            other_network = self._parse_cidr(other)
+            if not other_network:
+                continue
+            other_address, other_prefix = other_network
+            if other_prefix <= prefix:
+                if address >> (32 - other_prefix) == other_address >> (32 - other_prefix):
+                    return True
+            elif other_address >> (32 - prefix) == address >> (32 - prefix):
+                inner.append(other)
+        return self._collapse_cidrs(inner) == [ self._format_cidr(address, prefix) ]
+
+
+    def _is_covered(self, cidrs, ports, covering):
+        # Whether the CIDRs on the (start port, end port) range are covered by
+        # the union of the (cidrs, ports) given, e.g. by the existing rules an
+        # aggregated rule would replace. Ports (None, None) stand for rules
+        # without ports. The range is split at the bounds of the covering
+        # ranges, each part must be covered by the CIDRs of the rules
+        # spanning it.
+        start_port, end_port = ports
+        if start_port is None:
+            parts = [ (None, None) ]
+        else:
+            bounds = set([ start_port, end_port + 1 ])
+            for covering_cidrs, (covering_start, covering_end) in covering:
+                if covering_start is None:
+                    continue
+                for bound in [ covering_start, covering_end + 1 ]:
+                    if start_port < bound <= end_port:
+                        bounds.add(bound)
+            bounds = sorted(bounds)
+            parts = [ (bounds[i], bounds[i + 1] - 1) for i in range(len(bounds) - 1) ]
+
+        for part_start, part_end in parts:
+            part_cidrs = []
+            for covering_cidrs, (covering_start, covering_end) in covering:
+                if part_start is None or (covering_start is not None and covering_start <= part_start and part_end <= covering_end):
+                    part_cidrs.extend(covering_cidrs)
+            for cidr in cidrs:
+                if not self._is_cidr_covered(cidr, part_cidrs):
+                    return False
+        return True
+
+
+    def _merge_port_ranges(self, port_ranges):
+        # Merges overlapping and contiguous (start port, end port) ranges.
+        merged = []
+        for start_port, end_port in sorted(port_ranges):
+            if merged and start_port <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end_port))
+            else:
+                merged.append((start_port, end_port))
+        return merged
+
+
 class AnsibleCloudStackFirewall(AnsibleCloudStack):
 
     def __init__(self, module):
@@ -280,22 +617,25 @@ class AnsibleCloudStackFirewall(AnsibleCloudStack):
             'changed': False,
         }
         self.firewall_rule = None
+        self.firewall_rules = []
+        self.ip_addresses = None
 
 
-    def get_firewall_rule(self):
-        if not self.firewall_rule:
-            cidr = self.module.params.get('cidr')
-            protocol = self.module.params.get('protocol')
-            start_port = self.module.params.get('start_port')
-            end_port = self.module.params.get('end_port')
-            icmp_code = self.module.params.get('icmp_code')
-            icmp_type = self.module.params.get('icmp_type')
+    def get_cidr(self):
+        cidr = self.module.params.get('cidr')
+        if self.module.params.get('optimize') and self.module.params.get('state') != 'absent':
+            cidrs = cidr.split(',')
+            collapsed = self._collapse_cidrs(cidrs)
+            self.result['cidrs_saved'] = len(cidrs) - len(collapsed)
+            cidr = ','.join(collapsed)
+        return cidr
 
-            if protocol in ['tcp', 'udp'] and not (start_port and end_port):
-                self.module.fail_json(msg="no start_port or end_port set for protocol '%s'" % protocol)
 
-            if protocol == 'icmp' and not icmp_type:
-                self.module.fail_json(msg="no icmp_type set")
+    def get_firewall_rule(self):
+        if not self.firewall_rule:
+            rule = dict(self.module.params)
+            rule['cidr'] = self.get_cidr()
+            key = self._get_desired_rule_key(rule, self.module.params)
 
             args = {}
             args['ipaddressid'] = self.get_ip_address_id()
@@ -303,42 +643,32 @@ class AnsibleCloudStackFirewall(AnsibleCloudStack):
 
             firewall_rules = self.cs.listFirewallRules(**args)
             if firewall_rules and 'firewallrule' in firewall_rules:
-                for rule in firewall_rules['firewallrule']:
-                    type_match = self._type_cidr_match(rule, cidr)
-
-                    protocol_match = self._tcp_udp_match(rule, protocol, start_port, end_port) \
-                        or self._icmp_match(rule, protocol, icmp_code, icmp_type)
-
-                    if type_match and protocol_match:
+                self.firewall_rules = firewall_rules['firewallrule']
+                for rule in self.firewall_rules:
+                    if self._get_rule_key(rule) == key:
                         self.firewall_rule = rule
                         break
         return self.firewall_rule
 
 
-    def _tcp_udp_match(self, rule, protocol, start_port, end_port):
-        return protocol in ['tcp', 'udp'] \
-            and protocol == rule['protocol'] \
-            and start_port == int(rule['startport']) \
-            and end_port == int(rule['endport'])
-
-
-    def _icmp_match(self, rule, protocol, icmp_code, icmp_type):
-        return protocol == 'icmp' \
-           and protocol == rule['protocol'] \
-           and icmp_code == rule['icmpcode'] \
-           and icmp_type == rule['icmptype']
-
-
-    def _type_cidr_match(self, rule, cidr):
-        return cidr == rule['cidrlist']
+    def is_firewall_rule_covered(self):
+        # Whether the existing rules of the IP address already grant the
+        # access of the rule, e.g. one rule per CIDR of the collapsed CIDRs.
+        rule = dict(self.module.params)
+        rule['cidr'] = self.get_cidr()
+        key = self._get_desired_rule_key(rule, self.module.params)
+        existing = [ self._get_rule_key(r) for r in self.firewall_rules ]
+        return self._is_rule_covered(key, existing)
 
 
     def create_firewall_rule(self):
         firewall_rule = self.get_firewall_rule()
+        if not firewall_rule and self.module.params.get('optimize') and self.is_firewall_rule_covered():
+            return None
         if not firewall_rule:
             self.result['changed'] = True
             args = {}
-            args['cidrlist'] = self.module.params.get('cidr')
+            args['cidrlist'] = self.get_cidr()
             args['protocol'] = self.module.params.get('protocol')
             args['startport'] = self.module.params.get('start_port')
             args['endport'] = self.module.params.get('end_port')
@@ -347,7 +677,15 @@ class AnsibleCloudStackFirewall(AnsibleCloudStack):
             args['ipaddressid'] = self.get_ip_address_id()
 
             if not self.module.check_mode:
-                firewall_rule = self.cs.createFirewallRule(**args)
+                res = self.cs.createFirewallRule(**args)
+                if 'errortext' in res:
+                    self.module.fail_json(msg="Failed: '%s'" % res['errortext'])
+
+                poll_async = self.module.params.get('poll_async')
+                if poll_async:
+                    firewall_rule = self._poll_job(res, 'firewallrule')
+                elif 'jobid' in res:
+                    self.result['job_id'] = res['jobid']
 
         return firewall_rule
 
@@ -361,10 +699,245 @@ class AnsibleCloudStackFirewall(AnsibleCloudStack):
 
             if not self.module.check_mode:
                 res = self.cs.deleteFirewallRule(**args)
+                if 'errortext' in res:
+                    self.module.fail_json(msg="Failed: '%s'" % res['errortext'])
+
+                poll_async = self.module.params.get('poll_async')
+                if poll_async:
+                    res = self._poll_job(res, 'firewallrule')
+                elif 'jobid' in res:
+                    self.result['job_id'] = res['jobid']
 
         return firewall_rule
 
 
+    def _get_cidrs(self, cidr):
+        # The comma separated CIDRs as sorted tuple of their canonical forms,
+        # the order and spacing of the list does not matter.
+        cidrs = set()
+        for c in cidr.split(','):
+            network = self._parse_cidr(c)
+            if network:
+                cidrs.add(self._format_cidr(*network))
+            elif c.strip():
+                cidrs.add(c.strip())
+        return tuple(sorted(cidrs))
+
+
+    def _get_rule_key(self, rule):
+        # Normalized, hashable key of a firewall rule as returned by the API.
+        protocol = rule['protocol']
+        ports = (None, None)
+        icmp = (None, None)
+        if protocol in ['tcp', 'udp']:
+            ports = (int(rule['startport']), int(rule['endport']))
+        elif protocol == 'icmp':
+            icmp = (int(rule.get('icmptype', -1)), int(rule.get('icmpcode', -1)))
+        return (rule['ipaddress'], protocol, ports, icmp, self._get_cidrs(rule['cidrlist']))
+
+
+    def _get_desired_rule_key(self, rule, params=None):
+        # Normalized, hashable key of a rule given in rules or of the module
+        # params, keys not set are defaulted to the module params.
+        where = ''
+        if params is None:
+            where = " in rule %s" % rule
+        ip_address = rule.get('ip_address', self.module.params.get('ip_address'))
+        protocol   = rule.get('protocol', self.module.params.get('protocol'))
+        cidr       = rule.get('cidr', self.module.params.get('cidr'))
+        start_port = rule.get('start_port', rule.get('port'))
+        end_port   = rule.get('end_port')
+        icmp_type  = rule.get('icmp_type')
+        icmp_code  = rule.get('icmp_code')
+
+        if not ip_address:
+            self.module.fail_json(msg="no ip_address set%s" % where)
+
+        if end_port is None:
+            end_port = start_port
+
+        ports = (None, None)
+        icmp = (None, None)
+        if protocol in ['tcp', 'udp']:
+            if start_port is None:
+                self.module.fail_json(msg="no start_port or end_port set for protocol '%s'%s" % (protocol, where))
+            ports = (int(start_port), int(end_port))
+        elif protocol == 'icmp':
+            if icmp_type is None:
+                self.module.fail_json(msg="no icmp_type set%s" % where)
+            if icmp_code is None:
+                icmp_code = -1
+            icmp = (int(icmp_type), int(icmp_code))
+        else:
+            self.module.fail_json(msg="invalid protocol '%s'%s" % (protocol, where))
+        return (ip_address, protocol, ports, icmp, self._get_cidrs(cidr))
+
+
+    def _get_rule_from_key(self, key):
+        ip_address, protocol, ports, icmp, cidr = key
+        rule = {
+            'ip_address': ip_address,
+            'protocol': protocol,
+            'cidr': ','.join(cidr),
+        }
+        if protocol in ['tcp', 'udp']:
+            rule['start_port'], rule['end_port'] = ports
+        elif protocol == 'icmp':
+            rule['icmp_type'], rule['icmp_code'] = icmp
+        return rule
+
+
+    def _optimize_rule_keys(self, keys):
+        # Merges the port ranges per CIDRs, then the CIDRs per port range,
+        # until no more rules are saved.
+        optimized = []
+        while len(keys) != len(optimized):
+            optimized = keys
+
+            port_ranges = {}
+            keys = []
+            for ip_address, protocol, ports, icmp, cidr in optimized:
+                if protocol not in ['tcp', 'udp']:
+                    keys.append((ip_address, protocol, ports, icmp, cidr))
+                    continue
+                source = (ip_address, protocol, cidr)
+                if source not in port_ranges:
+                    port_ranges[source] = []
+                port_ranges[source].append(ports)
+            for ip_address, protocol, cidr in sorted(port_ranges):
+                for ports in self._merge_port_ranges(port_ranges[(ip_address, protocol, cidr)]):
+                    keys.append((ip_address, protocol, ports, (None, None), cidr))
+
+            cidrs = {}
+            for ip_address, protocol, ports, icmp, cidr in keys:
+                access = (ip_address, protocol, ports, icmp)
+                if access not in cidrs:
+                    cidrs[access] = []
+                cidrs[access].extend(cidr)
+            keys = []
+            for access in sorted(cidrs):
+                cidr = tuple(sorted(self._collapse_cidrs(cidrs[access])))
+                keys.append(access + (cidr,))
+        return keys
+
+
+    def _is_rule_covered(self, key, existing):
+        # Whether the access of the rule is already granted by the existing
+        # rules of the same IP address and protocol.
+        ip_address, protocol, ports, icmp, cidr = key
+        covering = [ (k[4], k[2]) for k in existing if k[:2] == (ip_address, protocol) and k[3] == icmp ]
+        return self._is_covered(cidr, ports, covering)
+
+
+    def get_ip_addresses(self):
+        # Public IP addresses of the project by address, listed once, all
+        # pages.
+        if self.ip_addresses is None:
+            args = {}
+            args['projectid'] = self.get_project_id()
+
+            self.ip_addresses = {}
+            for ip_address in self._list_all('listPublicIpAddresses', 'publicipaddress', **args):
+                self.ip_addresses[ip_address['ipaddress']] = ip_address
+        return self.ip_addresses
+
+
+    def get_ip_address_ids(self, ip_addresses):
+        # Ids of the IP addresses, looked up by the project wide index if more
+        # than one IP address is involved.
+        if len(ip_addresses) == 1 and self.ip_addresses is None:
+            args = {}
+            args['ipaddress'] = ip_addresses[0]
+            args['projectid'] = self.get_project_id()
+            res = self.cs.listPublicIpAddresses(**args)
+            found = {}
+            if res and 'publicipaddress' in res:
+                found[ip_addresses[0]] = res['publicipaddress'][0]
+        else:
+            found = self.get_ip_addresses()
+
+        ip_address_ids = {}
+        for ip_address in ip_addresses:
+            if ip_address not in found:
+                self.module.fail_json(msg="IP address '%s' not found" % ip_address)
+            ip_address_ids[ip_address] = found[ip_address]['id']
+        return ip_address_ids
+
+
+    def get_firewall_rules_index(self, ip_address_ids):
+        # Firewall rules of the IP addresses by their normalized key, listed
+        # once for one IP address or once for the project, all pages.
+        args = {}
+        args['projectid'] = self.get_project_id()
+        if len(ip_address_ids) == 1:
+            args['ipaddressid'] = ip_address_ids.values()[0]
+
+        index = {}
+        for rule in self._list_all('listFirewallRules', 'firewallrule', **args):
+            if rule['ipaddress'] in ip_address_ids:
+                index[self._get_rule_key(rule)] = rule
+        return index
+
+
+    def apply_rules(self):
+        desired = []
+        for rule in self.module.params.get('rules'):
+            key = self._get_desired_rule_key(rule)
+            if key not in desired:
+                desired.append(key)
+
+        ip_addresses = sorted(set([ k[0] for k in desired ]))
+        ip_address_ids = self.get_ip_address_ids(ip_addresses)
+        existing = self.get_firewall_rules_index(ip_address_ids)
+
+        if self.module.params.get('optimize') and self.module.params.get('state') != 'absent':
+            optimized = self._optimize_rule_keys(desired)
+            self.result['rules_saved'] = len(desired) - len(optimized)
+            desired = optimized
+
+        added = []
+        removed = []
+        if self.module.params.get('state') == 'absent':
+            removed = [ k for k in desired if k in existing ]
+        else:
+            added = [ k for k in desired if k not in existing ]
+            if self.module.params.get('optimize'):
+                # not to add an aggregated rule next to the rules it replaces
+                added = [ k for k in added if not self._is_rule_covered(k, existing) ]
+
+        calls = []
+        for ip_address, protocol, ports, icmp, cidr in added:
+            args = {}
+            args['cidrlist'] = ','.join(cidr)
+            args['protocol'] = protocol
+            args['startport'] = ports[0]
+            args['endport'] = ports[1]
+            args['icmptype'] = icmp[0]
+            args['icmpcode'] = icmp[1]
+            args['ipaddressid'] = ip_address_ids[ip_address]
+            calls.append((self.cs.createFirewallRule, args))
+        for key in removed:
+            calls.append((self.cs.deleteFirewallRule, { 'id': existing[key]['id'] }))
+
+        if len(ip_addresses) == 1:
+            self.result['ip_address'] = ip_addresses[0]
+        self.result['rules_added'] = [ self._get_rule_from_key(k) for k in added ]
+        self.result['rules_removed'] = [ self._get_rule_from_key(k) for k in removed ]
+
+        if calls:
+            self.result['changed'] = True
+            if not self.module.check_mode:
+                concurrency = self.module.params.get('concurrency')
+                res = self._run_jobs(calls, 'firewallrule', concurrency)
+
+                errors = [ r['errortext'] for r in res if 'errortext' in r ]
+                if errors:
+                    self.module.fail_json(msg="Failed: %s" % '; '.join(errors), **self.result)
+                if not self.module.params.get('poll_async'):
+                    self.result['job_ids'] = [ r['jobid'] for r in res if 'jobid' in r ]
+        return self.result
+
+
     def get_result(self, firewall_rule):
         return self.result
 
@@ -372,8 +945,11 @@ class AnsibleCloudStackFirewall(AnsibleCloudStack):
 def main():
     module = AnsibleModule(
         argument_spec = dict(
-            ip_address = dict(required=True, default=None),
+            ip_address = dict(default=None),
             cidr = dict(default='0.0.0.0/0'),
+            optimize = dict(type='bool', default=False),
+            rules = dict(type='list', default=None),
+            concurrency = dict(type='int', default=10),
             protocol = dict(choices=['tcp', 'udp', 'icmp'], default='tcp'),
             icmp_type = dict(type='int', default=None),
             icmp_code = dict(type='int', default=None),
@@ -381,6 +957,7 @@ def main():
             end_port = dict(type='int', default=None),
             state = dict(choices=['present', 'absent'], default='present'),
             project = dict(default=None),
+            poll_async = dict(choices=BOOLEANS, default=True),
             api_key = dict(default=None),
             api_secret = dict(default=None),
             api_url = dict(default=None),
@@ -403,12 +980,17 @@ def main():
         acs_fw = AnsibleCloudStackFirewall(module)
 
         state = module.params.get('state')
-        if state in ['absent']:
+        if module.params.get('rules') is None and not module.params.get('ip_address'):
+            module.fail_json(msg="missing required arguments: ip_address")
+
+        if module.params.get('rules') is not None:
+            result = acs_fw.apply_rules()
+        elif state in ['absent']:
             fw_rule = acs_fw.remove_firewall_rule()
+            result = acs_fw.get_result(fw_rule)
         else:
             fw_rule = acs_fw.create_firewall_rule()
-
-        result = acs_fw.get_result(fw_rule)
+            result = acs_fw.get_result(fw_rule)
 
     except CloudStackException, e:
         module.fail_json(msg='CloudStackException: %s' % str(e))
@@ -29,12 +29,43 @@ options:
   name:
     description:
       - Name of the ISO.
+      - Shell-style pattern of the names if C(state=cleanup), e.g. C(debian-8-*).
     required: true
   url:
     description:
-      - URL where the ISO can be downloaded from. Required if C(state) is present.
+      - URL where the ISO can be downloaded from. Required if C(state) is present and C(path) is not set.
     required: false
     default: null
+  path:
+    description:
+      - Path of a local image file to register. The file is served by an HTTP server started on this host until it is downloaded into the zones. Mutually exclusive with C(url).
+      - The file is sent by sendfile(), on Python 2 this requires the python library pysendfile. Without it the file is copied through Python buffers and a warning is returned.
+    required: false
+    default: null
+  serve_address:
+    description:
+      - Address the secondary storage VMs reach this host by for downloading C(path).
+      - If not set, the address of the interface routing to the API is used.
+      - The HTTP server serving C(path) listens on this address only.
+    required: false
+    default: null
+  serve_port:
+    description:
+      - Port the image file C(path) is served on, C(0) picks a free port.
+    required: false
+    default: 0
+  checksum_algorithm:
+    description:
+      - Algorithm of the checksum computed from the image file C(path).
+      - Checksums other than MD5 are prefixed by the algorithm, e.g. C({SHA-256}), supported since CloudStack 4.11.
+    required: false
+    default: 'md5'
+    choices: [ 'md5', 'sha1', 'sha256', 'sha512' ]
+  checksum_cache:
+    description:
+      - Path of the file caching the checksums computed by path, size and modification time of the image files.
+    required: false
+    default: '~/.ansible-cloudstack-checksum.cache'
   os_type:
     description:
       - Name of the OS that best represents the OS of this ISO. If the iso is bootable this parameter needs to be passed. Required if C(state) is present.
@@ -65,6 +96,7 @@ options:
   checksum:
     description:
       - The MD5 checksum value of this ISO. If set, we search by checksum instead of name.
+      - If not set, it is computed from the image file C(path) if given.
     required: false
     default: false
   bootable:
@@ -82,18 +114,55 @@ options:
       - Name of the zone you wish the ISO to be registered or deleted from. If not specified, first zone found will be used.
     required: false
     default: null
+  zones:
+    description:
+      - List of names of the zones you wish the ISO to be registered in or deleted from, C(all) for all zones. The ISO is registered in the zones concurrently. Mutually exclusive with C(zone).
+    required: false
+    default: null
+  concurrency:
+    description:
+      - Max number of zones the ISO is registered in or deleted from at the same time.
+    required: false
+    default: 10
+  wait_for_ready:
+    description:
+      - Whether to wait until the ISO is ready in all zones. The zones are polled together, with backoff.
+    required: false
+    default: false
+  wait_timeout:
+    description:
+      - Seconds to wait for the ISO to be ready if C(wait_for_ready=true).
+    required: false
+    default: 3600
   iso_filter:
     description:
       - Name of the filter used to search for the ISO.
     required: false
     default: 'self'
     choices: [ 'featured', 'self', 'selfexecutable','sharedexecutable','executable', 'community' ]
+  catalog_cache:
+    description:
+      - Path of the file caching an index of the ISOs by zone, checksum and name. The index is built by listing all ISOs of all zones if it is missing or expired. Otherwise existence checks are looked up in the index and verified by one listing filtered by the id found, or by C(name) if none is found.
+    required: false
+    default: '~/.ansible-cloudstack-catalog.cache'
+  catalog_cache_ttl:
+    description:
+      - Seconds the cached index is used, C(0) disables the cache.
+    required: false
+    default: 300
   state:
     description:
       - State of the ISO.
+      - C(cleanup) removes all ISOs matching C(name) older than C(older_than) days not used by any VM.
+      - C(cleanup) fails without removing any ISOs if the VMs using them can not be listed.
     required: false
     default: 'present'
-    choices: [ 'present', 'absent' ]
+    choices: [ 'present', 'absent', 'cleanup' ]
+  older_than:
+    description:
+      - Minimal age in days of the ISOs removed if C(state=cleanup).
+    required: false
+    default: 0
 '''
 
 EXAMPLES = '''
@@ -115,6 +184,16 @@ EXAMPLES = '''
     checksum: 0b31bccccb048d20b551f70830bb7ad0
 
 
+# Register an ISO in all zones and wait until it is ready
+- local_action:
+    module: cs_iso
+    name: Debian 7 64-bit
+    url: http://mirror.switch.ch/ftp/mirror/debian-cd/current/amd64/iso-cd/debian-7.7.0-amd64-netinst.iso
+    os_type: Debian GNU/Linux 7(64-bit)
+    zones: all
+    wait_for_ready: true
+
+
 # Remove an ISO by name
 - local_action:
     module: cs_iso
@@ -128,6 +207,15 @@ EXAMPLES = '''
     name: Debian 7 64-bit
     checksum: 0b31bccccb048d20b551f70830bb7ad0
     state: absent
+
+
+# Remove all ISOs of a name pattern older than 90 days not used by any VM
+- local_action:
+    module: cs_iso
+    name: debian-*
+    zones: all
+    older_than: 90
+    state: cleanup
 '''
 
 RETURN = '''
@@ -167,8 +255,46 @@ created:
   returned: success
   type: string
   sample: 2015-03-29T14:57:06+0200
+zones:
+  description: Status of the ISO per zone.
+  returned: success
+  type: list
+  sample: [ { zone: zuerich, id: 5fd4a81b-a6a9-4d9e-9bdb-ea1b4f48d7a5, status: Successfully Installed, is_ready: true, changed: true } ]
+removed:
+  description: ISOs removed by C(state=cleanup), in check mode the ISOs which would be removed.
+  returned: success
+  type: list
+  sample: [ { name: debian-8-20150101, id: 2b1cd4d9-8ee4-4e54-a0a7-ab23a7f9e3fd, zone: zuerich, created: 2015-01-01T10:15:03+0100 } ]
+in_use:
+  description: ISOs matched by C(state=cleanup) but kept as used by VMs.
+  returned: success
+  type: list
+  sample: [ { name: debian-8-20150301, id: 5fd4a81b-a6a9-4d9e-9bdb-ea1b4f48d7a5, zone: zuerich, created: 2015-03-01T10:15:03+0100, vms: [ web-01 ] } ]
 '''
 
+import os
+import json
+import fnmatch
+import calendar
+import mmap
+import hashlib
+import socket
+import urllib
+import urlparse
+import time
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
 try:
     from cs import CloudStack, CloudStackException, read_config
     has_lib_cs = True
@@ -259,7 +385,7 @@ class AnsibleCloudStack:
         vms = self.cs.listVirtualMachines(**args)
         if vms:
             for v in vms['virtualmachine']:
-                if vm in [ v['name'], v['displaytext'] v['id'] ]:
+                if vm in [ v['name'], v['displayname'], v['id'] ]:
                     self.vm_id = v['id']
                     return self.vm_id
         self.module.fail_json(msg="Virtual machine '%s' not found" % vm)
@@ -285,6 +411,31 @@ class AnsibleCloudStack:
         self.module.fail_json(msg="zone '%s' not found" % zone)
 
 
+    def get_zones(self):
+        # Zones given by param zones, all zones if it contains 'all'. Without
+        # zones, the zone of param zone or the first zone found is used.
+        res = self.cs.listZones()
+        all_zones = []
+        if res and 'zone' in res:
+            all_zones = res['zone']
+
+        zones = self.module.params.get('zones')
+        if not zones:
+            if not self.module.params.get('zone'):
+                return all_zones[:1]
+            zones = [ self.module.params.get('zone') ]
+        elif 'all' in zones:
+            return all_zones
+
+        result = []
+        for zone in zones:
+            found = [ z for z in all_zones if zone in [ z['name'], z['id'] ] ]
+            if not found:
+                self.module.fail_json(msg="zone '%s' not found" % zone)
+            result.append(found[0])
+        return result
+
+
     def get_os_type_id(self):
         if self.os_type_id:
             return self.os_type_id
@@ -321,20 +472,271 @@ class AnsibleCloudStack:
         self.module.fail_json(msg="Hypervisor '%s' not found" % hypervisor)
 
 
+    def _list_all(self, method, key, page_size=500, **args):
+        # All pages of a list API call, the API returns at most pagesize
+        # items a call. Returns the items of the response key.
+        args['pagesize'] = page_size
+        items = []
+        page = 1
+        while True:
+            args['page'] = page
+            res = getattr(self.cs, method)(**args)
+            if not res or key not in res:
+                break
+            items.extend(res[key])
+            if len(res[key]) < page_size:
+                break
+            page += 1
+        return items
+
+
     def _poll_job(self, job=None, key=None):
         if 'jobid' in job:
             while True:
                 res = self.cs.queryAsyncJobResult(jobid=job['jobid'])
-                if res['jobstatus'] != 0 and 'jobresult' in res:
-                    if 'errortext' in res['jobresult']:
-                        self.module.fail_json(msg="Failed: '%s'" % res['jobresult']['errortext'])
-                    if key and key in res['jobresult']:
-                        job = res['jobresult'][key]
+                if res['jobstatus'] != 0:
+                    job_result = self._get_job_result(job['jobid'], res)
+                    if 'errortext' in job_result:
+                        self.module.fail_json(msg="Failed: '%s'" % job_result['errortext'])
+                    if key and key in job_result:
+                        job = job_result[key]
                     break
                 time.sleep(2)
         return job
 
 
+    def _get_job_result(self, jobid, res, key=None):
+        # The result of a finished job, a failed job (jobstatus 2) as dict
+        # having 'errortext', even if the API gives none.
+        job_result = res.get('jobresult', {})
+        if res['jobstatus'] == 2 or 'errortext' in job_result:
+            errortext = job_result.get('errortext') or "job failed with result code %s" % res.get('jobresultcode')
+            return { 'jobid': jobid, 'errortext': errortext }
+        if key and key in job_result:
+            return job_result[key]
+        return job_result
+
+
+    def _poll_jobs(self, jobs, key=None, timeout=None):
+        # Polls the async jobs together, one query per running job and round.
+        # Returns the results in order of the jobs, a failed job as dict
+        # having 'errortext' and a job still running after timeout as given.
+        # The timeout defaults to the module param, without one the jobs are
+        # waited for until done; a timeout of 0 queries them once.
+        if timeout is None:
+            timeout = self.module.params.get('timeout')
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        results = list(jobs)
+        running = {}
+        for i, job in enumerate(jobs):
+            if job and 'jobid' in job:
+                running[job['jobid']] = i
+
+        while running:
+            for jobid, i in running.items():
+                res = self.cs.queryAsyncJobResult(jobid=jobid)
+                if res['jobstatus'] != 0:
+                    del running[jobid]
+                    results[i] = self._get_job_result(jobid, res, key)
+
+            if not running:
+                break
+            delay = 2
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                delay = min(delay, remaining)
+            time.sleep(delay)
+        return results
+
+
+    def _run_jobs(self, calls, key=None, concurrency=10, poll_async=None):
+        # Submits the (api method, args) calls keeping at most concurrency
+        # jobs running, polled together. Returns the results in order of the
+        # calls, failures as dict having 'errortext'. Without poll_async all
+        # calls are submitted and the jobs are returned as given, poll_async
+        # defaults to the module param.
+        if poll_async is None:
+            poll_async = self.module.params.get('poll_async', True)
+        results = [ None ] * len(calls)
+        queued = list(enumerate(calls))
+        running = {}
+        while queued or running:
+            while queued and (len(running) < concurrency or not poll_async):
+                i, (method, args) = queued.pop(0)
+                try:
+                    res = method(**args)
+                except CloudStackException, e:
+                    res = { 'errortext': str(e) }
+                results[i] = res
+                if poll_async and 'jobid' in res and 'errortext' not in res:
+                    running[res['jobid']] = i
+
+            for jobid, i in running.items():
+                res = self.cs.queryAsyncJobResult(jobid=jobid)
+                if res['jobstatus'] != 0:
+                    del running[jobid]
+                    results[i] = self._get_job_result(jobid, res, key)
+            if running:
+                time.sleep(2)
+        return results
+
+
+    def _run_calls(self, calls, concurrency=10):
+        # Runs the synchronous (api method, args) calls in up to concurrency
+        # threads. Returns the results in order of the calls, failures as
+        # dict having 'errortext'.
+        results = [ None ] * len(calls)
+        queued = list(enumerate(calls))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                lock.acquire()
+                try:
+                    if not queued:
+                        return
+                    i, (method, args) = queued.pop(0)
+                finally:
+                    lock.release()
+                try:
+                    results[i] = method(**args)
+                except Exception, e:
+                    results[i] = { 'errortext': str(e) }
+
+        threads = [ threading.Thread(target=worker) for i in range(min(concurrency, len(calls))) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+
+    def _parse_cidr(self, cidr):
+        # Returns the IPv4 CIDR as (network, prefix length) or None if it is
+        # not an IPv4 network in full notation.
+        try:
+            address, prefix = cidr.strip().split('/')
+            octets = [ int(o) for o in address.split('.') ]
+            prefix = int(prefix)
+        except (AttributeError, ValueError):
+            return None
+        if len(octets) != 4 or [ o for o in octets if not 0 <= o <= 255 ] or not 0 <= prefix <= 32:
+            return None
+
+        network = (octets[0] << 24) + (octets[1] << 16) + (octets[2] << 8) + octets[3]
+        if network & ((1 << (32 - prefix)) - 1):
+            return None
+        return (network, prefix)
+
+
+    def _format_cidr(self, network, prefix):
+        octets = [ str((network >> shift) & 255) for shift in [24, 16, 8, 0] ]
+        return '%s/%d' % ('.'.join(octets), prefix)
+
+
+    def _collapse_cidrs(self, cidrs):
+        # Collapses the CIDRs into the minimal list of networks covering the
+        # same addresses, networks contained in others are dropped and
+        # adjacent siblings are merged into their supernet. CIDRs not being
+        # IPv4 networks are kept as given.
+        networks = []
+        others = []
+        for cidr in cidrs:
+            network = self._parse_cidr(cidr)
+            if network:
+                networks.append(network)
+            elif cidr not in others:
+                others.append(cidr)
+
+        collapsed = []
+        for network, prefix in sorted(networks):
+            if collapsed:
+                last_network, last_prefix = collapsed[-1]
+                if network >> (32 - last_prefix) == last_network >> (32 - last_prefix):
+                    continue
+            collapsed.append((network, prefix))
+
+            while len(collapsed) > 1:
+                (lower, lower_prefix), (upper, upper_prefix) = collapsed[-2:]
+                size = 1 << (32 - upper_prefix)
+                if lower_prefix != upper_prefix or lower & size or lower + size != upper:
+                    break
+                collapsed[-2:] = [ (lower, lower_prefix - 1) ]
+
+        return [ self._format_cidr(n, p) for n, p in collapsed ] + others
+
+
+    def _is_cidr_covered(self, cidr, cidrs):
+        # Whether the addresses of the CIDR are all in the CIDRs given, by one
+        # network containing it or by the networks within it collapsing into
+        # it. CIDRs not being IPv4 networks must be given as they are.
+        network = self._parse_cidr(cidr)
+        if not network:
+            return cidr in cidrs
+        address, prefix = network
+
+        inner = []
+        for other in cidrs:
+            other_network = self._parse_cidr(other)
+            if not other_network:
+                continue
+            other_address, other_prefix = other_network
+            if other_prefix <= prefix:
+                if address >> (32 - other_prefix) == other_address >> (32 - other_prefix):
+                    return True
+            elif other_address >> (32 - prefix) == address >> (32 - prefix):
+                inner.append(other)
+        return self._collapse_cidrs(inner) == [ self._format_cidr(address, prefix) ]
+
+
+    def _is_covered(self, cidrs, ports, covering):
+        # Whether the CIDRs on the (start port, end port) range are covered by
+        # the union of the (cidrs, ports) given, e.g. by the existing rules an
+        # aggregated rule would replace. Ports (None, None) stand for rules
+        # without ports. The range is split at the bounds of the covering
+        # ranges, each part must be covered by the CIDRs of the rules
+        # spanning it.
+        start_port, end_port = ports
+        if start_port is None:
+            parts = [ (None, None) ]
+        else:
+            bounds = set([ start_port, end_port + 1 ])
+            for covering_cidrs, (covering_start, covering_end) in covering:
+                if covering_start is None:
+                    continue
+                for bound in [ covering_start, covering_end + 1 ]:
+                    if start_port < bound <= end_port:
+                        bounds.add(bound)
+            bounds = sorted(bounds)
+            parts = [ (bounds[i], bounds[i + 1] - 1) for i in range(len(bounds) - 1) ]
+
+        for part_start, part_end in parts:
+            part_cidrs = []
+            for covering_cidrs, (covering_start, covering_end) in covering:
+                if part_start is None or (covering_start is not None and covering_start <= part_start and part_end <= covering_end):
+                    part_cidrs.extend(covering_cidrs)
+            for cidr in cidrs:
+                if not self._is_cidr_covered(cidr, part_cidrs):
+                    return False
+        return True
+
+
+    def _merge_port_ranges(self, port_ranges):
+        # Merges overlapping and contiguous (start port, end port) ranges.
+        merged = []
+        for start_port, end_port in sorted(port_ranges):
+            if merged and start_port <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end_port))
+            else:
+                merged.append((start_port, end_port))
+        return merged
+
+
 class AnsibleCloudStackIso(AnsibleCloudStack):
 
     def __init__(self, module):
@@ -342,13 +744,63 @@ class AnsibleCloudStackIso(AnsibleCloudStack):
         self.result = {
             'changed': False,
         }
+        self.catalog = None
+        self.checksum = None
         self.iso = None
 
+    def get_checksum(self):
+        if not self.checksum:
+            self.checksum = self.module.params.get('checksum')
+            path = self.module.params.get('path')
+            if not self.checksum and path:
+                algorithm = self.module.params.get('checksum_algorithm')
+                try:
+                    digest = ImageChecksum(self.module).get(os.path.expanduser(path), algorithm)
+                except (IOError, OSError), e:
+                    self.module.fail_json(msg="Failed to compute checksum of image file '%s': %s" % (path, str(e)))
+                if algorithm == 'md5':
+                    self.checksum = digest
+                else:
+                    self.checksum = '{%s}%s' % (algorithm.upper().replace('SHA', 'SHA-'), digest)
+        return self.checksum
+
+
+    def get_serve_address(self):
+        # Address of the interface routing to the API, the secondary storage
+        # VMs usually reach this host by the same way.
+        host = urlparse.urlparse(self.cs.endpoint).hostname
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect((host, 80))
+            return s.getsockname()[0]
+        finally:
+            s.close()
+
+
+    def start_image_server(self):
+        # The server listens on the serve address only, not on all interfaces.
+        path = os.path.expanduser(self.module.params.get('path'))
+        if not os.path.isfile(path):
+            self.module.fail_json(msg="Image file '%s' not found." % path)
+        try:
+            address = self.module.params.get('serve_address') or self.get_serve_address()
+            image_server = ImageServer(path, address, self.module.params.get('serve_port'))
+        except socket.error, e:
+            self.module.fail_json(msg="Failed to serve image file '%s': %s" % (path, str(e)))
+        if not sendfile:
+            self.result.setdefault('warnings', []).append("python library pysendfile not found, image file '%s' is served through Python buffers: pip install pysendfile" % path)
+        image_server.start()
+        return image_server
+
+
     def register_iso(self):
-        iso = self.get_iso()
-        if not iso:
+        image_server = None
+        zones = self.get_zones()
+        isos = self.get_isos(zones)
+
+        missing = [ z for z in zones if z['id'] not in isos ]
+        if missing:
             args = {}
-            args['zoneid'] = self.get_zone_id()
             args['projectid'] = self.get_project_id()
 
             args['bootable'] = self.module.params.get('bootable')
@@ -357,59 +809,314 @@ class AnsibleCloudStackIso(AnsibleCloudStack):
                 self.module.fail_json(msg="OS type 'os_type' is requried if 'bootable=true'.")
 
             args['url'] = self.module.params.get('url')
-            if not args['url']:
+            if not args['url'] and not self.module.params.get('path'):
                 self.module.fail_json(msg="URL is requried.")
 
             args['name'] = self.module.params.get('name')
             args['displaytext'] = self.module.params.get('name')
-            args['checksum'] = self.module.params.get('checksum')
+            args['checksum'] = self.get_checksum()
             args['isdynamicallyscalable'] = self.module.params.get('is_dynamically_scalable')
             args['isfeatured'] = self.module.params.get('is_featured')
             args['ispublic'] = self.module.params.get('is_public')
 
-            self.result['changed'] = True
-            if not self.module.check_mode:
-                res = self.cs.registerIso(**args)
-                iso = res['iso'][0]
-        return iso
+            if self.module.params.get('path') and not self.module.check_mode:
+                image_server = self.start_image_server()
+                args['url'] = image_server.get_url()
 
+            calls = []
+            for zone in missing:
+                zone_args = args.copy()
+                zone_args['zoneid'] = zone['id']
+                calls.append((self.cs.registerIso, zone_args))
 
-    def get_iso(self):
-        if not self.iso:
+            self.result['changed'] = True
+            if not self.module.check_mode:
+                concurrency = self.module.params.get('concurrency')
+                res = self._run_calls(calls, concurrency)
+                errors = []
+                for zone, r in zip(missing, res):
+                    if 'errortext' in r:
+                        errors.append("%s: %s" % (zone['name'], r['errortext']))
+                    else:
+                        isos[zone['id']] = r['iso'][0]
+                        self.get_catalog().add(r['iso'][0])
+                if errors:
+                    self.result['zones'] = self.get_zones_result(zones, isos, missing)
+                    self.module.fail_json(msg="Failed: %s" % '; '.join(errors), **self.result)
+
+        if image_server:
+            # the image is served until it is downloaded into all zones
+            try:
+                isos = self.wait_for_ready(zones, isos, missing)
+            finally:
+                image_server.stop()
+        elif self.module.params.get('wait_for_ready') and not self.module.check_mode:
+            isos = self.wait_for_ready(zones, isos, missing)
+
+        self.result['zones'] = self.get_zones_result(zones, isos, missing)
+        for zone in zones:
+            if zone['id'] in isos:
+                return isos[zone['id']]
+        return None
+
+
+    def _is_failed(self, iso):
+        status = iso.get('status', '').lower()
+        return not iso.get('isready') and ('fail' in status or 'error' in status)
+
+
+    def wait_for_ready(self, zones, isos, registered):
+        # Polls the ISOs of all zones by one listing per pending id and round,
+        # backing off from 2 up to 30 seconds between the rounds. The ISOs are
+        # listed by id, an ISO found by checksum may have another name.
+        timeout = self.module.params.get('wait_timeout')
+        started = time.time()
+        delay = 2
+        while True:
+            pending = [ z for z in zones if z['id'] in isos and not isos[z['id']].get('isready') and not self._is_failed(isos[z['id']]) ]
+            if not pending:
+                break
+            if time.time() - started > timeout:
+                self.result['zones'] = self.get_zones_result(zones, isos, registered)
+                self.module.fail_json(msg="Timeout waiting for ISO to be ready in zones: %s" % ', '.join([ z['name'] for z in pending ]), **self.result)
+
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+            pending_ids = dict([ (z['id'], isos[z['id']]['id']) for z in pending ])
+            listed = []
+            for iso_id in sorted(set(pending_ids.values())):
+                args = {}
+                args['isofilter'] = self.module.params.get('iso_filter')
+                args['projectid'] = self.get_project_id()
+                args['id'] = iso_id
+                res = self.cs.listIsos(**args)
+                if res and 'iso' in res:
+                    for i in res['iso']:
+                        if pending_ids.get(i.get('zoneid')) == i['id']:
+                            isos[i['zoneid']] = i
+                            listed.append(i['zoneid'])
+                            self.get_catalog().add(i)
+
+            # an ISO vanished while downloading will never get ready
+            for zone in pending:
+                if zone['id'] not in listed:
+                    isos[zone['id']] = dict(isos[zone['id']], status='Error: ISO not found')
+
+        failed = [ z['name'] for z in zones if z['id'] in isos and self._is_failed(isos[z['id']]) ]
+        if failed:
+            self.result['zones'] = self.get_zones_result(zones, isos, registered)
+            self.module.fail_json(msg="ISO failed to get ready in zones: %s" % ', '.join(failed), **self.result)
+        return isos
+
+
+    def get_zones_result(self, zones, isos, registered):
+        result = []
+        for zone in zones:
+            zone_result = {}
+            zone_result['zone'] = zone['name']
+            zone_result['changed'] = zone in registered
+            if zone['id'] in isos:
+                iso = isos[zone['id']]
+                zone_result['id'] = iso.get('id')
+                zone_result['status'] = iso.get('status')
+                zone_result['is_ready'] = iso.get('isready')
+            result.append(zone_result)
+        return result
+
+
+    def get_catalog(self):
+        if not self.catalog:
             args = {}
-            args['isready'] = self.module.params.get('is_ready')
             args['isofilter'] = self.module.params.get('iso_filter')
             args['projectid'] = self.get_project_id()
-            args['zoneid'] = self.get_zone_id()
+            self.catalog = Catalog(self.module, self.cs, 'iso', self.cs.listIsos, args)
+        return self.catalog
 
-            # if checksum is set, we only look on that.
-            checksum = self.module.params.get('checksum')
-            if not checksum:
-                args['name'] = self.module.params.get('name')
 
-            isos = self.cs.listIsos(**args)
-            if isos:
-                if not checksum:
-                    self.iso = isos['iso'][0]
-                else:
-                    for i in isos['iso']:
-                        if i['checksum'] == checksum:
-                            self.iso = i
-                            break
+    def get_isos(self, zones):
+        # ISOs by zone id, listed once for all zones.
+        args = {}
+        args['isready'] = self.module.params.get('is_ready')
+        args['isofilter'] = self.module.params.get('iso_filter')
+        args['projectid'] = self.get_project_id()
+        if len(zones) == 1:
+            args['zoneid'] = zones[0]['id']
+
+        # if checksum is set, we only look on that.
+        checksum = self.get_checksum()
+        if not checksum:
+            args['name'] = self.module.params.get('name')
+
+        isos = {}
+        catalog = self.get_catalog()
+        if catalog.enabled():
+            for zone in zones:
+                item = catalog.get(zone['id'], self.module.params.get('name'), checksum)
+                if item and (item.get('isready') or not args['isready']):
+                    isos[zone['id']] = item
+            return isos
+
+        zone_ids = [ z['id'] for z in zones ]
+        res = self.cs.listIsos(**args)
+        if res and 'iso' in res:
+            for i in res['iso']:
+                if i.get('zoneid') not in zone_ids or i.get('zoneid') in isos:
+                    continue
+                if not checksum or i['checksum'] == checksum:
+                    isos[i['zoneid']] = i
+        return isos
+
+
+    def get_iso(self):
+        if not self.iso:
+            zones = self.get_zones()
+            self.iso = self.get_isos(zones).get(zones[0]['id'])
         return self.iso
 
 
     def remove_iso(self):
-        iso = self.get_iso()
-        if iso:
+        zones = self.get_zones()
+        isos = self.get_isos(zones)
+
+        removed = [ z for z in zones if z['id'] in isos ]
+        if removed:
             self.result['changed'] = True
+            calls = []
+            for zone in removed:
+                args = {}
+                args['id'] = isos[zone['id']]['id']
+                args['projectid'] = self.get_project_id()
+                args['zoneid'] = zone['id']
+                calls.append((self.cs.deleteIso, args))
+
+            if not self.module.check_mode:
+                concurrency = self.module.params.get('concurrency')
+                res = self._run_jobs(calls, 'iso', concurrency)
+                errors = [ "%s: %s" % (z['name'], r['errortext']) for z, r in zip(removed, res) if 'errortext' in r ]
+                for z, r in zip(removed, res):
+                    if 'errortext' not in r:
+                        self.get_catalog().remove(isos[z['id']])
+                if errors:
+                    self.module.fail_json(msg="Failed: %s" % '; '.join(errors))
+
+        self.result['zones'] = self.get_zones_result(zones, isos, removed)
+        for zone in removed:
+            return isos[zone['id']]
+        return None
+
+
+    def get_vm_iso_ids(self):
+        # VM names by ISO id, indexed by listing all VMs page by page, of all
+        # projects and the VMs not in a project if no project is given. A VM
+        # references an ISO by isoid if attached and by templateid if
+        # deployed from it. Fails if a listing fails, usage must be known to
+        # delete.
+        project_id = self.get_project_id()
+        if project_id:
+            scopes = [ { 'projectid': project_id } ]
+        else:
+            scopes = [ { 'projectid': -1 }, {} ]
+
+        vm_names = {}
+        vm_ids = set()
+        for scope in scopes:
             args = {}
-            args['id'] = iso['id']
-            args['projectid'] = self.get_project_id()
-            args['zoneid'] = self.get_zone_id()
+            args.update(scope)
+            args['listall'] = True
+            try:
+                for vm in self._list_all('listVirtualMachines', 'virtualmachine', **args):
+                    if vm['id'] in vm_ids:
+                        continue
+                    vm_ids.add(vm['id'])
+                    for iso_id in set([ vm.get('isoid'), vm.get('templateid') ]):
+                        if iso_id:
+                            vm_names.setdefault(iso_id, []).append(vm['name'])
+            except CloudStackException, e:
+                self.module.fail_json(msg="Failed to list the VMs using the ISOs, not removing any: %s" % str(e))
+        return vm_names
+
+
+    def _get_age(self, created):
+        # Seconds since created, e.g. 2015-03-29T14:57:06+0200, None if it
+        # can not be parsed.
+        try:
+            timestamp = calendar.timegm(time.strptime(created[:19], '%Y-%m-%dT%H:%M:%S'))
+            offset = created[19:]
+            if offset:
+                sign = -1 if offset[0] == '-' else 1
+                timestamp -= sign * (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60)
+        except (ValueError, TypeError):
+            return None
+        return time.time() - timestamp
+
+
+    def _get_cleanup_result(self, iso, vm_names=None):
+        result = {}
+        result['id'] = iso['id']
+        result['name'] = iso['name']
+        result['zone'] = iso.get('zonename')
+        result['created'] = iso.get('created')
+        if vm_names:
+            result['vms'] = vm_names
+        return result
+
+
+    def cleanup_isos(self):
+        # Removes the ISOs matching the name pattern older than
+        # older_than days and not used by any VM, listed once for all zones,
+        # all pages.
+        zones = self.get_zones()
+        zone_ids = [ z['id'] for z in zones ]
+        pattern = self.module.params.get('name')
+        max_age = self.module.params.get('older_than') * 86400
+
+        args = {}
+        args['isofilter'] = self.module.params.get('iso_filter')
+        args['projectid'] = self.get_project_id()
+        if len(zones) == 1:
+            args['zoneid'] = zones[0]['id']
+
+        candidates = []
+        for i in self._list_all('listIsos', 'iso', **args):
+            if i.get('zoneid') not in zone_ids or not fnmatch.fnmatchcase(i['name'], pattern):
+                continue
+            age = self._get_age(i.get('created'))
+            if max_age and (age is None or age < max_age):
+                continue
+            candidates.append(i)
+
+        stale = []
+        in_use = []
+        vm_names = self.get_vm_iso_ids() if candidates else {}
+        for i in candidates:
+            if i['id'] in vm_names:
+                in_use.append(self._get_cleanup_result(i, vm_names[i['id']]))
+            else:
+                stale.append(i)
+
+        self.result['removed'] = [ self._get_cleanup_result(i) for i in stale ]
+        self.result['in_use'] = in_use
+        if stale:
+            self.result['changed'] = True
+            calls = []
+            for i in stale:
+                args = {}
+                args['id'] = i['id']
+                args['projectid'] = self.get_project_id()
+                args['zoneid'] = i['zoneid']
+                calls.append((self.cs.deleteIso, args))
+
             if not self.module.check_mode:
-                res = self.cs.deleteIso(**args)
-        return iso
+                concurrency = self.module.params.get('concurrency')
+                res = self._run_jobs(calls, 'iso', concurrency)
+                errors = [ "%s (%s): %s" % (i['name'], i.get('zonename'), r['errortext']) for i, r in zip(stale, res) if 'errortext' in r ]
+                for i, r in zip(stale, res):
+                    if 'errortext' not in r:
+                        self.get_catalog().remove(i)
+                if errors:
+                    self.module.fail_json(msg="Failed: %s" % '; '.join(errors), **self.result)
+        return None
 
 
     def get_result(self, iso):
@@ -431,13 +1138,380 @@ class AnsibleCloudStackIso(AnsibleCloudStack):
         return self.result
 
 
+class Catalog:
+    # Index of the templates or ISOs by zone, checksum and name, stored in
+    # the file catalog_cache and shared between module runs for
+    # catalog_cache_ttl seconds. The index is built by one listing of all
+    # zones if the cache is missing or expired. Otherwise a lookup in the
+    # index read from the file is verified by one listing filtered by the id
+    # found, or by the name if none is found, merged into the index.
+    # Registered and removed items are updated in place.
+
+    FIELDS = [ 'id', 'name', 'displaytext', 'checksum', 'zoneid', 'zonename', 'status', 'isready', 'created', 'templatetag' ]
+
+    PAGE_SIZE = 500
+
+    def __init__(self, module, cs, kind, list_method, args):
+        self.module = module
+        self.kind = kind
+        self.list_method = list_method
+        self.args = args
+        self.path = os.path.expanduser(module.params.get('catalog_cache') or '')
+        self.ttl = module.params.get('catalog_cache_ttl') or 0
+        self.key = '|'.join([ getattr(cs, 'endpoint', '') or '', kind ] + [ '%s=%s' % (k, args[k]) for k in sorted(args) ])
+        self.zones = None
+        self.timestamp = None
+        self.refreshed = False
+        self.changed = False
+        self.lookups = set()
+
+
+    def enabled(self):
+        return self.path and self.ttl > 0
+
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+    def load(self):
+        if self.zones is not None:
+            return
+        entry = self.read().get(self.key)
+        if entry and entry['timestamp'] + self.ttl > time.time():
+            self.zones = entry['zones']
+            self.timestamp = entry['timestamp']
+        else:
+            self.refresh()
+
+
+    def list(self, **filters):
+        # all pages of the listing, the API returns at most pagesize items
+        # a call
+        args = dict(self.args)
+        args.update(filters)
+        args['pagesize'] = self.PAGE_SIZE
+        items = []
+        page = 1
+        while True:
+            args['page'] = page
+            res = self.list_method(**args)
+            if not res or self.kind not in res:
+                break
+            items.extend(res[self.kind])
+            if len(res[self.kind]) < self.PAGE_SIZE:
+                break
+            page += 1
+        return items
+
+
+    def refresh(self):
+        self.zones = {}
+        self.timestamp = time.time()
+        self.refreshed = True
+        self.changed = True
+        for item in self.list():
+            self.add(item)
+
+
+    def lookup(self, **filters):
+        # Lists the items of a filter once and replaces the indexed items
+        # matching the filter by them, items gone are removed.
+        key = tuple(sorted(filters.items()))
+        if self.refreshed or key in self.lookups:
+            return
+        self.lookups.add(key)
+        items = self.list(**filters)
+        for zone in self.zones.values():
+            for index in zone.values():
+                for k, i in index.items():
+                    if all(i.get(f) == v for f, v in filters.items()):
+                        del index[k]
+        for item in items:
+            self.add(item)
+        self.changed = True
+
+
+    def get(self, zone_id, name=None, checksum=None):
+        self.load()
+        item = self._get(zone_id, name, checksum)
+        if item:
+            self.lookup(id=item['id'])
+            item = self._get(zone_id, name, checksum)
+        if not item and name:
+            self.lookup(name=name)
+            item = self._get(zone_id, name, checksum)
+        elif not item and not self.refreshed:
+            # there is no filter by checksum, list all
+            self.refresh()
+            item = self._get(zone_id, name, checksum)
+        return item
+
+
+    def _get(self, zone_id, name, checksum):
+        zone = self.zones.get(zone_id, {})
+        if checksum:
+            return zone.get('checksum', {}).get(checksum)
+        return zone.get('name', {}).get(name)
+
+
+    def add(self, item):
+        # the first item found for a key wins, as listed by the API
+        if self.zones is None:
+            return
+        item = dict([ (k, item[k]) for k in self.FIELDS if k in item ])
+        zone = self.zones.setdefault(item.get('zoneid'), { 'checksum': {}, 'name': {} })
+        for index, key in [ ('checksum', item.get('checksum')), ('name', item.get('name')) ]:
+            if key and (key not in zone[index] or zone[index][key]['id'] == item['id']):
+                zone[index][key] = item
+        self.changed = True
+
+
+    def remove(self, item):
+        if not self.enabled():
+            return
+        self.load()
+        for index in self.zones.get(item.get('zoneid'), {}).values():
+            for key, i in index.items():
+                if i['id'] == item['id']:
+                    del index[key]
+        self.changed = True
+
+
+    def save(self):
+        if not self.enabled() or not self.changed or self.zones is None:
+            return
+        catalog = self.read()
+        catalog[self.key] = {
+            'timestamp': self.timestamp,
+            'zones': self.zones,
+        }
+        # write to a temp file and rename, other module runs may read it
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(catalog, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+
+class ImageChecksum:
+    # Checksums of local image files, hashed over memory mapped chunks of
+    # the file and stored in the file checksum_cache by path, size and
+    # mtime, so an unchanged image is not hashed again.
+
+    CHUNK_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, module):
+        self.path = os.path.expanduser(module.params.get('checksum_cache') or '')
+
+
+    def read(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+    def save(self, checksums):
+        if not self.path:
+            return
+        # write to a temp file and rename, other module runs may read it
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(checksums, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+
+    def get(self, image_path, algorithm):
+        image_path = os.path.realpath(image_path)
+        stat = os.stat(image_path)
+        key = '%s|%s' % (algorithm, image_path)
+        entry = self.read().get(key)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['checksum']
+
+        checksum = self.compute(image_path, algorithm)
+        checksums = self.read()
+        checksums[key] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'checksum': checksum,
+        }
+        self.save(checksums)
+        return checksum
+
+
+    def compute(self, image_path, algorithm):
+        digest = hashlib.new(algorithm)
+        with open(image_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = 0
+            while offset < size:
+                length = min(self.CHUNK_SIZE, size - offset)
+                chunk = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ, offset=offset)
+                try:
+                    digest.update(chunk)
+                finally:
+                    chunk.close()
+                offset += length
+        return digest.hexdigest()
+
+
+class ImageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # Serves a local image file over HTTP while it is downloaded into the
+    # zones. The file is sent by sendfile() from the page cache to the
+    # socket without passing through Python buffers where available, range
+    # requests let the downloads resume.
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, image_path, address, port):
+        self.image_path = image_path
+        self.address = address
+        self.size = os.path.getsize(image_path)
+        self.name = urllib.quote(os.path.basename(image_path))
+        BaseHTTPServer.HTTPServer.__init__(self, (address, port), ImageRequestHandler)
+        self.thread = None
+
+
+    def get_url(self):
+        return 'http://%s:%d/%s' % (self.address, self.server_address[1], self.name)
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ImageRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_HEAD(self):
+        self.send_image(False)
+
+
+    def do_GET(self):
+        self.send_image(True)
+
+
+    def log_message(self, format, *args):
+        # stdout is the module result
+        pass
+
+
+    def get_range(self):
+        # (start, end) of a single byte range, None for the whole file and
+        # False if the range is not satisfiable.
+        size = self.server.size
+        header = self.headers.get('Range')
+        if not header or not header.startswith('bytes=') or ',' in header:
+            return None
+        start, sep, end = header[len('bytes='):].strip().partition('-')
+        try:
+            if start:
+                start = int(start)
+                end = min(int(end), size - 1) if end else size - 1
+            else:
+                start = max(size - int(end), 0)
+                end = size - 1
+        except ValueError:
+            return None
+        if start > end:
+            return False
+        return (start, end)
+
+
+    def send_image(self, send_body):
+        if self.path.split('?')[0] != '/' + self.server.name:
+            self.send_error(404)
+            return
+
+        size = self.server.size
+        byte_range = self.get_range()
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            start, end = 0, size - 1
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        if send_body:
+            try:
+                self.send_file(start, end - start + 1)
+            except socket.error:
+                # the download was aborted, it may resume by a range request
+                pass
+
+
+    def send_file(self, offset, count):
+        self.wfile.flush()
+        with open(self.server.image_path, 'rb') as f:
+            if sendfile:
+                out_fd = self.connection.fileno()
+                while count > 0:
+                    sent = sendfile(out_fd, f.fileno(), offset, count)
+                    if not sent:
+                        break
+                    offset += sent
+                    count -= sent
+            else:
+                f.seek(offset)
+                while count > 0:
+                    chunk = f.read(min(count, 1024 * 1024))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    count -= len(chunk)
+
+
 def main():
     module = AnsibleModule(
         argument_spec = dict(
             name = dict(required=True, default=None),
             url = dict(default=None),
             os_type = dict(default=None),
+            path = dict(default=None),
+            serve_address = dict(default=None),
+            serve_port = dict(type='int', default=0),
+            checksum_algorithm = dict(default='md5', choices=[ 'md5', 'sha1', 'sha256', 'sha512' ]),
+            checksum_cache = dict(default='~/.ansible-cloudstack-checksum.cache'),
             zone = dict(default=None),
+            zones = dict(type='list', default=None),
+            catalog_cache = dict(default='~/.ansible-cloudstack-catalog.cache'),
+            catalog_cache_ttl = dict(type='int', default=300),
+            concurrency = dict(type='int', default=10),
+            wait_for_ready = dict(choices=BOOLEANS, default=False),
+            wait_timeout = dict(type='int', default=3600),
             iso_filter = dict(default='self', choices=[ 'featured', 'self', 'selfexecutable','sharedexecutable','executable', 'community' ]),
             project = dict(default=None),
             checksum = dict(default=None),
@@ -445,12 +1519,17 @@ def main():
             bootable = dict(choices=BOOLEANS, default=True),
             is_featured = dict(choices=BOOLEANS, default=False),
             is_dynamically_scalable = dict(choices=BOOLEANS, default=False),
-            state = dict(choices=['present', 'absent'], default='present'),
+            state = dict(choices=['present', 'absent', 'cleanup'], default='present'),
+            older_than = dict(type='int', default=0),
             api_key = dict(default=None),
             api_secret = dict(default=None),
             api_url = dict(default=None),
             api_http_method = dict(default='get'),
         ),
+        mutually_exclusive = (
+            ['url', 'path'],
+            ['zone', 'zones'],
+        ),
         supports_check_mode=True
     )
 
@@ -461,11 +1540,16 @@ def main():
         acs_iso = AnsibleCloudStackIso(module)
 
         state = module.params.get('state')
-        if state in ['absent']:
+        if state in ['cleanup']:
+            iso = acs_iso.cleanup_isos()
+        elif state in ['absent']:
             iso = acs_iso.remove_iso()
         else:
             iso = acs_iso.register_iso()
 
+        if acs_iso.catalog:
+            acs_iso.catalog.save()
+
         result = acs_iso.get_result(iso)
 
     except CloudStackException, e:
@@ -0,0 +1,627 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, René Moser <mail@renemoser.net>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible. If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: cs_job
+short_description: Waits for async jobs on Apache CloudStack based clouds.
+description:
+    - Waits for async jobs to finish, e.g. jobs returned as C(job_id) by modules run with C(poll_async=false). All jobs are polled together.
+version_added: '2.0'
+author: René Moser
+options:
+  job_ids:
+    description:
+      - List of ids of the async jobs to wait for.
+    required: true
+    aliases: [ 'job_id' ]
+  timeout:
+    description:
+      - Seconds to wait for all jobs to finish. The module fails for jobs still running after timeout.
+      - With a timeout of 0, the jobs are queried once without waiting.
+      - In check mode, the jobs are queried once without waiting and jobs still running are reported as pending.
+    required: false
+    default: 600
+  fail_on_error:
+    description:
+      - Fail if one of the jobs failed.
+    required: false
+    default: true
+'''
+
+EXAMPLES = '''
+---
+# Create 100 snapshots without waiting, then wait for all of them
+- local_action:
+    module: cs_vmsnapshot
+    name: Snapshot before upgrade
+    vm: '{{ item }}'
+    poll_async: false
+  with_items: groups['web']
+  register: snapshots
+
+- local_action:
+    module: cs_job
+    job_ids: '{{ snapshots.results | map(attribute="job_id") | list }}'
+    timeout: 1800
+'''
+
+RETURN = '''
+---
+jobs:
+  description: Status and result of each job, in order of C(job_ids).
+  returned: success
+  type: list
+  sample: '[ { "job_id": "e1e5fd6b-ff4c-46f1-89a6-6b0a4ecf6e3b", "status": "succeeded", "result": { ... } } ]'
+succeeded_jobs:
+  description: Number of succeeded jobs.
+  returned: success
+  type: int
+  sample: 99
+failed_jobs:
+  description: Number of failed jobs.
+  returned: success
+  type: int
+  sample: 1
+pending_jobs:
+  description: Number of jobs still running after timeout.
+  returned: success
+  type: int
+  sample: 0
+'''
+
+import time
+import threading
+
+try:
+    from cs import CloudStack, CloudStackException, read_config
+    has_lib_cs = True
+except ImportError:
+    has_lib_cs = False
+
+
+class AnsibleCloudStack:
+
+    def __init__(self, module):
+        if not has_lib_cs:
+            module.fail_json(msg="python library cs required: pip install cs")
+
+        self.module = module
+        self._connect()
+
+        self.project_id = None
+        self.ip_address_id = None
+        self.zone_id = None
+        self.vm_id = None
+        self.os_type_id = None
+        self.hypervisor = None
+
+
+    def _connect(self):
+        api_key = self.module.params.get('api_key')
+        api_secret = self.module.params.get('secret_key')
+        api_url = self.module.params.get('api_url')
+        api_http_method = self.module.params.get('api_http_method')
+
+        if api_key and api_secret and api_url:
+            self.cs = CloudStack(
+                endpoint=api_url,
+                key=api_key,
+                secret=api_secret,
+                method=api_http_method
+                )
+        else:
+            self.cs = CloudStack(**read_config())
+
+
+    def get_project_id(self):
+        if self.project_id:
+            return self.project_id
+
+        project = self.module.params.get('project')
+        if not project:
+            return None
+
+        projects = self.cs.listProjects()
+        if projects:
+            for p in projects['project']:
+                if project in [ p['name'], p['displaytext'], p['id'] ]:
+                    self.project_id = p['id']
+                    return self.project_id
+        self.module.fail_json(msg="project '%s' not found" % project)
+
+
+    def get_ip_address_id(self):
+        if self.ip_address_id:
+            return self.ip_address_id
+
+        ip_address = self.module.params.get('ip_address')
+        if not ip_address:
+            self.module.fail_json(msg="IP address param 'ip_address' is required")
+
+        args = {}
+        args['ipaddress'] = ip_address
+        args['projectid'] = self.get_project_id()
+        ip_addresses = self.cs.listPublicIpAddresses(**args)
+
+        if not ip_addresses:
+            self.module.fail_json(msg="IP address '%s' not found" % args['ipaddress'])
+
+        self.ip_address_id = ip_addresses['publicipaddress'][0]['id']
+        return self.ip_address_id
+
+
+    def get_vm_id(self):
+        if self.vm_id:
+            return self.vm_id
+
+        vm = self.module.params.get('vm')
+        if not vm:
+            self.module.fail_json(msg="Virtual machine param 'vm' is required")
+
+        args = {}
+        args['projectid'] = self.get_project_id()
+        vms = self.cs.listVirtualMachines(**args)
+        if vms:
+            for v in vms['virtualmachine']:
+                if vm in [ v['name'], v['displayname'], v['id'] ]:
+                    self.vm_id = v['id']
+                    return self.vm_id
+        self.module.fail_json(msg="Virtual machine '%s' not found" % vm)
+
+
+    def get_zone_id(self):
+        if self.zone_id:
+            return self.zone_id
+
+        zone = self.module.params.get('zone')
+        zones = self.cs.listZones()
+
+        # use the first zone if no zone param given
+        if not zone:
+            self.zone_id = zones['zone'][0]['id']
+            return self.zone_id
+
+        if zones:
+            for z in zones['zone']:
+                if zone in [ z['name'], z['id'] ]:
+                    self.zone_id = z['id']
+                    return self.zone_id
+        self.module.fail_json(msg="zone '%s' not found" % zone)
+
+
+    def get_zones(self):
+        # Zones given by param zones, all zones if it contains 'all'. Without
+        # zones, the zone of param zone or the first zone found is used.
+        res = self.cs.listZones()
+        all_zones = []
+        if res and 'zone' in res:
+            all_zones = res['zone']
+
+        zones = self.module.params.get('zones')
+        if not zones:
+            if not self.module.params.get('zone'):
+                return all_zones[:1]
+            zones = [ self.module.params.get('zone') ]
+        elif 'all' in zones:
+            return all_zones
+
+        result = []
+        for zone in zones:
+            found = [ z for z in all_zones if zone in [ z['name'], z['id'] ] ]
+            if not found:
+                self.module.fail_json(msg="zone '%s' not found" % zone)
+            result.append(found[0])
+        return result
+
+
+    def get_os_type_id(self):
+        if self.os_type_id:
+            return self.os_type_id
+
+        os_type = self.module.params.get('os_type')
+        if not os_type:
+            return None
+
+        os_types = self.cs.listOsTypes()
+        if os_types:
+            for o in os_types['ostype']:
+                if os_type in [ o['description'], o['id'] ]:
+                    self.os_type_id = o['id']
+                    return self.os_type_id
+        self.module.fail_json(msg="OS type '%s' not found" % os_type)
+
+
+    def get_hypervisor(self):
+        if self.hypervisor:
+            return self.hypervisor
+
+        hypervisor = self.module.params.get('hypervisor')
+        hypervisors = self.cs.listHypervisors()
+
+        # use the first hypervisor if no hypervisor param given
+        if not hypervisor:
+            self.hypervisor = hypervisors['hypervisor'][0]['name']
+            return self.hypervisor
+
+        for h in hypervisors['hypervisor']:
+            if hypervisor.lower() == h['name'].lower():
+                self.hypervisor = h['name']
+                return self.hypervisor
+        self.module.fail_json(msg="Hypervisor '%s' not found" % hypervisor)
+
+
+    def _list_all(self, method, key, page_size=500, **args):
+        # All pages of a list API call, the API returns at most pagesize
+        # items a call. Returns the items of the response key.
+        args['pagesize'] = page_size
+        items = []
+        page = 1
+        while True:
+            args['page'] = page
+            res = getattr(self.cs, method)(**args)
+            if not res or key not in res:
+                break
+            items.extend(res[key])
+            if len(res[key]) < page_size:
+                break
+            page += 1
+        return items
+
+
+    def _poll_job(self, job=None, key=None):
+        if 'jobid' in job:
+            while True:
+                res = self.cs.queryAsyncJobResult(jobid=job['jobid'])
+                if res['jobstatus'] != 0:
+                    job_result = self._get_job_result(job['jobid'], res)
+                    if 'errortext' in job_result:
+                        self.module.fail_json(msg="Failed: '%s'" % job_result['errortext'])
+                    if key and key in job_result:
+                        job = job_result[key]
+                    break
+                time.sleep(2)
+        return job
+
+
+    def _get_job_result(self, jobid, res, key=None):
+        # The result of a finished job, a failed job (jobstatus 2) as dict
+        # having 'errortext', even if the API gives none.
+        job_result = res.get('jobresult', {})
+        if res['jobstatus'] == 2 or 'errortext' in job_result:
+            errortext = job_result.get('errortext') or "job failed with result code %s" % res.get('jobresultcode')
+            return { 'jobid': jobid, 'errortext': errortext }
+        if key and key in job_result:
+            return job_result[key]
+        return job_result
+
+
+    def _poll_jobs(self, jobs, key=None, timeout=None):
+        # Polls the async jobs together, one query per running job and round.
+        # Returns the results in order of the jobs, a failed job as dict
+        # having 'errortext' and a job still running after timeout as given.
+        # The timeout defaults to the module param, without one the jobs are
+        # waited for until done; a timeout of 0 queries them once.
+        if timeout is None:
+            timeout = self.module.params.get('timeout')
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        results = list(jobs)
+        running = {}
+        for i, job in enumerate(jobs):
+            if job and 'jobid' in job:
+                running[job['jobid']] = i
+
+        while running:
+            for jobid, i in running.items():
+                res = self.cs.queryAsyncJobResult(jobid=jobid)
+                if res['jobstatus'] != 0:
+                    del running[jobid]
+                    results[i] = self._get_job_result(jobid, res, key)
+
+            if not running:
+                break
+            delay = 2
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                delay = min(delay, remaining)
+            time.sleep(delay)
+        return results
+
+
+    def _run_jobs(self, calls, key=None, concurrency=10, poll_async=None):
+        # Submits the (api method, args) calls keeping at most concurrency
+        # jobs running, polled together. Returns the results in order of the
+        # calls, failures as dict having 'errortext'. Without poll_async all
+        # calls are submitted and the jobs are returned as given, poll_async
+        # defaults to the module param.
+        if poll_async is None:
+            poll_async = self.module.params.get('poll_async', True)
+        results = [ None ] * len(calls)
+        queued = list(enumerate(calls))
+        running = {}
+        while queued or running:
+            while queued and (len(running) < concurrency or not poll_async):
+                i, (method, args) = queued.pop(0)
+                try:
+                    res = method(**args)
+                except CloudStackException, e:
+                    res = { 'errortext': str(e) }
+                results[i] = res
+                if poll_async and 'jobid' in res and 'errortext' not in res:
+                    running[res['jobid']] = i
+
+            for jobid, i in running.items():
+                res = self.cs.queryAsyncJobResult(jobid=jobid)
+                if res['jobstatus'] != 0:
+                    del running[jobid]
+                    results[i] = self._get_job_result(jobid, res, key)
+            if running:
+                time.sleep(2)
+        return results
+
+
+    def _run_calls(self, calls, concurrency=10):
+        # Runs the synchronous (api method, args) calls in up to concurrency
+        # threads. Returns the results in order of the calls, failures as
+        # dict having 'errortext'.
+        results = [ None ] * len(calls)
+        queued = list(enumerate(calls))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                lock.acquire()
+                try:
+                    if not queued:
+                        return
+                    i, (method, args) = queued.pop(0)
+                finally:
+                    lock.release()
+                try:
+                    results[i] = method(**args)
+                except Exception, e:
+                    results[i] = { 'errortext': str(e) }
+
+        threads = [ threading.Thread(target=worker) for i in range(min(concurrency, len(calls))) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+
+    def _parse_cidr(self, cidr):
+        # Returns the IPv4 CIDR as (network, prefix length) or None if it is
+        # not an IPv4 network in full notation.
+        try:
+            address, prefix = cidr.strip().split('/')
+            octets = [ int(o) for o in address.split('.') ]
+            prefix = int(prefix)
+        except (AttributeError, ValueError):
+            return None
+        if len(octets) != 4 or [ o for o in octets if not 0 <= o <= 255 ] or not 0 <= prefix <= 32:
+            return None
+
+        network = (octets[0] << 24) + (octets[1] << 16) + (octets[2] << 8) + octets[3]
+        if network & ((1 << (32 - prefix)) - 1):
+            return None
+        return (network, prefix)
+
+
+    def _format_cidr(self, network, prefix):
+        octets = [ str((network >> shift) & 255) for shift in [24, 16, 8, 0] ]
+        return '%s/%d' % ('.'.join(octets), prefix)
+
+
+    def _collapse_cidrs(self, cidrs):
+        # Collapses the CIDRs into the minimal list of networks covering the
+        # same addresses, networks contained in others are dropped and
+        # adjacent siblings are merged into their supernet. CIDRs not being
+        # IPv4 networks are kept as given.
+        networks = []
+        others = []
+        for cidr in cidrs:
+            network = self._parse_cidr(cidr)
+            if network:
+                networks.append(network)
+            elif cidr not in others:
+                others.append(cidr)
+
+        collapsed = []
+        for network, prefix in sorted(networks):
+            if collapsed:
+                last_network, last_prefix = collapsed[-1]
+                if network >> (32 - last_prefix) == last_network >> (32 - last_prefix):
+                    continue
+            collapsed.append((network, prefix))
+
+            while len(collapsed) > 1:
+                (lower, lower_prefix), (upper, upper_prefix) = collapsed[-2:]
+                size = 1 << (32 - upper_prefix)
+                if lower_prefix != upper_prefix or lower & size or lower + size != upper:
+                    break
+                collapsed[-2:] = [ (lower, lower_prefix - 1) ]
+
+        return [ self._format_cidr(n, p) for n, p in collapsed ] + others
+
+
+    def _is_cidr_covered(self, cidr, cidrs):
+        # Whether the addresses of the CIDR are all in the CIDRs given, by one
+        # network containing it or by the networks within it collapsing into
+        # it. CIDRs not being IPv4 networks must be given as they are.
+        network = self._parse_cidr(cidr)
+        if not network:
+            return cidr in cidrs
+        address, prefix = network
+
+        inner = []
+        for other in cidrs:
+            other_network = self._parse_cidr(other)
+            if not other_network:
+                continue
+            other_address, other_prefix = other_network
+            if other_prefix <= prefix:
+                if address >> (32 - other_prefix) == other_address >> (32 - other_prefix):
+                    return True
+            elif other_address >> (32 - prefix) == address >> (32 - prefix):
+                inner.append(other)
+        return self._collapse_cidrs(inner) == [ self._format_cidr(address, prefix) ]
+
+
+    def _is_covered(self, cidrs, ports, covering):
+        # Whether the CIDRs on the (start port, end port) range are covered by
+        # the union of the (cidrs, ports) given, e.g. by the existing rules an
+        # aggregated rule would replace. Ports (None, None) stand for rules
+        # without ports. The range is split at the bounds of the covering
+        # ranges, each part must be covered by the CIDRs of the rules
+        # spanning it.
+        start_port, end_port = ports
+        if start_port is None:
+            parts = [ (None, None) ]
+        else:
+            bounds = set([ start_port, end_port + 1 ])
+            for covering_cidrs, (covering_start, covering_end) in covering:
+                if covering_start is None:
+                    continue
+                for bound in [ covering_start, covering_end + 1 ]:
+                    if start_port < bound <= end_port:
+                        bounds.add(bound)
+            bounds = sorted(bounds)
+            parts = [ (bounds[i], bounds[i + 1] - 1) for i in range(len(bounds) - 1) ]
+
+        for part_start, part_end in parts:
+            part_cidrs = []
+            for covering_cidrs, (covering_start, covering_end) in covering:
+                if part_start is None or (covering_start is not None and covering_start <= part_start and part_end <= covering_end):
+                    part_cidrs.extend(covering_cidrs)
+            for cidr in cidrs:
+                if not self._is_cidr_covered(cidr, part_cidrs):
+                    return False
+        return True
+
+
+    def _merge_port_ranges(self, port_ranges):
+        # Merges overlapping and contiguous (start port, end port) ranges.
+        merged = []
+        for start_port, end_port in sorted(port_ranges):
+            if merged and start_port <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end_port))
+            else:
+                merged.append((start_port, end_port))
+        return merged
+
+
+class AnsibleCloudStackJob(AnsibleCloudStack):
+
+    def __init__(self, module):
+        AnsibleCloudStack.__init__(self, module)
+        self.result = {
+            'changed': False,
+        }
+
+
+    def wait_for_jobs(self):
+        job_ids = self.module.params.get('job_ids')
+        timeout = self.module.params.get('timeout')
+
+        jobs = [ { 'jobid': job_id } for job_id in job_ids if job_id ]
+        if self.module.check_mode:
+            return self.get_jobs(jobs, self.query_jobs(jobs))
+        return self.get_jobs(jobs, self._poll_jobs(jobs, timeout=timeout))
+
+
+    def query_jobs(self, jobs):
+        # The current status of the jobs, queried once without waiting.
+        results = []
+        for job in jobs:
+            res = self.cs.queryAsyncJobResult(jobid=job['jobid'])
+            if res['jobstatus'] == 0:
+                results.append(job)
+            else:
+                results.append(self._get_job_result(job['jobid'], res))
+        return results
+
+
+    def get_jobs(self, jobs, results):
+        job_results = []
+        for job, res in zip(jobs, results):
+            job_result = {}
+            job_result['job_id'] = job['jobid']
+            if res is job:
+                job_result['status'] = 'pending'
+            elif 'errortext' in res:
+                job_result['status'] = 'failed'
+                job_result['errortext'] = res['errortext']
+            else:
+                job_result['status'] = 'succeeded'
+                job_result['result'] = res
+            job_results.append(job_result)
+        return job_results
+
+
+    def get_result(self, jobs):
+        self.result['jobs'] = jobs
+        for status in [ 'succeeded', 'failed', 'pending' ]:
+            self.result['%s_jobs' % status] = len([ j for j in jobs if j['status'] == status ])
+        return self.result
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec = dict(
+            job_ids = dict(type='list', required=True, aliases=['job_id']),
+            timeout = dict(type='int', default=600),
+            fail_on_error = dict(choices=BOOLEANS, default=True),
+            api_key = dict(default=None),
+            api_secret = dict(default=None),
+            api_url = dict(default=None),
+            api_http_method = dict(default='get'),
+        ),
+        supports_check_mode=True
+    )
+
+    if not has_lib_cs:
+        module.fail_json(msg="python library cs required: pip install cs")
+
+    try:
+        acs_job = AnsibleCloudStackJob(module)
+        jobs = acs_job.wait_for_jobs()
+        result = acs_job.get_result(jobs)
+
+        # in check mode the jobs are not waited for
+        if result['pending_jobs'] and not module.check_mode:
+            module.fail_json(msg="%d jobs still running after %s seconds" % (result['pending_jobs'], module.params.get('timeout')), **result)
+
+        if result['failed_jobs'] and module.params.get('fail_on_error'):
+            module.fail_json(msg="%d jobs failed" % result['failed_jobs'], **result)
+
+    except CloudStackException, e:
+        module.fail_json(msg='CloudStackException: %s' % str(e))
+
+    module.exit_json(**result)
+
+# import module snippets
+from ansible.module_utils.basic import *
+main()
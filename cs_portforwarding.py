@@ -30,8 +30,8 @@ version_added: '1.9'
 options:
   ip_address:
     description:
-      - Public IP address the rule is assigned to.
-    required: true
+      - Public IP address the rule is assigned to. Required unless all C(forwards) have an C(ip_address).
+    required: false
     default: null
     aliases: []
   vm:
@@ -56,8 +56,8 @@ options:
     aliases: []
   public_port
     description:
-      - Start public port for this rule.
-    required: true
+      - Start public port for this rule. Required unless C(forwards) is used.
+    required: false
     default: null
     aliases: []
   public_end_port
@@ -68,8 +68,8 @@ options:
     aliases: []
   private_port
     description:
-      - Start private port for this rule.
-    required: true
+      - Start private port for this rule. Required unless C(forwards) is used.
+    required: false
     default: null
     aliases: []
   private_end_port
@@ -90,6 +90,19 @@ options:
     required: false
     default: false
     aliases: []
+  forwards:
+    description:
+      - List of port forwarding rules of one or more public IP addresses to be applied in one task, each a dict having the keys C(ip_address), C(vm), C(protocol), C(public_port), C(public_end_port), C(private_port), C(private_end_port), C(vm_guest_ip) and C(open_firewall). Keys not set default to the options of the same name.
+      - The rules of each IP address are listed once. Forwards overlapping each other or an existing rule on another public port range are rejected before any change is made. Only the differences are applied, the changes are returned as C(forwards_added), C(forwards_updated) and C(forwards_removed).
+    required: false
+    default: null
+    aliases: []
+  concurrency:
+    description:
+      - Max number of jobs running at the same time if C(forwards) is used.
+    required: false
+    default: 10
+    aliases: []
   project:
     description:
       - Name of the project the VM is located in.
@@ -98,7 +111,7 @@ options:
     aliases: []
   poll_async:
     description:
-      - Poll async jobs until job has finised.
+      - Poll async jobs until job has finised. If C(false), the id of the job is returned as C(job_id), see M(cs_job). If the rule is recreated for another VM, the delete is waited on and the id of the create job is returned as C(job_id). With C(forwards), the updates and deletes are waited on and the ids of the create jobs are returned as C(job_ids).
     required: false
     default: true
     aliases: []
@@ -158,8 +171,22 @@ EXAMPLES = '''
     private_port: 22
     state: absent
 
+- name: forward a set of ports in one task
+  local_action:
+    module: cloudstack_pf
+    ip_address: 1.2.3.4
+    forwards:
+    - { vm: web01, public_port: 80, private_port: 8080 }
+    - { vm: web01, public_port: 443, private_port: 8443 }
+    - { vm: db01, public_port: 10000, public_end_port: 10100, private_port: 10000, private_end_port: 10100 }
+    - { vm: dns01, ip_address: 1.2.3.5, protocol: udp, public_port: 53, private_port: 53 }
+
 '''
 
+import time
+import threading
+import bisect
+
 try:
     from cs import CloudStack, CloudStackException, read_config
     has_lib_cs = True
@@ -250,7 +277,7 @@ class AnsibleCloudStack:
         vms = self.cs.listVirtualMachines(**args)
         if vms:
             for v in vms['virtualmachine']:
-                if vm in [ v['name'], v['displaytext'] v['id'] ]:
+                if vm in [ v['name'], v['displayname'], v['id'] ]:
                     self.vm_id = v['id']
                     return self.vm_id
         self.module.fail_json(msg="Virtual machine '%s' not found" % vm)
@@ -276,6 +303,31 @@ class AnsibleCloudStack:
         self.module.fail_json(msg="zone '%s' not found" % zone)
 
 
+    def get_zones(self):
+        # Zones given by param zones, all zones if it contains 'all'. Without
+        # zones, the zone of param zone or the first zone found is used.
+        res = self.cs.listZones()
+        all_zones = []
+        if res and 'zone' in res:
+            all_zones = res['zone']
+
+        zones = self.module.params.get('zones')
+        if not zones:
+            if not self.module.params.get('zone'):
+                return all_zones[:1]
+            zones = [ self.module.params.get('zone') ]
+        elif 'all' in zones:
+            return all_zones
+
+        result = []
+        for zone in zones:
+            found = [ z for z in all_zones if zone in [ z['name'], z['id'] ] ]
+            if not found:
+                self.module.fail_json(msg="zone '%s' not found" % zone)
+            result.append(found[0])
+        return result
+
+
     def get_os_type_id(self):
         if self.os_type_id:
             return self.os_type_id
@@ -312,20 +364,271 @@ class AnsibleCloudStack:
         self.module.fail_json(msg="Hypervisor '%s' not found" % hypervisor)
 
 
+    def _list_all(self, method, key, page_size=500, **args):
+        # All pages of a list API call, the API returns at most pagesize
+        # items a call. Returns the items of the response key.
+        args['pagesize'] = page_size
+        items = []
+        page = 1
+        while True:
+            args['page'] = page
+            res = getattr(self.cs, method)(**args)
+            if not res or key not in res:
+                break
+            items.extend(res[key])
+            if len(res[key]) < page_size:
+                break
+            page += 1
+        return items
+
+
     def _poll_job(self, job=None, key=None):
         if 'jobid' in job:
             while True:
                 res = self.cs.queryAsyncJobResult(jobid=job['jobid'])
-                if res['jobstatus'] != 0 and 'jobresult' in res:
-                    if 'errortext' in res['jobresult']:
-                        self.module.fail_json(msg="Failed: '%s'" % res['jobresult']['errortext'])
-                    if key and key in res['jobresult']:
-                        job = res['jobresult'][key]
+                if res['jobstatus'] != 0:
+                    job_result = self._get_job_result(job['jobid'], res)
+                    if 'errortext' in job_result:
+                        self.module.fail_json(msg="Failed: '%s'" % job_result['errortext'])
+                    if key and key in job_result:
+                        job = job_result[key]
                     break
                 time.sleep(2)
         return job
 
 
+    def _get_job_result(self, jobid, res, key=None):
+        # The result of a finished job, a failed job (jobstatus 2) as dict
+        # having 'errortext', even if the API gives none.
+        job_result = res.get('jobresult', {})
+        if res['jobstatus'] == 2 or 'errortext' in job_result:
+            errortext = job_result.get('errortext') or "job failed with result code %s" % res.get('jobresultcode')
+            return { 'jobid': jobid, 'errortext': errortext }
+        if key and key in job_result:
+            return job_result[key]
+        return job_result
+
+
+    def _poll_jobs(self, jobs, key=None, timeout=None):
+        # Polls the async jobs together, one query per running job and round.
+        # Returns the results in order of the jobs, a failed job as dict
+        # having 'errortext' and a job still running after timeout as given.
+        # The timeout defaults to the module param, without one the jobs are
+        # waited for until done; a timeout of 0 queries them once.
+        if timeout is None:
+            timeout = self.module.params.get('timeout')
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        results = list(jobs)
+        running = {}
+        for i, job in enumerate(jobs):
+            if job and 'jobid' in job:
+                running[job['jobid']] = i
+
+        while running:
+            for jobid, i in running.items():
+                res = self.cs.queryAsyncJobResult(jobid=jobid)
+                if res['jobstatus'] != 0:
+                    del running[jobid]
+                    results[i] = self._get_job_result(jobid, res, key)
+
+            if not running:
+                break
+            delay = 2
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                delay = min(delay, remaining)
+            time.sleep(delay)
+        return results
+
+
+    def _run_jobs(self, calls, key=None, concurrency=10, poll_async=None):
+        # Submits the (api method, args) calls keeping at most concurrency
+        # jobs running, polled together. Returns the results in order of the
+        # calls, failures as dict having 'errortext'. Without poll_async all
+        # calls are submitted and the jobs are returned as given, poll_async
+        # defaults to the module param.
+        if poll_async is None:
+            poll_async = self.module.params.get('poll_async', True)
+        results = [ None ] * len(calls)
+        queued = list(enumerate(calls))
+        running = {}
+        while queued or running:
+            while queued and (len(running) < concurrency or not poll_async):
+                i, (method, args) = queued.pop(0)
+                try:
+                    res = method(**args)
+                except CloudStackException, e:
+                    res = { 'errortext': str(e) }
+                results[i] = res
+                if poll_async and 'jobid' in res and 'errortext' not in res:
+                    running[res['jobid']] = i
+
+            for jobid, i in running.items():
+                res = self.cs.queryAsyncJobResult(jobid=jobid)
+                if res['jobstatus'] != 0:
+                    del running[jobid]
+                    results[i] = self._get_job_result(jobid, res, key)
+            if running:
+                time.sleep(2)
+        return results
+
+
+    def _run_calls(self, calls, concurrency=10):
+        # Runs the synchronous (api method, args) calls in up to concurrency
+        # threads. Returns the results in order of the calls, failures as
+        # dict having 'errortext'.
+        results = [ None ] * len(calls)
+        queued = list(enumerate(calls))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                lock.acquire()
+                try:
+                    if not queued:
+                        return
+                    i, (method, args) = queued.pop(0)
+                finally:
+                    lock.release()
+                try:
+                    results[i] = method(**args)
+                except Exception, e:
+                    results[i] = { 'errortext': str(e) }
+
+        threads = [ threading.Thread(target=worker) for i in range(min(concurrency, len(calls))) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+
+    def _parse_cidr(self, cidr):
+        # Returns the IPv4 CIDR as (network, prefix length) or None if it is
+        # not an IPv4 network in full notation.
+        try:
+            address, prefix = cidr.strip().split('/')
+            octets = [ int(o) for o in address.split('.') ]
+            prefix = int(prefix)
+        except (AttributeError, ValueError):
+            return None
+        if len(octets) != 4 or [ o for o in octets if not 0 <= o <= 255 ] or not 0 <= prefix <= 32:
+            return None
+
+        network = (octets[0] << 24) + (octets[1] << 16) + (octets[2] << 8) + octets[3]
+        if network & ((1 << (32 - prefix)) - 1):
+            return None
+        return (network, prefix)
+
+
+    def _format_cidr(self, network, prefix):
+        octets = [ str((network >> shift) & 255) for shift in [24, 16, 8, 0] ]
+        return '%s/%d' % ('.'.join(octets), prefix)
+
+
+    def _collapse_cidrs(self, cidrs):
+        # Collapses the CIDRs into the minimal list of networks covering the
+        # same addresses, networks contained in others are dropped and
+        # adjacent siblings are merged into their supernet. CIDRs not being
+        # IPv4 networks are kept as given.
+        networks = []
+        others = []
+        for cidr in cidrs:
+            network = self._parse_cidr(cidr)
+            if network:
+                networks.append(network)
+            elif cidr not in others:
+                others.append(cidr)
+
+        collapsed = []
+        for network, prefix in sorted(networks):
+            if collapsed:
+                last_network, last_prefix = collapsed[-1]
+                if network >> (32 - last_prefix) == last_network >> (32 - last_prefix):
+                    continue
+            collapsed.append((network, prefix))
+
+            while len(collapsed) > 1:
+                (lower, lower_prefix), (upper, upper_prefix) = collapsed[-2:]
+                size = 1 << (32 - upper_prefix)
+                if lower_prefix != upper_prefix or lower & size or lower + size != upper:
+                    break
+                collapsed[-2:] = [ (lower, lower_prefix - 1) ]
+
+        return [ self._format_cidr(n, p) for n, p in collapsed ] + others
+
+
+    def _is_cidr_covered(self, cidr, cidrs):
+        # Whether the addresses of the CIDR are all in the CIDRs given, by one
+        # network containing it or by the networks within it collapsing into
+        # it. CIDRs not being IPv4 networks must be given as they are.
+        network = self._parse_cidr(cidr)
+        if not network:
+            return cidr in cidrs
+        address, prefix = network
+
+        inner = []
+        for other in cidrs:
+            other_network = self._parse_cidr(other)
+            if not other_network:
+                continue
+            other_address, other_prefix = other_network
+            if other_prefix <= prefix:
+                if address >> (32 - other_prefix) == other_address >> (32 - other_prefix):
+                    return True
+            elif other_address >> (32 - prefix) == address >> (32 - prefix):
+                inner.append(other)
+        return self._collapse_cidrs(inner) == [ self._format_cidr(address, prefix) ]
+
+
+    def _is_covered(self, cidrs, ports, covering):
+        # Whether the CIDRs on the (start port, end port) range are covered by
+        # the union of the (cidrs, ports) given, e.g. by the existing rules an
+        # aggregated rule would replace. Ports (None, None) stand for rules
+        # without ports. The range is split at the bounds of the covering
+        # ranges, each part must be covered by the CIDRs of the rules
+        # spanning it.
+        start_port, end_port = ports
+        if start_port is None:
+            parts = [ (None, None) ]
+        else:
+            bounds = set([ start_port, end_port + 1 ])
+            for covering_cidrs, (covering_start, covering_end) in covering:
+                if covering_start is None:
+                    continue
+                for bound in [ covering_start, covering_end + 1 ]:
+                    if start_port < bound <= end_port:
+                        bounds.add(bound)
+            bounds = sorted(bounds)
+            parts = [ (bounds[i], bounds[i + 1] - 1) for i in range(len(bounds) - 1) ]
+
+        for part_start, part_end in parts:
+            part_cidrs = []
+            for covering_cidrs, (covering_start, covering_end) in covering:
+                if part_start is None or (covering_start is not None and covering_start <= part_start and part_end <= covering_end):
+                    part_cidrs.extend(covering_cidrs)
+            for cidr in cidrs:
+                if not self._is_cidr_covered(cidr, part_cidrs):
+                    return False
+        return True
+
+
+    def _merge_port_ranges(self, port_ranges):
+        # Merges overlapping and contiguous (start port, end port) ranges.
+        merged = []
+        for start_port, end_port in sorted(port_ranges):
+            if merged and start_port <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end_port))
+            else:
+                merged.append((start_port, end_port))
+        return merged
+
+
 class AnsibleCloudStackPortforwarding(AnsibleCloudStack):
 
     def __init__(self, module):
@@ -388,20 +691,65 @@ class AnsibleCloudStackPortforwarding(AnsibleCloudStack):
                 portforwarding_rule = self.cs.createPortForwardingRule(**args)
                 if poll_async:
                     portforwarding_rule = self._poll_job(portforwarding_rule, 'portforwardingrule')
+                elif 'jobid' in portforwarding_rule:
+                    self.result['job_id'] = portforwarding_rule['jobid']
         else:
             vm_id = self.get_vm_id()
             if vm_id != portforwarding_rule['virtualmachineid']:
                 self.result['changed'] = True
                 if not self.module.check_mode:
-                    # Seems broken in 4.2.1?, implementing workaround
-                    # portforwarding_rule = self.cs.updatePortForwardingRule(**args)
-                    self.remove_portforwarding_rule()
-                    portforwarding_rule = self.cs.createPortForwardingRule(**args)
-                    if poll_async:
-                        portforwarding_rule = self._poll_job(portforwarding_rule, 'portforwardingrule')
+                    updated = self.update_portforwarding_rule(portforwarding_rule, args)
+                    if updated:
+                        portforwarding_rule = updated
+                    else:
+                        portforwarding_rule = self.recreate_portforwarding_rule(portforwarding_rule, args)
         return portforwarding_rule
 
 
+    def update_portforwarding_rule(self, portforwarding_rule, args):
+        # Changes the VM of the rule in place. Returns None if the update is
+        # not supported, it seems broken in 4.2.1.
+        update_args = {}
+        update_args['id'] = portforwarding_rule['id']
+        update_args['virtualmachineid'] = args['virtualmachineid']
+        update_args['vmguestip'] = args['vmguestip']
+        try:
+            res = self.cs.updatePortForwardingRule(**update_args)
+        except CloudStackException:
+            return None
+        if 'errortext' in res:
+            return None
+
+        poll_async = self.module.params.get('poll_async')
+        if not poll_async:
+            if 'jobid' in res:
+                self.result['job_id'] = res['jobid']
+            return res
+
+        res = self._poll_jobs([ res ], 'portforwardingrule')[0]
+        if 'errortext' in res or res.get('virtualmachineid') != args['virtualmachineid']:
+            return None
+        return res
+
+
+    def recreate_portforwarding_rule(self, portforwarding_rule, args):
+        # The create is submitted once the delete is done, the port range of
+        # the rule is not free before. The delete is waited on even without
+        # poll_async.
+        res = self._run_jobs([ (self.cs.deletePortForwardingRule, { 'id': portforwarding_rule['id'] }) ], 'portforwardingrule', poll_async=True)[0]
+        if 'errortext' in res:
+            self.module.fail_json(msg="Failed: %s" % res['errortext'])
+
+        res = self._run_jobs([ (self.cs.createPortForwardingRule, args) ], 'portforwardingrule')[0]
+        if 'errortext' in res:
+            self.module.fail_json(msg="Failed: %s" % res['errortext'])
+
+        poll_async = self.module.params.get('poll_async')
+        if not poll_async and 'jobid' in res:
+            self.result['job_id'] = res['jobid']
+        return res
+
+
     def remove_portforwarding_rule(self):
         portforwarding_rule = self.get_portforwarding_rule()
 
@@ -415,27 +763,256 @@ class AnsibleCloudStackPortforwarding(AnsibleCloudStack):
                 poll_async = self.module.params.get('poll_async')
                 if poll_async:
                     self._poll_job(res, 'portforwardingrule')
+                elif 'jobid' in res:
+                    self.result['job_id'] = res['jobid']
 
         return portforwarding_rule
 
 
+    def get_forwards(self):
+        # Normalizes the forwards, keys not set are defaulted to the module params.
+        forwards = []
+        for forward in self.module.params.get('forwards'):
+            f = {}
+            for key in ['ip_address', 'vm', 'protocol', 'public_port', 'public_end_port',
+                        'private_port', 'private_end_port', 'vm_guest_ip', 'open_firewall']:
+                f[key] = forward.get(key, self.module.params.get(key))
+
+            if not f['ip_address']:
+                self.module.fail_json(msg="no ip_address set in forward %s" % forward)
+            if f['protocol'] not in ['tcp', 'udp']:
+                self.module.fail_json(msg="invalid protocol '%s' in forward %s" % (f['protocol'], forward))
+            if f['public_port'] is None or f['private_port'] is None:
+                self.module.fail_json(msg="no public_port or private_port set in forward %s" % forward)
+
+            for port in ['public', 'private']:
+                f[port + '_port'] = int(f[port + '_port'])
+                if f[port + '_end_port'] is None:
+                    f[port + '_end_port'] = f[port + '_port']
+                f[port + '_end_port'] = int(f[port + '_end_port'])
+            forwards.append(f)
+        return forwards
+
+
+    def get_ip_address_ids(self, ip_addresses):
+        args = {}
+        args['projectid'] = self.get_project_id()
+        if len(ip_addresses) == 1:
+            args['ipaddress'] = ip_addresses[0]
+
+        ip_address_ids = {}
+        for ip_address in self._list_all('listPublicIpAddresses', 'publicipaddress', **args):
+            ip_address_ids[ip_address['ipaddress']] = ip_address['id']
+        for ip_address in ip_addresses:
+            if ip_address not in ip_address_ids:
+                self.module.fail_json(msg="IP address '%s' not found" % ip_address)
+        return ip_address_ids
+
+
+    def get_vm_ids(self):
+        # VM ids by name, display name and id, listed once, all pages.
+        args = {}
+        args['projectid'] = self.get_project_id()
+
+        vm_ids = {}
+        for v in self._list_all('listVirtualMachines', 'virtualmachine', **args):
+            for key in [ v['name'], v['displayname'], v['id'] ]:
+                vm_ids[key] = v['id']
+        return vm_ids
+
+
+    def _get_forward_result(self, forward):
+        result = {}
+        for key in ['ip_address', 'vm', 'protocol', 'public_port', 'public_end_port', 'private_port', 'private_end_port']:
+            result[key] = forward[key]
+        return result
+
+
+    def _get_rule_forward(self, ip_address, rule):
+        return {
+            'ip_address': ip_address,
+            'vm': rule.get('virtualmachinename'),
+            'protocol': rule['protocol'],
+            'public_port': int(rule['publicport']),
+            'public_end_port': int(rule['publicendport']),
+            'private_port': int(rule['privateport']),
+            'private_end_port': int(rule['privateendport']),
+        }
+
+
+    def apply_forwards(self):
+        forwards = self.get_forwards()
+        state = self.module.params.get('state')
+
+        # reject forwards overlapping each other
+        requested = {}
+        for f in forwards:
+            index = requested.setdefault((f['ip_address'], f['protocol']), PortRangeIndex())
+            if not index.add(f['public_port'], f['public_end_port'], f):
+                other = index.get_overlapping(f['public_port'], f['public_end_port'])[0]
+                self.module.fail_json(msg="forward %s:%s-%s/%s overlaps %s-%s" % (f['ip_address'], f['public_port'], f['public_end_port'], f['protocol'], other['public_port'], other['public_end_port']))
+
+        ip_addresses = sorted(set([ f['ip_address'] for f in forwards ]))
+        ip_address_ids = self.get_ip_address_ids(ip_addresses)
+        vm_ids = {}
+        if state != 'absent':
+            vm_ids = self.get_vm_ids()
+
+        # existing rules per IP address and protocol, listed once per IP address
+        existing = {}
+        for ip_address in ip_addresses:
+            args = {}
+            args['ipaddressid'] = ip_address_ids[ip_address]
+            args['projectid'] = self.get_project_id()
+            for rule in self._list_all('listPortForwardingRules', 'portforwardingrule', **args):
+                index = existing.setdefault((ip_address, rule['protocol']), PortRangeIndex())
+                index.add(int(rule['publicport']), int(rule['publicendport']), rule)
+
+        added = []
+        updated = []
+        removed = []
+        for f in forwards:
+            index = existing.get((f['ip_address'], f['protocol']), PortRangeIndex())
+            overlapping = index.get_overlapping(f['public_port'], f['public_end_port'])
+            rule = None
+            if len(overlapping) == 1 \
+                and int(overlapping[0]['publicport']) == f['public_port'] \
+                and int(overlapping[0]['publicendport']) == f['public_end_port']:
+                rule = overlapping[0]
+            elif overlapping and state != 'absent':
+                other = self._get_rule_forward(f['ip_address'], overlapping[0])
+                self.module.fail_json(msg="forward %s:%s-%s/%s conflicts with existing rule %s-%s" % (f['ip_address'], f['public_port'], f['public_end_port'], f['protocol'], other['public_port'], other['public_end_port']))
+
+            if state == 'absent':
+                if rule:
+                    removed.append(rule)
+                continue
+
+            if f['vm'] not in vm_ids:
+                self.module.fail_json(msg="Virtual machine '%s' not found" % f['vm'])
+            f['vm_id'] = vm_ids[f['vm']]
+
+            if not rule:
+                added.append(f)
+            elif int(rule['privateport']) != f['private_port'] or int(rule['privateendport']) != f['private_end_port']:
+                removed.append(rule)
+                added.append(f)
+            elif rule['virtualmachineid'] != f['vm_id']:
+                f['rule'] = rule
+                updated.append(f)
+
+        self.result['forwards_added'] = [ self._get_forward_result(f) for f in added ]
+        self.result['forwards_updated'] = [ self._get_forward_result(f) for f in updated ]
+        self.result['forwards_removed'] = [ self._get_rule_forward(r['ipaddress'], r) for r in removed ]
+
+        if added or updated or removed:
+            self.result['changed'] = True
+            if not self.module.check_mode:
+                self._apply_forward_changes(added, updated, removed, ip_address_ids)
+        return self.result
+
+
+    def _apply_forward_changes(self, added, updated, removed, ip_address_ids):
+        # The updates and the deletes are independent and run together, the
+        # creates follow once the deleted port ranges are free, so the updates
+        # and deletes are waited on even without poll_async. Updates failed,
+        # not supported by the API version or not changing the VM, as checked
+        # by update_portforwarding_rule(), are recreated.
+        concurrency = self.module.params.get('concurrency')
+        poll_async = self.module.params.get('poll_async')
+        jobs = []
+
+        calls = []
+        for f in updated:
+            update_args = {}
+            update_args['id'] = f['rule']['id']
+            update_args['virtualmachineid'] = f['vm_id']
+            update_args['vmguestip'] = f['vm_guest_ip']
+            calls.append((self.cs.updatePortForwardingRule, update_args))
+        for rule in removed:
+            calls.append((self.cs.deletePortForwardingRule, { 'id': rule['id'] }))
+        res = self._run_jobs(calls, 'portforwardingrule', concurrency, poll_async=True)
+
+        recreated = []
+        for f, r in zip(updated, res):
+            if 'errortext' in r or r.get('virtualmachineid') != f['vm_id']:
+                recreated.append(f)
+        jobs.extend(res[len(updated):])
+        if recreated:
+            calls = [ (self.cs.deletePortForwardingRule, { 'id': f['rule']['id'] }) for f in recreated ]
+            jobs.extend(self._run_jobs(calls, 'portforwardingrule', concurrency, poll_async=True))
+        errors = [ j['errortext'] for j in jobs if 'errortext' in j ]
+        if errors:
+            self.module.fail_json(msg="Failed: %s" % '; '.join(errors), **self.result)
+
+        calls = []
+        for f in added + recreated:
+            args = {}
+            args['protocol'] = f['protocol']
+            args['publicport'] = f['public_port']
+            args['publicendport'] = f['public_end_port']
+            args['privateport'] = f['private_port']
+            args['privateendport'] = f['private_end_port']
+            args['ipaddressid'] = ip_address_ids[f['ip_address']]
+            args['openfirewall'] = f['open_firewall']
+            args['vmguestip'] = f['vm_guest_ip']
+            args['virtualmachineid'] = f['vm_id']
+            calls.append((self.cs.createPortForwardingRule, args))
+        jobs = self._run_jobs(calls, 'portforwardingrule', concurrency)
+
+        errors = [ j['errortext'] for j in jobs if 'errortext' in j ]
+        if errors:
+            self.module.fail_json(msg="Failed: %s" % '; '.join(errors), **self.result)
+        if not poll_async:
+            self.result['job_ids'] = [ j['jobid'] for j in jobs if 'jobid' in j ]
+
+
     def get_result(self, portforwarding_rule):
         return self.result
 
 
+class PortRangeIndex:
+    # Non overlapping port ranges ordered by start port. As the ranges do not
+    # overlap, the end ports are ordered too and the ranges overlapping a
+    # given one are found by two bisections.
+
+    def __init__(self):
+        self.start_ports = []
+        self.end_ports = []
+        self.items = []
+
+
+    def get_overlapping(self, start_port, end_port):
+        first = bisect.bisect_left(self.end_ports, start_port)
+        last = bisect.bisect_right(self.start_ports, end_port)
+        return self.items[first:last]
+
+
+    def add(self, start_port, end_port, item):
+        if self.get_overlapping(start_port, end_port):
+            return False
+        i = bisect.bisect_left(self.start_ports, start_port)
+        self.start_ports.insert(i, start_port)
+        self.end_ports.insert(i, end_port)
+        self.items.insert(i, item)
+        return True
+
+
 def main():
     module = AnsibleModule(
         argument_spec = dict(
-            ip_address = dict(required=True),
+            ip_address = dict(default=None),
             protocol = dict(choices=['tcp', 'udp'], default='tcp'),
-            public_port = dict(type='int', required=True, default=None),
+            public_port = dict(type='int', default=None),
             public_end_port = dict(type='int', default=None),
-            private_port = dict(type='int', required=True, default=None),
+            private_port = dict(type='int', default=None),
             private_end_port = dict(type='int', default=None),
             state = dict(choices=['present', 'absent'], default='present'),
             open_firewall = dict(choices=BOOLEANS, default=False),
             vm_guest_ip = dict(default=None),
             vm = dict(default=None),
+            forwards = dict(type='list', default=None),
+            concurrency = dict(type='int', default=10),
             project = dict(default=None),
             poll_async = dict(choices=BOOLEANS, default=True),
             api_key = dict(default=None),
@@ -452,12 +1029,18 @@ def main():
     try:
         acs_pf = AnsibleCloudStackPortforwarding(module)
         state = module.params.get('state')
-        if state in ['absent']:
-            pf_rule = acs_pf.remove_portforwarding_rule()
+        if module.params.get('forwards') is not None:
+            result = acs_pf.apply_forwards()
         else:
-            pf_rule = acs_pf.create_portforwarding_rule()
-
-        result = acs_pf.get_result(pf_rule)
+            missing = [ p for p in ['ip_address', 'public_port', 'private_port'] if module.params.get(p) is None ]
+            if missing:
+                module.fail_json(msg="missing required arguments: %s" % ','.join(missing))
+
+            if state in ['absent']:
+                pf_rule = acs_pf.remove_portforwarding_rule()
+            else:
+                pf_rule = acs_pf.create_portforwarding_rule()
+            result = acs_pf.get_result(pf_rule)
 
     except CloudStackException, e:
         module.fail_json(msg='CloudStackException: %s' % str(e))
@@ -79,6 +79,27 @@ options:
       - Error code for this icmp message. Required if C(protocol=icmp).
     required: false
     default: null
+  rules:
+    description:
+      - List of rules to be applied in one task, each a dict having the keys C(type), C(protocol), C(cidr), C(user_security_group), C(start_port) or C(port), C(end_port), C(icmp_type) and C(icmp_code). Keys not set default to the options of the same name. The security group is fetched once and only the missing rules are added, or with C(state=absent) the existing rules are removed.
+    required: false
+    default: null
+  exclusive:
+    description:
+      - Whether C(rules) is the full set of rules of the security group. If C(true), all ingress and egress rules not in C(rules) are removed. Only used with C(state=present).
+    required: false
+    default: false
+  optimize:
+    description:
+      - Whether to aggregate C(rules) before applying them. Contiguous or overlapping port ranges of the same source are merged and CIDRs of the same ports are collapsed into their minimal supernets, the access granted stays the same. Only used with C(state=present).
+      - Without C(exclusive), an aggregated rule is not added if existing rules already grant its access, e.g. the rules it would replace. Use C(exclusive=true) to replace them by the aggregated rules.
+    required: false
+    default: false
+  concurrency:
+    description:
+      - Max number of jobs running at the same time if C(rules) is used.
+    required: false
+    default: 10
   project:
     description:
       - Name of the project the security group to be created in.
@@ -86,7 +107,7 @@ options:
     default: null
   poll_async:
     description:
-      - Poll async jobs until job has finished.
+      - Poll async jobs until job has finished. If C(false), the id of the job is returned as C(job_id), see M(cs_job).
     required: false
     default: true
 '''
@@ -137,6 +158,39 @@ EXAMPLES = '''
     security_group: default
     port: 80
     user_security_group: web
+
+
+# Allow a set of rules in one task added to security group 'default'
+- local_action:
+    module: cs_securitygroup_rule
+    security_group: default
+    rules:
+    - { port: 22, cidr: 10.0.0.0/8 }
+    - { port: 80 }
+    - { port: 443 }
+    - { protocol: udp, start_port: 60000, end_port: 61000 }
+    - { protocol: icmp, icmp_type: -1, icmp_code: -1 }
+    - { type: egress, start_port: 1, end_port: 65535 }
+
+
+# Allow generated rules aggregated, e.g. 10.0.0.0/24 and 10.0.1.0/24 on ports 8000 and 8001
+# are added as one rule 10.0.0.0/23 on ports 8000-8001
+- local_action:
+    module: cs_securitygroup_rule
+    security_group: default
+    optimize: true
+    rules: '{{ generated_rules }}'
+
+
+# Ensure security group 'web' has exactly these rules, all others are removed
+- local_action:
+    module: cs_securitygroup_rule
+    security_group: web
+    exclusive: true
+    rules:
+    - { port: 80 }
+    - { port: 443 }
+    - { type: egress, start_port: 1, end_port: 65535 }
 '''
 
 RETURN = '''
@@ -176,8 +230,36 @@ end_port:
   returned: success
   type: int
   sample: 80
+job_id:
+  description: Id of the async job, use M(cs_job) to wait for it.
+  returned: success and poll_async is false
+  type: string
+  sample: e1e5fd6b-ff4c-46f1-89a6-6b0a4ecf6e3b
+rules_added:
+  description: Rules added, if C(rules) is used.
+  returned: success and rules is defined
+  type: list
+  sample: [ { type: ingress, protocol: tcp, cidr: 0.0.0.0/0, start_port: 80, end_port: 80 } ]
+rules_removed:
+  description: Rules removed, if C(rules) is used.
+  returned: success and rules is defined
+  type: list
+  sample: [ { type: ingress, protocol: tcp, cidr: 0.0.0.0/0, start_port: 80, end_port: 80 } ]
+rules_saved:
+  description: Number of rules saved by aggregating C(rules).
+  returned: success, rules is defined and optimize is true
+  type: int
+  sample: 12
+job_ids:
+  description: Ids of the async jobs, use M(cs_job) to wait for them.
+  returned: success, rules is defined and poll_async is false
+  type: list
+  sample: [ e1e5fd6b-ff4c-46f1-89a6-6b0a4ecf6e3b ]
 '''
 
+import time
+import threading
+
 try:
     from cs import CloudStack, CloudStackException, read_config
     has_lib_cs = True
@@ -268,7 +350,7 @@ class AnsibleCloudStack:
         vms = self.cs.listVirtualMachines(**args)
         if vms:
             for v in vms['virtualmachine']:
-                if vm in [ v['name'], v['displaytext'] v['id'] ]:
+                if vm in [ v['name'], v['displayname'], v['id'] ]:
                     self.vm_id = v['id']
                     return self.vm_id
         self.module.fail_json(msg="Virtual machine '%s' not found" % vm)
@@ -294,6 +376,31 @@ class AnsibleCloudStack:
         self.module.fail_json(msg="zone '%s' not found" % zone)
 
 
+    def get_zones(self):
+        # Zones given by param zones, all zones if it contains 'all'. Without
+        # zones, the zone of param zone or the first zone found is used.
+        res = self.cs.listZones()
+        all_zones = []
+        if res and 'zone' in res:
+            all_zones = res['zone']
+
+        zones = self.module.params.get('zones')
+        if not zones:
+            if not self.module.params.get('zone'):
+                return all_zones[:1]
+            zones = [ self.module.params.get('zone') ]
+        elif 'all' in zones:
+            return all_zones
+
+        result = []
+        for zone in zones:
+            found = [ z for z in all_zones if zone in [ z['name'], z['id'] ] ]
+            if not found:
+                self.module.fail_json(msg="zone '%s' not found" % zone)
+            result.append(found[0])
+        return result
+
+
     def get_os_type_id(self):
         if self.os_type_id:
             return self.os_type_id
@@ -330,103 +437,321 @@ class AnsibleCloudStack:
         self.module.fail_json(msg="Hypervisor '%s' not found" % hypervisor)
 
 
+    def _list_all(self, method, key, page_size=500, **args):
+        # All pages of a list API call, the API returns at most pagesize
+        # items a call. Returns the items of the response key.
+        args['pagesize'] = page_size
+        items = []
+        page = 1
+        while True:
+            args['page'] = page
+            res = getattr(self.cs, method)(**args)
+            if not res or key not in res:
+                break
+            items.extend(res[key])
+            if len(res[key]) < page_size:
+                break
+            page += 1
+        return items
+
+
     def _poll_job(self, job=None, key=None):
         if 'jobid' in job:
             while True:
                 res = self.cs.queryAsyncJobResult(jobid=job['jobid'])
-                if res['jobstatus'] != 0 and 'jobresult' in res:
-                    if 'errortext' in res['jobresult']:
-                        self.module.fail_json(msg="Failed: '%s'" % res['jobresult']['errortext'])
-                    if key and key in res['jobresult']:
-                        job = res['jobresult'][key]
+                if res['jobstatus'] != 0:
+                    job_result = self._get_job_result(job['jobid'], res)
+                    if 'errortext' in job_result:
+                        self.module.fail_json(msg="Failed: '%s'" % job_result['errortext'])
+                    if key and key in job_result:
+                        job = job_result[key]
                     break
                 time.sleep(2)
         return job
 
 
-class AnsibleCloudStackSecurityGroupRule(AnsibleCloudStack):
-
-    def __init__(self, module):
-        AnsibleCloudStack.__init__(self, module)
-        self.result = {
-            'changed': False,
-        }
-
-
-    def _tcp_udp_match(self, rule, protocol, start_port, end_port):
-        return protocol in ['tcp', 'udp'] \
-               and protocol == rule['protocol'] \
-               and start_port == int(rule['startport']) \
-               and end_port == int(rule['endport'])
-
-
-    def _icmp_match(self, rule, protocol, icmp_code, icmp_type):
-        return protocol == 'icmp' \
-               and protocol == rule['protocol'] \
-               and icmp_code == int(rule['icmpcode']) \
-               and icmp_type == int(rule['icmptype'])
-
+    def _get_job_result(self, jobid, res, key=None):
+        # The result of a finished job, a failed job (jobstatus 2) as dict
+        # having 'errortext', even if the API gives none.
+        job_result = res.get('jobresult', {})
+        if res['jobstatus'] == 2 or 'errortext' in job_result:
+            errortext = job_result.get('errortext') or "job failed with result code %s" % res.get('jobresultcode')
+            return { 'jobid': jobid, 'errortext': errortext }
+        if key and key in job_result:
+            return job_result[key]
+        return job_result
+
+
+    def _poll_jobs(self, jobs, key=None, timeout=None):
+        # Polls the async jobs together, one query per running job and round.
+        # Returns the results in order of the jobs, a failed job as dict
+        # having 'errortext' and a job still running after timeout as given.
+        # The timeout defaults to the module param, without one the jobs are
+        # waited for until done; a timeout of 0 queries them once.
+        if timeout is None:
+            timeout = self.module.params.get('timeout')
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        results = list(jobs)
+        running = {}
+        for i, job in enumerate(jobs):
+            if job and 'jobid' in job:
+                running[job['jobid']] = i
+
+        while running:
+            for jobid, i in running.items():
+                res = self.cs.queryAsyncJobResult(jobid=jobid)
+                if res['jobstatus'] != 0:
+                    del running[jobid]
+                    results[i] = self._get_job_result(jobid, res, key)
+
+            if not running:
+                break
+            delay = 2
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                delay = min(delay, remaining)
+            time.sleep(delay)
+        return results
+
+
+    def _run_jobs(self, calls, key=None, concurrency=10, poll_async=None):
+        # Submits the (api method, args) calls keeping at most concurrency
+        # jobs running, polled together. Returns the results in order of the
+        # calls, failures as dict having 'errortext'. Without poll_async all
+        # calls are submitted and the jobs are returned as given, poll_async
+        # defaults to the module param.
+        if poll_async is None:
+            poll_async = self.module.params.get('poll_async', True)
+        results = [ None ] * len(calls)
+        queued = list(enumerate(calls))
+        running = {}
+        while queued or running:
+            while queued and (len(running) < concurrency or not poll_async):
+                i, (method, args) = queued.pop(0)
+                try:
+                    res = method(**args)
+                except CloudStackException, e:
+                    res = { 'errortext': str(e) }
+                results[i] = res
+                if poll_async and 'jobid' in res and 'errortext' not in res:
+                    running[res['jobid']] = i
+
+            for jobid, i in running.items():
+                res = self.cs.queryAsyncJobResult(jobid=jobid)
+                if res['jobstatus'] != 0:
+                    del running[jobid]
+                    results[i] = self._get_job_result(jobid, res, key)
+            if running:
+                time.sleep(2)
+        return results
 
-    def _ah_esp_gre_match(self, rule, protocol):
-        return protocol in ['ah', 'esp', 'gre'] \
-               and protocol == rule['protocol']
 
+    def _run_calls(self, calls, concurrency=10):
+        # Runs the synchronous (api method, args) calls in up to concurrency
+        # threads. Returns the results in order of the calls, failures as
+        # dict having 'errortext'.
+        results = [ None ] * len(calls)
+        queued = list(enumerate(calls))
+        lock = threading.Lock()
 
-    def _type_security_group_match(self, rule, security_group_name):
-        return security_group_name \
-               and 'securitygroupname' in rule \
-               and security_group_name == rule['securitygroupname']
+        def worker():
+            while True:
+                lock.acquire()
+                try:
+                    if not queued:
+                        return
+                    i, (method, args) = queued.pop(0)
+                finally:
+                    lock.release()
+                try:
+                    results[i] = method(**args)
+                except Exception, e:
+                    results[i] = { 'errortext': str(e) }
+
+        threads = [ threading.Thread(target=worker) for i in range(min(concurrency, len(calls))) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+
+    def _parse_cidr(self, cidr):
+        # Returns the IPv4 CIDR as (network, prefix length) or None if it is
+        # not an IPv4 network in full notation.
+        try:
+            address, prefix = cidr.strip().split('/')
+            octets = [ int(o) for o in address.split('.') ]
+            prefix = int(prefix)
+        except (AttributeError, ValueError):
+            return None
+        if len(octets) != 4 or [ o for o in octets if not 0 <= o <= 255 ] or not 0 <= prefix <= 32:
+            return None
 
+        network = (octets[0] << 24) + (octets[1] << 16) + (octets[2] << 8) + octets[3]
+        if network & ((1 << (32 - prefix)) - 1):
+            return None
+        return (network, prefix)
+
+
+    def _format_cidr(self, network, prefix):
+        octets = [ str((network >> shift) & 255) for shift in [24, 16, 8, 0] ]
+        return '%s/%d' % ('.'.join(octets), prefix)
+
+
+    def _collapse_cidrs(self, cidrs):
+        # Collapses the CIDRs into the minimal list of networks covering the
+        # same addresses, networks contained in others are dropped and
+        # adjacent siblings are merged into their supernet. CIDRs not being
+        # IPv4 networks are kept as given.
+        networks = []
+        others = []
+        for cidr in cidrs:
+            network = self._parse_cidr(cidr)
+            if network:
+                networks.append(network)
+            elif cidr not in others:
+                others.append(cidr)
+
+        collapsed = []
+        for network, prefix in sorted(networks):
+            if collapsed:
+                last_network, last_prefix = collapsed[-1]
+                if network >> (32 - last_prefix) == last_network >> (32 - last_prefix):
+                    continue
+            collapsed.append((network, prefix))
+
+            while len(collapsed) > 1:
+                (lower, lower_prefix), (upper, upper_prefix) = collapsed[-2:]
+                size = 1 << (32 - upper_prefix)
+                if lower_prefix != upper_prefix or lower & size or lower + size != upper:
+                    break
+                collapsed[-2:] = [ (lower, lower_prefix - 1) ]
+
+        return [ self._format_cidr(n, p) for n, p in collapsed ] + others
+
+
+    def _is_cidr_covered(self, cidr, cidrs):
+        # Whether the addresses of the CIDR are all in the CIDRs given, by one
+        # network containing it or by the networks within it collapsing into
+        # it. CIDRs not being IPv4 networks must be given as they are.
+        network = self._parse_cidr(cidr)
+        if not network:
+            return cidr in cidrs
+        address, prefix = network
+
+        inner = []
+        for other in cidrs:
+            other_network = self._parse_cidr(other)
+            if not other_network:
+                continue
+            other_address, other_prefix = other_network
+            if other_prefix <= prefix:
+                if address >> (32 - other_prefix) == other_address >> (32 - other_prefix):
+                    return True
+            elif other_address >> (32 - prefix) == address >> (32 - prefix):
+                inner.append(other)
+        return self._collapse_cidrs(inner) == [ self._format_cidr(address, prefix) ]
+
+
+    def _is_covered(self, cidrs, ports, covering):
+        # Whether the CIDRs on the (start port, end port) range are covered by
+        # the union of the (cidrs, ports) given, e.g. by the existing rules an
+        # aggregated rule would replace. Ports (None, None) stand for rules
+        # without ports. The range is split at the bounds of the covering
+        # ranges, each part must be covered by the CIDRs of the rules
+        # spanning it.
+        start_port, end_port = ports
+        if start_port is None:
+            parts = [ (None, None) ]
+        else:
+            bounds = set([ start_port, end_port + 1 ])
+            for covering_cidrs, (covering_start, covering_end) in covering:
+                if covering_start is None:
+                    continue
+                for bound in [ covering_start, covering_end + 1 ]:
+                    if start_port < bound <= end_port:
+                        bounds.add(bound)
+            bounds = sorted(bounds)
+            parts = [ (bounds[i], bounds[i + 1] - 1) for i in range(len(bounds) - 1) ]
+
+        for part_start, part_end in parts:
+            part_cidrs = []
+            for covering_cidrs, (covering_start, covering_end) in covering:
+                if part_start is None or (covering_start is not None and covering_start <= part_start and part_end <= covering_end):
+                    part_cidrs.extend(covering_cidrs)
+            for cidr in cidrs:
+                if not self._is_cidr_covered(cidr, part_cidrs):
+                    return False
+        return True
+
+
+    def _merge_port_ranges(self, port_ranges):
+        # Merges overlapping and contiguous (start port, end port) ranges.
+        merged = []
+        for start_port, end_port in sorted(port_ranges):
+            if merged and start_port <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end_port))
+            else:
+                merged.append((start_port, end_port))
+        return merged
 
-    def _type_cidr_match(self, rule, cidr):
-        return 'cidr' in rule \
-               and cidr == rule['cidr']
 
+class AnsibleCloudStackSecurityGroupRule(AnsibleCloudStack):
 
-    def _get_rule(self, rules):
-        user_security_group_name = self.module.params.get('user_security_group')
-        cidr                     = self.module.params.get('cidr')
-        protocol                 = self.module.params.get('protocol')
-        start_port               = self.module.params.get('start_port')
-        end_port                 = self.module.params.get('end_port')
-        icmp_code                = self.module.params.get('icmp_code')
-        icmp_type                = self.module.params.get('icmp_type')
-
-        if not end_port:
-            end_port = start_port
+    def __init__(self, module):
+        AnsibleCloudStack.__init__(self, module)
+        self.result = {
+            'changed': False,
+        }
+        self.security_groups = None
+        self.rules_indexes = {}
 
-        if protocol in ['tcp', 'udp'] and not (start_port and end_port):
-            self.module.fail_json(msg="no start_port or end_port set for protocol '%s'" % protocol)
 
-        if protocol == 'icmp' and not (icmp_type and icmp_code):
-            self.module.fail_json(msg="no icmp_type or icmp_code set for protocol '%s'" % protocol)
+    def _get_rule(self, security_group):
+        key = self._get_desired_rule_key(self.module.params)
+        return self.get_rules_index(security_group).get(key)
 
-        for rule in rules:
-            if user_security_group_name:
-                type_match = self._type_security_group_match(rule, user_security_group_name)
-            else:
-                type_match = self._type_cidr_match(rule, cidr)
 
-            protocol_match = (    self._tcp_udp_match(rule, protocol, start_port, end_port) \
-                               or self._icmp_match(rule, protocol, icmp_code, icmp_type) \
-                               or self._ah_esp_gre_match(rule, protocol)
-                             )
+    def get_security_groups(self):
+        # The security group and the user security groups are resolved by
+        # one listing of the project's security groups, all pages, indexed
+        # by name.
+        if self.security_groups is None:
+            args = {}
+            args['projectid'] = self.get_project_id()
 
-            if type_match and protocol_match:
-                return rule
-        return None
+            self.security_groups = {}
+            self.rules_indexes = {}
+            for sg in self._list_all('listSecurityGroups', 'securitygroup', **args):
+                self.security_groups[sg['name']] = sg
+        return self.security_groups
 
 
     def get_security_group(self, security_group_name=None):
         if not security_group_name:
             security_group_name = self.module.params.get('security_group')
-        args = {}
-        args['securitygroupname'] =  security_group_name
-        args['projectid'] = self.get_project_id()
-        sgs = self.cs.listSecurityGroups(**args)
-        if not sgs or 'securitygroup' not in sgs:
+        security_groups = self.get_security_groups()
+        if security_group_name not in security_groups:
                 self.module.fail_json(msg="security group '%s' not found" % security_group_name)
-        return sgs['securitygroup'][0]
+        return security_groups[security_group_name]
+
+
+    def get_rules_index(self, security_group):
+        # Rules of the security group by their normalized key, built once
+        # per fetched security group.
+        if security_group['id'] not in self.rules_indexes:
+            index = {}
+            for type in ['ingress', 'egress']:
+                for rule in security_group.get(type + 'rule', []):
+                    index[self._get_rule_key(type, rule)] = rule
+            self.rules_indexes[security_group['id']] = index
+        return self.rules_indexes[security_group['id']]
 
 
     def add_rule(self):
@@ -462,14 +787,14 @@ class AnsibleCloudStackSecurityGroupRule(AnsibleCloudStack):
         res  = None
         type = self.module.params.get('type')
         if type == 'ingress':
-            rule = self._get_rule(security_group['ingressrule'])
+            rule = self._get_rule(security_group)
             if not rule:
                 self.result['changed'] = True
                 if not self.module.check_mode:
                     res = self.cs.authorizeSecurityGroupIngress(**args)
 
         elif type == 'egress':
-            rule = self._get_rule(security_group['egressrule'])
+            rule = self._get_rule(security_group)
             if not rule:
                 self.result['changed'] = True
                 if not self.module.check_mode:
@@ -481,6 +806,8 @@ class AnsibleCloudStackSecurityGroupRule(AnsibleCloudStack):
         poll_async = self.module.params.get('poll_async')
         if res and poll_async:
             security_group = self._poll_job(res, 'securitygroup')
+        elif res and 'jobid' in res:
+            self.result['job_id'] = res['jobid']
         return security_group
 
 
@@ -490,14 +817,14 @@ class AnsibleCloudStackSecurityGroupRule(AnsibleCloudStack):
         res  = None
         type = self.module.params.get('type')
         if type == 'ingress':
-            rule = self._get_rule(security_group['ingressrule'])
+            rule = self._get_rule(security_group)
             if rule:
                 self.result['changed'] = True
                 if not self.module.check_mode:
                     res = self.cs.revokeSecurityGroupIngress(id=rule['ruleid'])
 
         elif type == 'egress':
-            rule = self._get_rule(security_group['egressrule'])
+            rule = self._get_rule(security_group)
             if rule:
                 self.result['changed'] = True
                 if not self.module.check_mode:
@@ -509,9 +836,235 @@ class AnsibleCloudStackSecurityGroupRule(AnsibleCloudStack):
         poll_async = self.module.params.get('poll_async')
         if res and poll_async:
             res = self._poll_job(res, 'securitygroup')
+        elif res and 'jobid' in res:
+            self.result['job_id'] = res['jobid']
         return security_group
 
 
+    def _get_rule_key(self, type, rule):
+        # Normalized, hashable key of a rule as returned by the API.
+        protocol = rule['protocol']
+        ports = (None, None)
+        icmp = (None, None)
+        if protocol in ['tcp', 'udp']:
+            ports = (int(rule['startport']), int(rule['endport']))
+        elif protocol == 'icmp':
+            icmp = (int(rule['icmptype']), int(rule['icmpcode']))
+
+        if 'securitygroupname' in rule:
+            return (type, protocol, ports, icmp, None, rule['securitygroupname'])
+        return (type, protocol, ports, icmp, rule.get('cidr'), None)
+
+
+    def _get_desired_rule_key(self, rule):
+        # Normalized, hashable key of a rule given in rules or of the module
+        # params, keys not set are defaulted to the module params.
+        params = self.module.params
+        type                     = rule.get('type', params.get('type'))
+        protocol                 = rule.get('protocol', params.get('protocol'))
+        user_security_group_name = rule.get('user_security_group', params.get('user_security_group'))
+        cidr                     = rule.get('cidr', params.get('cidr'))
+        start_port               = rule.get('start_port', rule.get('port'))
+        end_port                 = rule.get('end_port')
+        icmp_type                = rule.get('icmp_type', params.get('icmp_type'))
+        icmp_code                = rule.get('icmp_code', params.get('icmp_code'))
+
+        # the ports are defaulted together, a rule having a port only is a single port.
+        if start_port is None and end_port is None:
+            start_port = params.get('start_port')
+            end_port   = params.get('end_port')
+
+        where = ''
+        if rule is not params:
+            where = " in rule %s" % rule
+
+        if type not in ['ingress', 'egress']:
+            self.module.fail_json(msg="invalid type '%s'%s" % (type, where))
+
+        if end_port is None:
+            end_port = start_port
+
+        ports = (None, None)
+        icmp = (None, None)
+        if protocol in ['tcp', 'udp']:
+            if start_port is None or end_port is None:
+                self.module.fail_json(msg="no start_port or end_port set for protocol '%s'%s" % (protocol, where))
+            try:
+                ports = (int(start_port), int(end_port))
+            except (ValueError, TypeError):
+                self.module.fail_json(msg="invalid start_port '%s' or end_port '%s'%s" % (start_port, end_port, where))
+        elif protocol == 'icmp':
+            if icmp_type is None or icmp_code is None:
+                self.module.fail_json(msg="no icmp_type or icmp_code set for protocol '%s'%s" % (protocol, where))
+            try:
+                icmp = (int(icmp_type), int(icmp_code))
+            except (ValueError, TypeError):
+                self.module.fail_json(msg="invalid icmp_type '%s' or icmp_code '%s'%s" % (icmp_type, icmp_code, where))
+        elif protocol not in ['ah', 'esp', 'gre']:
+            self.module.fail_json(msg="invalid protocol '%s'%s" % (protocol, where))
+
+        # the user_security_group and cidr are mutually_exclusive, but cidr is defaulted to 0.0.0.0/0.
+        if user_security_group_name:
+            return (type, protocol, ports, icmp, None, user_security_group_name)
+        return (type, protocol, ports, icmp, cidr, None)
+
+
+    def _get_rule_from_key(self, key):
+        type, protocol, ports, icmp, cidr, user_security_group_name = key
+        rule = {
+            'type': type,
+            'protocol': protocol,
+        }
+        if user_security_group_name:
+            rule['user_security_group'] = user_security_group_name
+        else:
+            rule['cidr'] = cidr
+        if protocol in ['tcp', 'udp']:
+            rule['start_port'], rule['end_port'] = ports
+        elif protocol == 'icmp':
+            rule['icmp_type'], rule['icmp_code'] = icmp
+        return rule
+
+
+    def _optimize_rule_keys(self, keys):
+        # Merges the port ranges per source, then collapses the CIDRs per
+        # port range, until no more rules are saved.
+        optimized = []
+        while len(keys) != len(optimized):
+            optimized = keys
+
+            port_ranges = {}
+            keys = []
+            for key in optimized:
+                type, protocol, ports, icmp, cidr, user_security_group_name = key
+                if protocol not in ['tcp', 'udp']:
+                    keys.append(key)
+                    continue
+                source = (type, protocol, cidr, user_security_group_name)
+                if source not in port_ranges:
+                    port_ranges[source] = []
+                port_ranges[source].append(ports)
+            for source in sorted(port_ranges):
+                type, protocol, cidr, user_security_group_name = source
+                for ports in self._merge_port_ranges(port_ranges[source]):
+                    keys.append((type, protocol, ports, (None, None), cidr, user_security_group_name))
+
+            cidrs = {}
+            merged = []
+            for key in keys:
+                type, protocol, ports, icmp, cidr, user_security_group_name = key
+                if user_security_group_name:
+                    merged.append(key)
+                    continue
+                access = (type, protocol, ports, icmp)
+                if access not in cidrs:
+                    cidrs[access] = []
+                cidrs[access].append(cidr)
+            for access in sorted(cidrs):
+                type, protocol, ports, icmp = access
+                for cidr in self._collapse_cidrs(cidrs[access]):
+                    merged.append((type, protocol, ports, icmp, cidr, None))
+            keys = merged
+        return keys
+
+
+    def _is_rule_covered(self, key, existing):
+        # Whether the access of the rule is already granted by the existing
+        # CIDR rules of the same type and protocol, e.g. by the rules an
+        # aggregated rule would replace.
+        type, protocol, ports, icmp, cidr, user_security_group_name = key
+        if user_security_group_name:
+            return False
+        covering = [ ((k[4],), k[2]) for k in existing if k[:2] == (type, protocol) and k[3] == icmp and not k[5] ]
+        return self._is_covered((cidr,), ports, covering)
+
+
+    def _get_authorize_call(self, security_group, key):
+        type, protocol, ports, icmp, cidr, user_security_group_name = key
+        args = {}
+        if user_security_group_name:
+            user_security_group = self.get_security_group(user_security_group_name)
+            args['usersecuritygrouplist'] = [{
+                'group': user_security_group['name'],
+                'account': user_security_group['account'],
+            }]
+        else:
+            args['cidrlist'] = cidr
+
+        args['protocol']        = protocol
+        args['startport']       = ports[0]
+        args['endport']         = ports[1]
+        args['icmptype']        = icmp[0]
+        args['icmpcode']        = icmp[1]
+        args['projectid']       = self.get_project_id()
+        args['securitygroupid'] = security_group['id']
+
+        if type == 'egress':
+            return (self.cs.authorizeSecurityGroupEgress, args)
+        return (self.cs.authorizeSecurityGroupIngress, args)
+
+
+    def _get_revoke_call(self, type, rule):
+        if type == 'egress':
+            return (self.cs.revokeSecurityGroupEgress, { 'id': rule['ruleid'] })
+        return (self.cs.revokeSecurityGroupIngress, { 'id': rule['ruleid'] })
+
+
+    def apply_rules(self):
+        security_group = self.get_security_group()
+
+        existing = self.get_rules_index(security_group)
+
+        desired = []
+        desired_keys = set()
+        for rule in self.module.params.get('rules'):
+            key = self._get_desired_rule_key(rule)
+            if key not in desired_keys:
+                desired.append(key)
+                desired_keys.add(key)
+
+        if self.module.params.get('optimize') and self.module.params.get('state') != 'absent':
+            optimized = self._optimize_rule_keys(desired)
+            self.result['rules_saved'] = len(desired) - len(optimized)
+            desired = optimized
+            desired_keys = set(desired)
+
+        added = []
+        removed = []
+        if self.module.params.get('state') == 'absent':
+            removed = [ k for k in desired if k in existing ]
+        else:
+            added = [ k for k in desired if k not in existing ]
+            if self.module.params.get('exclusive'):
+                removed = [ k for k in sorted(existing) if k not in desired_keys ]
+            elif self.module.params.get('optimize'):
+                # not to add an aggregated rule next to the rules it replaces
+                added = [ k for k in added if not self._is_rule_covered(k, existing) ]
+
+        calls = []
+        for key in added:
+            calls.append(self._get_authorize_call(security_group, key))
+        for key in removed:
+            calls.append(self._get_revoke_call(key[0], existing[key]))
+
+        self.result['security_group'] = security_group['name']
+        self.result['rules_added'] = [ self._get_rule_from_key(k) for k in added ]
+        self.result['rules_removed'] = [ self._get_rule_from_key(k) for k in removed ]
+
+        if calls:
+            self.result['changed'] = True
+            if not self.module.check_mode:
+                concurrency = self.module.params.get('concurrency')
+                res = self._run_jobs(calls, 'securitygroup', concurrency)
+
+                errors = [ r['errortext'] for r in res if 'errortext' in r ]
+                if errors:
+                    self.module.fail_json(msg="Failed: %s" % '; '.join(errors), **self.result)
+                if not self.module.params.get('poll_async'):
+                    self.result['job_ids'] = [ r['jobid'] for r in res if 'jobid' in r ]
+        return self.result
+
+
     def get_result(self, security_group_rule):
         type = self.module.params.get('type')
         
@@ -553,6 +1106,10 @@ def main():
             start_port = dict(type='int', default=None, aliases=['port']),
             end_port = dict(type='int', default=None),
             state = dict(choices=['present', 'absent'], default='present'),
+            rules = dict(type='list', default=None),
+            exclusive = dict(type='bool', default=False),
+            optimize = dict(type='bool', default=False),
+            concurrency = dict(type='int', default=10),
             project = dict(default=None),
             poll_async = dict(choices=BOOLEANS, default=True),
             api_key = dict(default=None),
@@ -576,12 +1133,14 @@ def main():
         acs_sg_rule = AnsibleCloudStackSecurityGroupRule(module)
 
         state = module.params.get('state')
-        if state in ['absent']:
+        if module.params.get('rules') is not None:
+            result = acs_sg_rule.apply_rules()
+        elif state in ['absent']:
             sg_rule = acs_sg_rule.remove_rule()
+            result = acs_sg_rule.get_result(sg_rule)
         else:
             sg_rule = acs_sg_rule.add_rule()
-
-        result = acs_sg_rule.get_result(sg_rule)
+            result = acs_sg_rule.get_result(sg_rule)
 
     except CloudStackException, e:
         module.fail_json(msg='CloudStackException: %s' % str(e))
@@ -23,7 +23,7 @@ DOCUMENTATION = '''
 module: cloudstack_vm
 short_description: Create, start, scale, restart, stop and destroy virtual machines on Apache CloudStack based clouds.
 description:
-    - Manage virtual machines on Apache CloudStack, Citrix CloudPlatform and Exoscale. Existing virtual machines will be scaled if service offering is different by stopping and starting the virtual machine.
+    - Manage virtual machines on Apache CloudStack, Citrix CloudPlatform and Exoscale. Existing virtual machines will be scaled if service offering is different, running dynamically scalable virtual machines on XenServer or VMware are scaled up in place, others by stopping and starting the virtual machine.
     - Credentials can be stored locally in C($HOME/.cloudstack.ini) instead of using C(api_url), C(api_key), C(api_secret), C(api_http_method), see https://github.com/exoscale/cs on which this module depends on.
     - This module supports check mode.
 version_added: '1.9'
@@ -40,6 +40,51 @@ options:
     required: false
     default: null
     aliases: []
+  names:
+    description:
+      - List of names of virtual machines to be deployed in one task. The shared prerequisites are only looked up once and the virtual machines are deployed concurrently, see C(concurrency). Only used with C(state=present).
+    required: false
+    default: null
+    aliases: []
+  count:
+    description:
+      - Number of virtual machines to be deployed in one task, named after C(name_pattern). Only used with C(state=present).
+    required: false
+    default: null
+    aliases: []
+  name_pattern:
+    description:
+      - Pattern used with C(count) to build the names of the virtual machines, the index starting with 1 is inserted for C(%d). If not set, C(<name>-%d) is used.
+    required: false
+    default: null
+    aliases: []
+  exact_count:
+    description:
+      - Number of virtual machines the group C(group) should have. Missing virtual machines are deployed, named after C(name_pattern) (defaults to C(<group>-%d)), surplus ones are destroyed, not running and newest first. Only used with C(state=present).
+      - Only virtual machines of the group having the C(template) or C(iso) and C(service_offering) given are counted. Others in the group are neither counted nor destroyed.
+    required: false
+    default: null
+    aliases: []
+  concurrency:
+    description:
+      - Max number of deploy or destroy jobs running at the same time if C(names), C(count) or C(exact_count) is used.
+    required: false
+    default: 10
+    aliases: []
+  catalog_cache:
+    description:
+      - Path of the file caching the ids of templates and ISOs per zone between module runs.
+      - The file has another format than the C(catalog_cache) of M(cs_template) and M(cs_iso), do not share it with them.
+    required: false
+    default: '~/.ansible-cloudstack-vm-catalog.cache'
+    aliases: []
+  catalog_cache_ttl:
+    description:
+      - Seconds a cached template or ISO id is used before it is looked up again. C(0) disables the cache.
+      - A cached id the deployment fails on, e.g. of a deleted template, is looked up again once.
+    required: false
+    default: 300
+    aliases: []
   group:
     description:
       - Group in where the new virtual machine should be in.
@@ -134,7 +179,7 @@ options:
     aliases: []
   poll_async:
     description:
-      - Poll async jobs until job has finised.
+      - Poll async jobs until job has finised. If C(false), the id of the job is returned as C(job_id), see M(cs_job).
     required: false
     default: true
     aliases: []
@@ -198,6 +243,30 @@ EXAMPLES = '''
 - debug: msg='default ip {{ vm.default_ip }} and is in state {{ vm.vm_state }}'
 
 
+# Deploy 20 virtual machines web-01 to web-20, 5 at the same time
+- local_action:
+    module: cloudstack_vm
+    name_pattern: web-%02d
+    count: 20
+    concurrency: 5
+    template: Linux Debian 7 64-bit
+    service_offering: Tiny
+    group: web
+  register: vms
+
+- debug: msg='{{ item.name }} has ip {{ item.default_ip }}'
+  with_items: vms.vms
+
+
+# Ensure the group web has exactly 30 virtual machines of offering Tiny
+- local_action:
+    module: cloudstack_vm
+    group: web
+    exact_count: 30
+    template: Linux Debian 7 64-bit
+    service_offering: Tiny
+
+
 # Stop a virtual machine, credentials used in $HOME/.cloudstack.ini
 - local_action: cloudstack_vm name=web-vm-1 state=stopped
 
@@ -210,8 +279,14 @@ EXAMPLES = '''
 - local_action: cloudstack_vm name=web-vm-1 state=absent
 '''
 
+import os
+import re
 import sys
+import json
+import time
 import base64
+import tempfile
+import threading
 
 try:
     from cs import CloudStack, CloudStackException, read_config
@@ -220,21 +295,150 @@ except ImportError:
         "msg='python library cs required: pip install cs'")
     sys.exit(1)
 
+# max number of items a listing returns per page
+PAGE_SIZE = 500
 
-def get_service_offering_id(module, cs):
+
+def get_service_offering(module, cs):
     service_offering = module.params.get('service_offering')
     service_offerings = cs.listServiceOfferings()
     if service_offerings:
         if not service_offering:
-            return service_offerings['serviceoffering'][0]['id']
+            return service_offerings['serviceoffering'][0]
 
         for s in service_offerings['serviceoffering']:
             if s['name'] == service_offering or s['id'] == service_offering:
-                return s['id']
+                return s
     module.fail_json(msg="Service offering '%s' not found" % service_offering)
 
 
-def get_template_or_iso_id(module, cs):
+def get_service_offering_id(module, cs):
+    return get_service_offering(module, cs)['id']
+
+
+UUID_RE = re.compile('^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)
+
+
+class Catalog(object):
+    # Cache of template and ISO ids of a zone, stored in the file catalog_cache
+    # and shared between module runs for catalog_cache_ttl seconds.
+
+    def __init__(self, module, cs, kind, zone_id):
+        self.module = module
+        self.path = os.path.expanduser(module.params.get('catalog_cache') or '')
+        self.ttl = module.params.get('catalog_cache_ttl') or 0
+        self.key = '|'.join([ getattr(cs, 'endpoint', '') or '', kind, zone_id or '' ])
+        self.items = {}
+        self.changed = False
+
+        if self.enabled():
+            entry = self.read().get(self.key)
+            if entry and entry['timestamp'] + self.ttl > time.time():
+                self.items = entry['items']
+                self.timestamp = entry['timestamp']
+            else:
+                self.timestamp = time.time()
+
+
+    def enabled(self):
+        return self.path and self.ttl > 0
+
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+    def get(self, name):
+        return self.items.get(name)
+
+
+    def add(self, item, name=None):
+        for key in [ name, item['id'], item['name'], item['displaytext'] ]:
+            if key and self.items.get(key) != item['id']:
+                self.items[key] = item['id']
+                self.changed = True
+
+
+    def remove(self, name):
+        # drops the name and all other names of the same id
+        item_id = self.items.get(name)
+        if item_id:
+            for key, value in self.items.items():
+                if value == item_id:
+                    del self.items[key]
+            self.changed = True
+
+
+    def save(self):
+        if not self.enabled() or not self.changed:
+            return
+        catalog = self.read()
+        catalog[self.key] = {
+            'timestamp': self.timestamp,
+            'items': self.items,
+        }
+        # write to a temp file and rename, other module runs may read it
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(catalog, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+
+def list_templates_or_isos(cs, kind, **args):
+    if kind == 'template':
+        res = cs.listTemplates(templatefilter='executable', **args)
+    else:
+        res = cs.listIsos(**args)
+    if not res or kind not in res:
+        return []
+    return res[kind]
+
+
+def find_template_or_iso(module, cs, kind, name, zone_id=None):
+    catalog = Catalog(module, cs, kind, zone_id)
+    item_id = catalog.get(name)
+    if item_id:
+        return item_id
+
+    args = {}
+    if zone_id:
+        args['zoneid'] = zone_id
+
+    # look up by id or exact name first, the API filters for us. The full
+    # listing of the zone is only needed to match the display text.
+    if UUID_RE.match(name):
+        items = list_templates_or_isos(cs, kind, id=name, **args)
+    else:
+        items = list_templates_or_isos(cs, kind, name=name, **args)
+
+    match = None
+    for i in items:
+        if name in [ i['displaytext'], i['name'], i['id'] ]:
+            match = i
+            break
+
+    if not match:
+        items = list_templates_or_isos(cs, kind, **args)
+        for i in items:
+            catalog.add(i)
+            if not match and name in [ i['displaytext'], i['name'], i['id'] ]:
+                match = i
+
+    if match:
+        catalog.add(match, name)
+        catalog.save()
+        return match['id']
+    module.fail_json(msg="%s '%s' not found" % (kind, name))
+
+
+def get_template_or_iso_id(module, cs, zone_id=None):
     template = module.params.get('template')
     iso = module.params.get('iso')
 
@@ -245,20 +449,20 @@ def get_template_or_iso_id(module, cs):
         module.fail_json(msg="template are iso are mutually exclusive.")
 
     if template:
-        templates = cs.listTemplates(templatefilter='executable')
-        if templates:
-            for t in templates['template']:
-                if t['displaytext'] == template or t['name'] == template or t['id'] == template:
-                    return t['id']
-        module.fail_json(msg="template '%s' not found" % template)
-
-    elif iso:
-        isos = cs.listIsos()
-        if isos:
-            for i in isos['iso']:
-                if i['displaytext'] == iso or i['name'] == iso or i['id'] == iso:
-                    return i['id']
-        module.fail_json(msg="iso '%s' not found" % iso)
+        return find_template_or_iso(module, cs, 'template', template, zone_id)
+    return find_template_or_iso(module, cs, 'iso', iso, zone_id)
+
+
+def evict_template_or_iso(module, cs, zone_id=None):
+    # drops the cached id of the template or ISO, it may have been deleted
+    template = module.params.get('template')
+    if template:
+        catalog = Catalog(module, cs, 'template', zone_id)
+        catalog.remove(template)
+    else:
+        catalog = Catalog(module, cs, 'iso', zone_id)
+        catalog.remove(module.params.get('iso'))
+    catalog.save()
 
 
 def get_disk_offering_id(module, cs):
@@ -328,26 +532,170 @@ def get_vm(module, cs, project_id):
     return None
 
 
-def get_network_ids(module, cs, project_id):
+def list_networks(cs, project_id, zone_id=None):
+    args = {}
+    if project_id:
+        args['projectid'] = project_id
+    if zone_id:
+        args['zoneid'] = zone_id
+    return cs.listNetworks(**args)
+
+
+def get_network_ids(module, cs, project_id, zone_id=None, network_res=None):
     networks = module.params.get('networks')
 
     if not networks:
         return None
 
-    zone_id = get_zone_id(module, cs)
-    if project_id:
-        network_res = cs.listNetworks(projectid=project_id, zoneid=zone_id)
-    else:
-        network_res = cs.listNetworks(zoneid=zone_id)
+    if not zone_id:
+        zone_id = get_zone_id(module, cs)
+
+    if network_res is None:
+        network_res = list_networks(cs, project_id, zone_id)
 
+    # network_res may be listed without zone filter, see Resolver
     network_ids = []
     if network_res:
         for n in network_res['network']:
+            if n['zoneid'] != zone_id:
+                continue
             if n['name'] in networks or n['id'] in networks:
                 network_ids.append(n['id'])
     return ','.join(network_ids)
 
 
+class ResolveFailed(Exception):
+    pass
+
+
+class DeferredFailModule(object):
+    # fail_json() must not be called from a thread, the lookups get this
+    # module proxy and the failure is raised again in the main thread.
+
+    def __init__(self, module):
+        self.module = module
+
+
+    def fail_json(self, **kwargs):
+        raise ResolveFailed(kwargs)
+
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+
+class Resolver(object):
+    # Memoizes the lookups needed to deploy a virtual machine and resolves
+    # the missing ones concurrently, one thread per lookup. A lookup may
+    # depend on another one, see get().
+
+    def __init__(self, module, cs, project_id):
+        self.module = module
+        self.cs = cs
+        self.project_id = project_id
+        self.results = {}
+        self.errors = {}
+        self.events = {}
+        self.lock = threading.Lock()
+        self.template_refreshed = False
+        self.lookups = {
+            # scoped to the zone, waits for the zone lookup
+            'templateid':        lambda m: get_template_or_iso_id(m, cs, self.get('zoneid', m)),
+            'zoneid':            lambda m: get_zone_id(m, cs),
+            'serviceoffering':   lambda m: get_service_offering(m, cs),
+            'serviceofferingid': lambda m: self.get('serviceoffering', m)['id'],
+            'diskofferingid':    lambda m: get_disk_offering_id(m, cs),
+            'hypervisor':        lambda m: get_hypervisor(m, cs),
+            # listed for all zones to not wait for the zone lookup
+            'networks':          lambda m: m.params.get('networks') and list_networks(cs, project_id) or None,
+        }
+
+
+    def _run(self, key, module):
+        # the first caller runs the lookup, others wait for its result
+        with self.lock:
+            event = self.events.get(key)
+            owner = event is None
+            if owner:
+                event = self.events[key] = threading.Event()
+
+        if owner:
+            try:
+                self.results[key] = self.lookups[key](module)
+            except Exception, e:
+                self.errors[key] = e
+            event.set()
+        else:
+            event.wait()
+
+        if key in self.errors:
+            raise self.errors[key]
+        return self.results[key]
+
+
+    def resolve(self, keys=None):
+        if keys is None:
+            keys = self.lookups.keys()
+        keys = sorted([ k for k in keys if k not in self.results ])
+
+        deferred_module = DeferredFailModule(self.module)
+        def run(key):
+            try:
+                self._run(key, deferred_module)
+            except Exception:
+                pass
+
+        threads = [ threading.Thread(target=run, args=(k,)) for k in keys ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for key in keys:
+            if key in self.errors:
+                if isinstance(self.errors[key], ResolveFailed):
+                    self.module.fail_json(**self.errors[key].args[0])
+                raise self.errors[key]
+        return self.results
+
+
+    def get(self, key, module=None):
+        # module is given by lookups running in a thread
+        if module:
+            return self._run(key, module)
+        if key not in self.results:
+            self.resolve([ key ])
+        return self.results[key]
+
+
+    def forget(self, key):
+        with self.lock:
+            self.results.pop(key, None)
+            self.errors.pop(key, None)
+            self.events.pop(key, None)
+
+
+    def refresh_template_id(self, error):
+        # The template or ISO id may be cached and deleted meanwhile. If a
+        # deployment failed on it, the id is looked up again once. Returns
+        # True if another id was found and the deployment is worth a retry.
+        template_id = self.results.get('templateid')
+        if not template_id or self.template_refreshed:
+            return False
+        if template_id not in error and 'template' not in error.lower():
+            return False
+        self.template_refreshed = True
+        evict_template_or_iso(self.module, self.cs, self.get('zoneid'))
+        self.forget('templateid')
+        return self.get('templateid') != template_id
+
+
+    def get_network_ids(self):
+        return get_network_ids(self.module, self.cs, self.project_id,
+                               zone_id=self.get('zoneid'),
+                               network_res=self.get('networks'))
+
+
 def poll_job(cs, job, key):
     if 'jobid' in job:
         while True:
@@ -360,45 +708,70 @@ def poll_job(cs, job, key):
     return job
 
 
-def create_vm(module, cs, result, vm, project_id):
+def get_deploy_args(module, resolver):
+    resolver.resolve()
+
+    args = {}
+    args['templateid']          = resolver.get('templateid')
+    args['zoneid']              = resolver.get('zoneid')
+    args['serviceofferingid']   = resolver.get('serviceofferingid')
+    args['projectid']           = resolver.project_id
+    args['networkids']          = resolver.get_network_ids()
+    args['diskofferingid']      = resolver.get('diskofferingid')
+    args['hypervisor']          = resolver.get('hypervisor')
+
+    args['name']                = module.params.get('name')
+    args['group']               = module.params.get('group')
+    args['keypair']             = module.params.get('ssh_key')
+    args['size']                = module.params.get('disk_size')
+
+    user_data = module.params.get('user_data')
+    if user_data:
+        args['userdata'] = base64.b64encode(user_data)
+
+    display_name = module.params.get('display_name')
+    if not display_name:
+        display_name = args['name']
+    args['displayname'] = display_name
+
+    security_group_name_list = module.params.get('security_groups')
+    security_group_names = ''
+    if security_group_name_list:
+        security_group_names = ','.join(security_group_name_list)
+    args['securitygroupnames'] = security_group_names
+
+    affinity_group_name_list = module.params.get('affinity_groups')
+    affinity_group_names = ''
+    if affinity_group_name_list:
+        affinity_group_names = ','.join(affinity_group_name_list)
+    args['affinitygroupnames'] = affinity_group_names
+    return args
+
+
+def deploy_vm(cs, args, resolver):
+    try:
+        vm = cs.deployVirtualMachine(**args)
+        error = vm.get('errortext')
+    except CloudStackException, e:
+        vm = None
+        error = str(e)
+
+    if error and resolver.refresh_template_id(error):
+        args['templateid'] = resolver.get('templateid')
+        return cs.deployVirtualMachine(**args)
+    if vm is None:
+        raise CloudStackException(error)
+    return vm
+
+
+def create_vm(module, cs, result, vm, project_id, resolver=None):
     if not vm:
-        args = {}
-        args['templateid']          = get_template_or_iso_id(module, cs)
-        args['zoneid']              = get_zone_id(module, cs)
-        args['serviceofferingid']   = get_service_offering_id(module, cs)
-        args['projectid']           = project_id
-        args['networkids']          = get_network_ids(module, cs, project_id)
-        args['diskofferingid']      = get_disk_offering_id(module, cs)
-        args['hypervisor']          = get_hypervisor(module, cs)
-
-        args['name']                = module.params.get('name')
-        args['group']               = module.params.get('group')
-        args['keypair']             = module.params.get('ssh_key')
-        args['size']                = module.params.get('disk_size')
-
-        user_data = module.params.get('user_data')
-        if user_data:
-            args['userdata'] = base64.b64encode(user_data)
-
-        display_name = module.params.get('display_name')
-        if not display_name:
-            display_name = args['name']
-        args['displayname'] = display_name
-
-        security_group_name_list = module.params.get('security_groups')
-        security_group_names = ''
-        if security_group_name_list:
-            security_group_names = ','.join(security_group_name_list)
-        args['securitygroupnames'] = security_group_names
-
-        affinity_group_name_list = module.params.get('affinity_groups')
-        affinity_group_names = ''
-        if affinity_group_name_list:
-            affinity_group_names = ','.join(affinity_group_name_list)
-        args['affinitygroupnames'] = affinity_group_names
+        if not resolver:
+            resolver = Resolver(module, cs, project_id)
+        args = get_deploy_args(module, resolver)
 
         if not module.check_mode:
-            vm = cs.deployVirtualMachine(**args)
+            vm = deploy_vm(cs, args, resolver)
 
             if 'errortext' in vm:
                 module.fail_json(msg="Failed: '%s'" % vm['errortext'])
@@ -406,25 +779,319 @@ def create_vm(module, cs, result, vm, project_id):
             poll_async = module.params.get('poll_async')
             if poll_async:
                 vm = poll_job(cs, vm, 'virtualmachine')
+            elif 'jobid' in vm:
+                result['job_id'] = vm['jobid']
 
         result['changed'] = True
     return (result, vm)
 
 
-def scale_vm(module, cs, result, vm):
+def run_jobs(cs, calls, key, concurrency=10, poll_async=True):
+    # Submits the (api method, args) calls keeping at most concurrency jobs
+    # running and polls all running jobs in one round. Returns the results
+    # in order of the calls, failures as dict having 'errortext'.
+    results = [ None ] * len(calls)
+    queued = list(enumerate(calls))
+    running = {}
+    while queued or running:
+        while queued and (len(running) < concurrency or not poll_async):
+            i, (method, args) = queued.pop(0)
+            try:
+                res = method(**args)
+            except CloudStackException, e:
+                res = { 'errortext': str(e) }
+            if poll_async and 'jobid' in res and 'errortext' not in res:
+                running[res['jobid']] = i
+            else:
+                results[i] = res
+
+        for jobid, i in running.items():
+            res = cs.queryAsyncJobResult(jobid=jobid)
+            if res['jobstatus'] != 0:
+                del running[jobid]
+                job_result = res.get('jobresult', {})
+                if 'errortext' in job_result:
+                    results[i] = { 'errortext': job_result['errortext'] }
+                else:
+                    results[i] = job_result.get(key, job_result)
+        if running:
+            time.sleep(2)
+    return results
+
+
+def check_name_pattern(module, name_pattern):
+    # the pattern must insert the index exactly once, e.g. web-%02d
+    try:
+        names = [ name_pattern % 1, name_pattern % 2 ]
+    except (TypeError, ValueError, KeyError), e:
+        module.fail_json(msg="Invalid name_pattern '%s', it must contain one %%d for the index: %s" % (name_pattern, str(e)))
+    if names[0] == names[1]:
+        module.fail_json(msg="Invalid name_pattern '%s', it must contain one %%d for the index." % name_pattern)
+    return name_pattern
+
+
+def get_bulk_names(module):
+    names = module.params.get('names')
+    if names:
+        return names
+
+    count = module.params.get('count')
+    name_pattern = module.params.get('name_pattern')
+    if not name_pattern:
+        if not module.params.get('name'):
+            module.fail_json(msg="name_pattern or name is required if count is set.")
+        name_pattern = module.params.get('name') + '-%d'
+    check_name_pattern(module, name_pattern)
+    return [ name_pattern % i for i in range(1, count + 1) ]
+
+
+def list_vms(cs, **args):
+    # all pages of the listing, the API returns at most pagesize VMs a call
+    args['pagesize'] = PAGE_SIZE
+    vms = []
+    page = 1
+    while True:
+        args['page'] = page
+        res = cs.listVirtualMachines(**args)
+        if not res or 'virtualmachine' not in res:
+            break
+        vms.extend(res['virtualmachine'])
+        if len(res['virtualmachine']) < PAGE_SIZE:
+            break
+        page += 1
+    return vms
+
+
+def get_vms_by_name(module, cs, project_id):
+    vms = {}
+    for v in list_vms(cs, projectid=project_id):
+        vms[v['name']] = v
+    return vms
+
+
+def get_instance_group_id(module, cs, project_id):
+    group = module.params.get('group')
+    res = cs.listInstanceGroups(name=group, projectid=project_id)
+    if res and 'instancegroup' in res:
+        for g in res['instancegroup']:
+            if g['name'] == group:
+                return g['id']
+    return None
+
+
+def get_bulk_job_results(names, calls_results, action):
+    vms = {}
+    for name, vm in zip(names, calls_results):
+        vms[name] = get_vm_result(vm)
+        vms[name]['name'] = name
+        vms[name]['changed'] = True
+        if 'jobid' in vm:
+            vms[name]['job_id'] = vm['jobid']
+        if 'errortext' in vm:
+            vms[name]['failed'] = True
+            vms[name]['msg'] = vm['errortext']
+        elif action == 'deploy' and vm.get('state') == 'Error':
+            vms[name]['failed'] = True
+            vms[name]['msg'] = "Virtual machine in error state."
+    return vms
+
+
+def deploy_vms(module, cs, names, resolver):
+    args = get_deploy_args(module, resolver)
+    calls = []
+    for name in names:
+        vm_args = args.copy()
+        vm_args['name'] = name
+        vm_args['displayname'] = name
+        calls.append((cs.deployVirtualMachine, vm_args))
+
+    if module.check_mode:
+        return dict([ (name, { 'name': name, 'changed': True }) for name in names ])
+
+    poll_async = module.params.get('poll_async')
+    concurrency = int(module.params.get('concurrency'))
+    deployed = run_jobs(cs, calls, 'virtualmachine', concurrency, poll_async)
+
+    # deploy the failed ones again if a cached template id was outdated
+    failed = [ i for i, vm in enumerate(deployed) if 'errortext' in vm ]
+    if failed and resolver.refresh_template_id(deployed[failed[0]]['errortext']):
+        template_id = resolver.get('templateid')
+        calls = [ (cs.deployVirtualMachine, dict(calls[i][1], templateid=template_id)) for i in failed ]
+        for i, vm in zip(failed, run_jobs(cs, calls, 'virtualmachine', concurrency, poll_async)):
+            deployed[i] = vm
+    return get_bulk_job_results(names, deployed, 'deploy')
+
+
+def destroy_vms(module, cs, vms):
+    names = [ v['name'] for v in vms ]
+    if module.check_mode:
+        return dict([ (name, { 'name': name, 'changed': True }) for name in names ])
+
+    calls = [ (cs.destroyVirtualMachine, { 'id': v['id'] }) for v in vms ]
+    poll_async = module.params.get('poll_async')
+    concurrency = int(module.params.get('concurrency'))
+    destroyed = run_jobs(cs, calls, 'virtualmachine', concurrency, poll_async)
+    return get_bulk_job_results(names, destroyed, 'destroy')
+
+
+def fail_on_bulk_errors(module, result, vms, action):
+    failed = [ v['name'] for v in vms if v.get('failed') ]
+    if failed:
+        module.fail_json(msg="Failed to %s %d of %d virtual machines: %s" % (action, len(failed), len(vms), ', '.join(failed)), **result)
+
+
+def create_vms(module, cs, result, project_id, resolver):
+    names = get_bulk_names(module)
+    existing = get_vms_by_name(module, cs, project_id)
+
+    missing = [ n for n in names if n not in existing ]
+    vms = {}
+    for name in names:
+        if name in existing:
+            vms[name] = get_vm_result(existing[name])
+            vms[name]['changed'] = False
+
+    if missing:
+        result['changed'] = True
+        vms.update(deploy_vms(module, cs, missing, resolver))
+
+    result['vms'] = [ vms[n] for n in names ]
+    fail_on_bulk_errors(module, result, result['vms'], 'deploy')
+    return result
+
+
+def get_fleet_names(module, existing, count):
+    # the lowest free indexes of name_pattern, names must be unique
+    name_pattern = module.params.get('name_pattern')
+    if not name_pattern:
+        name_pattern = module.params.get('group') + '-%d'
+    check_name_pattern(module, name_pattern)
+
+    names = []
+    i = 1
+    while len(names) < count:
+        name = name_pattern % i
+        if name not in existing:
+            names.append(name)
+        i += 1
+    return names
+
+
+def reconcile_fleet(module, cs, result, project_id, resolver):
+    group = module.params.get('group')
+    if not group:
+        module.fail_json(msg="group is required if exact_count is set.")
+    exact_count = module.params.get('exact_count')
+
+    # the fleet are the VMs of the group having the template and service
+    # offering asked for, listed by the group id
+    fleet = []
+    group_id = get_instance_group_id(module, cs, project_id)
+    if group_id:
+        resolver.resolve([ 'templateid', 'serviceofferingid' ])
+        template_id = resolver.get('templateid')
+        service_offering_id = resolver.get('serviceofferingid')
+        fleet = [ v for v in list_vms(cs, projectid=project_id, groupid=group_id)
+                  if v['state'] not in [ 'Destroyed', 'Expunging' ]
+                  and v.get('templateid') == template_id
+                  and v.get('serviceofferingid') == service_offering_id ]
+
+    result['deployed'] = []
+    result['destroyed'] = []
+    vms = dict([ (v['name'], get_vm_result(v)) for v in fleet ])
+    for vm in vms.values():
+        vm['changed'] = False
+
+    if len(fleet) < exact_count:
+        result['changed'] = True
+        # names are unique in the project, not only in the group
+        existing = get_vms_by_name(module, cs, project_id)
+        names = get_fleet_names(module, existing, exact_count - len(fleet))
+        deployed = deploy_vms(module, cs, names, resolver)
+        vms.update(deployed)
+        result['deployed'] = names
+        fail_on_bulk_errors(module, result, deployed.values(), 'deploy')
+
+    elif len(fleet) > exact_count:
+        result['changed'] = True
+        # remove VMs not running first, then the newest ones
+        fleet.sort(key=lambda v: v.get('created', ''), reverse=True)
+        fleet.sort(key=lambda v: v['state'] == 'Running')
+        surplus = fleet[:len(fleet) - exact_count]
+        destroyed = destroy_vms(module, cs, surplus)
+        for name in destroyed:
+            del vms[name]
+        result['destroyed'] = [ v['name'] for v in surplus ]
+        fail_on_bulk_errors(module, result, destroyed.values(), 'destroy')
+
+    result['vms'] = [ vms[n] for n in sorted(vms) ]
+    return result
+
+
+def run_job(module, cs, method, args, key='virtualmachine'):
+    res = run_jobs(cs, [ (method, args) ], key)[0]
+    if 'errortext' in res:
+        module.fail_json(msg="Failed: '%s'" % res['errortext'])
+    return res
+
+
+# hypervisors able to scale a running virtual machine
+LIVE_SCALING_HYPERVISORS = [ 'XenServer', 'VMware' ]
+
+
+def can_scale_live(vm, service_offering):
+    if vm['state'] != 'Running' or not vm.get('isdynamicallyscalable'):
+        return False
+
+    if vm.get('hypervisor') not in LIVE_SCALING_HYPERVISORS:
+        return False
+
+    # a running virtual machine can only be scaled up
+    for key in [ 'cpunumber', 'cpuspeed', 'memory' ]:
+        if key in vm and key in service_offering and int(service_offering[key]) < int(vm[key]):
+            return False
+    return True
+
+
+def scale_vm(module, cs, result, vm, resolver=None):
     if vm:
-        service_offering_id = get_service_offering_id(module, cs)
-        if vm['serviceofferingid'] != service_offering_id:
-            if not module.check_mode:
-                vm_state = vm['state']
-                (result, vm) = stop_vm(module, cs, result, vm)
-                vm = poll_vm_job(vm, cs)
-                cs.scaleVirtualMachine(id=vm['id'], serviceofferingid=service_offering_id)
-                # Start VM again if it ran before the scaling
-                if vm_state == 'Running':
-                    (result, vm) = start_vm(module, cs, result, vm)
-                    vm = poll_job(cs, vm, 'virtualmachine')
+        if resolver:
+            service_offering = resolver.get('serviceoffering')
+        else:
+            service_offering = get_service_offering(module, cs)
+
+        if vm['serviceofferingid'] != service_offering['id']:
             result['changed'] = True
+            if module.check_mode:
+                return (result, vm)
+
+            args = {}
+            args['id'] = vm['id']
+            args['serviceofferingid'] = service_offering['id']
+
+            # scale in place if possible, one job and no downtime
+            if can_scale_live(vm, service_offering):
+                poll_async = module.params.get('poll_async')
+                if not poll_async:
+                    res = cs.scaleVirtualMachine(**args)
+                    if 'jobid' in res:
+                        result['job_id'] = res['jobid']
+                    return (result, vm)
+
+                res = run_jobs(cs, [ (cs.scaleVirtualMachine, args) ], 'virtualmachine')[0]
+                if 'errortext' not in res:
+                    vm = cs.listVirtualMachines(id=vm['id'])['virtualmachine'][0]
+                    return (result, vm)
+
+            # otherwise stop, scale and start the virtual machine again if it ran before
+            vm_state = vm['state']
+            if vm_state not in [ 'Stopped' ]:
+                vm = run_job(module, cs, cs.stopVirtualMachine, { 'id': vm['id'] })
+            run_job(module, cs, cs.scaleVirtualMachine, args)
+            if vm_state == 'Running':
+                vm = run_job(module, cs, cs.startVirtualMachine, { 'id': vm['id'] })
+            else:
+                vm = cs.listVirtualMachines(id=vm['id'])['virtualmachine'][0]
     return (result, vm)
 
 
@@ -440,6 +1107,8 @@ def remove_vm(module, cs, result, vm):
                 poll_async = module.params.get('poll_async')
                 if poll_async:
                     vm = poll_job(cs, res, 'virtualmachine')
+                elif 'jobid' in res:
+                    result['job_id'] = res['jobid']
 
     return (result, vm)
 
@@ -461,8 +1130,10 @@ def expunge_vm(module, cs, result, vm):
             module.fail_json(msg="Failed: '%s'" % res['errortext'])
 
         poll_async = module.params.get('poll_async')
-        if poll_async:
+        if poll_async and res:
             vm = poll_job(cs, res, 'virtualmachine')
+        elif res and 'jobid' in res:
+            result['job_id'] = res['jobid']
 
     return (result, vm)
 
@@ -479,6 +1150,8 @@ def stop_vm(module, cs, result, vm):
             poll_async = module.params.get('poll_async')
             if poll_async:
                 vm = poll_job(cs, vm, 'virtualmachine')
+            elif 'jobid' in vm:
+                result['job_id'] = vm['jobid']
 
         result['changed'] = True
     return (result, vm)
@@ -495,6 +1168,8 @@ def start_vm(module, cs, result, vm):
             poll_async = module.params.get('poll_async')
             if poll_async:
                 vm = poll_job(cs, vm, 'virtualmachine')
+            elif 'jobid' in vm:
+                result['job_id'] = vm['jobid']
 
         result['changed'] = True
     return (result, vm)
@@ -509,6 +1184,8 @@ def restart_vm(module, cs, result, vm):
             poll_async = module.params.get('poll_async')
             if poll_async:
                 vm = poll_job(cs, vm, 'virtualmachine')
+            elif 'jobid' in vm:
+                result['job_id'] = vm['jobid']
 
         result['changed'] = True
     elif vm['state'] == 'Stopping' or vm['state'] == 'Stopped':
@@ -516,6 +1193,58 @@ def restart_vm(module, cs, result, vm):
     return (result, vm)
 
 
+def get_vm_result(vm):
+    vm_result = {}
+
+    if 'id' in vm:
+        vm_result['id'] = vm['id']
+
+    if 'name' in vm:
+        vm_result['name'] = vm['name']
+
+    if 'displayname' in vm:
+        vm_result['display_name'] = vm['displayname']
+
+    if 'group' in vm:
+        vm_result['group'] = vm['group']
+
+    if 'password' in vm:
+        vm_result['password'] = vm['password']
+
+    if 'serviceofferingname' in vm:
+        vm_result['service_offering'] = vm['serviceofferingname']
+
+    if 'zonename' in vm:
+        vm_result['zone'] = vm['zonename']
+
+    if 'templatename' in vm:
+        vm_result['template'] = vm['templatename']
+
+    if 'isoname' in vm:
+        vm_result['iso'] = vm['isoname']
+
+    if 'created' in vm:
+        vm_result['created'] = vm['created']
+
+    if 'state' in vm:
+        vm_result['vm_state'] = vm['state']
+
+    if 'tags' in vm:
+        tags = {}
+        for tag in vm['tags']:
+            key = tag['key']
+            value = tag['value']
+            tags[key] = value
+        vm_result['tags'] = tags
+
+    if 'nic' in vm:
+        for nic in vm['nic']:
+            if nic['isdefault']:
+                vm_result['default_ip'] = nic['ipaddress']
+        vm_result['nic'] = vm['nic']
+    return vm_result
+
+
 def main():
     module = AnsibleModule(
         argument_spec = dict(
@@ -537,13 +1266,23 @@ def main():
             zone = dict(default=None),
             poll_async = dict(choices=BOOLEANS, default=True),
             ssh_key = dict(default=None),
+            names = dict(type='list', default=None),
+            count = dict(type='int', default=None),
+            name_pattern = dict(default=None),
+            concurrency = dict(type='int', default=10),
+            exact_count = dict(type='int', default=None),
+            catalog_cache = dict(default='~/.ansible-cloudstack-vm-catalog.cache'),
+            catalog_cache_ttl = dict(type='int', default=300),
             api_key = dict(default=None),
             api_secret = dict(default=None),
             api_url = dict(default=None),
             api_http_method = dict(default='get'),
         ),
         required_one_of = (
-            ['name', 'display_name'],
+            ['name', 'display_name', 'names', 'count', 'exact_count'],
+        ),
+        mutually_exclusive = (
+            ['names', 'count', 'exact_count'],
         ),
         supports_check_mode=True
     )
@@ -569,6 +1308,19 @@ def main():
             cs = CloudStack(**read_config())
 
         project_id = get_project_id(module, cs)
+        resolver = Resolver(module, cs, project_id)
+
+        fleet = module.params.get('exact_count') is not None
+        bulk = module.params.get('names') or module.params.get('count')
+        if (fleet or bulk) and state not in ['present', 'created']:
+            module.fail_json(msg="names, count and exact_count are only supported with state=present.")
+        if fleet:
+            result = reconcile_fleet(module, cs, result, project_id, resolver)
+            module.exit_json(**result)
+        if bulk:
+            result = create_vms(module, cs, result, project_id, resolver)
+            module.exit_json(**result)
+
         vm = get_vm(module, cs, project_id)
 
         if state in ['absent', 'destroyed']:
@@ -579,9 +1331,9 @@ def main():
 
         elif state in ['present', 'created']:
             if not vm:
-                (result, vm) = create_vm(module, cs, result, vm, project_id)
+                (result, vm) = create_vm(module, cs, result, vm, project_id, resolver)
             else:
-                (result, vm) = scale_vm(module, cs, result, vm)
+                (result, vm) = scale_vm(module, cs, result, vm, resolver)
 
         elif state in ['stopped', 'halted']:
             (result, vm) = stop_vm(module, cs, result, vm)
@@ -597,52 +1349,7 @@ def main():
             if 'state' in vm and vm['state'] == 'Error':
                 module.fail_json(msg="Virtual machine named '%s' in error state." % module.params.get('name'))
 
-            if 'id' in vm:
-                result['id'] = vm['id']
-
-            if 'name' in vm:
-                result['name'] = vm['name']
-
-            if 'displayname' in vm:
-                result['display_name'] = vm['displayname']
-
-            if 'group' in vm:
-                result['group'] = vm['group']
-
-            if 'password' in vm:
-                result['password'] = vm['password']
-
-            if 'serviceofferingname' in vm:
-                result['service_offering'] = vm['serviceofferingname']
-
-            if 'zonename' in vm:
-                result['zone'] = vm['zonename']
-
-            if 'templatename' in vm:
-                result['template'] = vm['templatename']
-
-            if 'isoname' in vm:
-                result['iso'] = vm['isoname']
-
-            if 'created' in vm:
-                result['created'] = vm['created']
-
-            if 'state' in vm:
-                result['vm_state'] = vm['state']
-
-            if 'tags' in vm:
-                tags = {}
-                for tag in vm['tags']:
-                    key = tag['key']
-                    value = tag['value']
-                    tags[key] = value
-                result['tags'] = tags
-
-            if 'nic' in vm:
-                for nic in vm['nic']:
-                    if nic['isdefault']:
-                        result['default_ip'] = nic['ipaddress']
-                result['nic'] = vm['nic']
+            result.update(get_vm_result(vm))
 
     except CloudStackException, e:
         module.fail_json(msg='CloudStackException: %s' % str(e))
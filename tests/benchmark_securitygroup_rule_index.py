@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Micro-benchmark of the security group rule lookup of cs_securitygroup_rule:
+# the hash index of get_rules_index() against the former linear scan over
+# all rules, on a fake security group of 5000 rules. No CloudStack API is
+# needed, run it by:
+#
+#   python tests/benchmark_securitygroup_rule_index.py [--rules 5000] [--lookups 1000]
+
+import os
+import sys
+import time
+import random
+import argparse
+
+MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cs_securitygroup_rule.py')
+
+
+def load_module_class():
+    # the module source without its main() call and ansible snippet import
+    source = open(MODULE).read()
+    source = source[:source.index('# import module snippets')]
+    namespace = { '__name__': 'cs_securitygroup_rule' }
+    exec(compile(source, MODULE, 'exec'), namespace)
+    return namespace['AnsibleCloudStackSecurityGroupRule']
+
+
+class FakeModule:
+
+    def __init__(self, params):
+        self.params = params
+
+
+    def fail_json(self, **kwargs):
+        raise Exception(kwargs['msg'])
+
+
+def get_params(**kwargs):
+    params = {
+        'security_group': 'bench',
+        'type': 'ingress',
+        'protocol': 'tcp',
+        'start_port': None,
+        'end_port': None,
+        'icmp_type': None,
+        'icmp_code': None,
+        'cidr': '0.0.0.0/0',
+        'user_security_group': None,
+        'project': None,
+    }
+    params.update(kwargs)
+    return params
+
+
+def build_security_group(count):
+    # tcp and udp port rules of different CIDRs, some icmp rules
+    rules = []
+    for i in range(count):
+        rule = {
+            'ruleid': 'rule-%d' % i,
+            'cidr': '10.%d.%d.0/24' % (i // 256 % 256, i % 256),
+        }
+        if i % 10 == 9:
+            rule['protocol'] = 'icmp'
+            rule['icmptype'] = i % 16
+            rule['icmpcode'] = 0
+        else:
+            rule['protocol'] = [ 'tcp', 'udp' ][i % 2]
+            rule['startport'] = 1024 + i
+            rule['endport'] = 1024 + i
+        rules.append(rule)
+    return {
+        'id': 'sg-bench',
+        'name': 'bench',
+        'ingressrule': rules,
+        'egressrule': [],
+    }
+
+
+def linear_scan(rules, params):
+    # the lookup as done before the rules index, matching rule by rule
+    user_security_group_name = params.get('user_security_group')
+    cidr       = params.get('cidr')
+    protocol   = params.get('protocol')
+    start_port = params.get('start_port')
+    end_port   = params.get('end_port') or start_port
+    icmp_code  = params.get('icmp_code')
+    icmp_type  = params.get('icmp_type')
+
+    for rule in rules:
+        if user_security_group_name:
+            type_match = 'securitygroupname' in rule and user_security_group_name == rule['securitygroupname']
+        else:
+            type_match = 'cidr' in rule and cidr == rule['cidr']
+
+        protocol_match = (protocol in ['tcp', 'udp']
+                          and protocol == rule['protocol']
+                          and start_port == int(rule['startport'])
+                          and end_port == int(rule['endport'])) \
+                      or (protocol == 'icmp'
+                          and protocol == rule['protocol']
+                          and icmp_code == int(rule['icmpcode'])
+                          and icmp_type == int(rule['icmptype'])) \
+                      or (protocol in ['ah', 'esp', 'gre'] and protocol == rule['protocol'])
+
+        if type_match and protocol_match:
+            return rule
+    return None
+
+
+def get_lookups(security_group, count):
+    # params of existing rules picked at random and of some missing ones
+    lookups = []
+    rules = security_group['ingressrule']
+    for i in range(count):
+        if i % 5 == 4:
+            lookups.append(get_params(protocol='tcp', start_port=80, end_port=80, cidr='192.0.2.0/24'))
+            continue
+        rule = random.choice(rules)
+        if rule['protocol'] == 'icmp':
+            lookups.append(get_params(protocol='icmp', icmp_type=rule['icmptype'], icmp_code=rule['icmpcode'], cidr=rule['cidr']))
+        else:
+            lookups.append(get_params(protocol=rule['protocol'], start_port=rule['startport'], end_port=rule['endport'], cidr=rule['cidr']))
+    return lookups
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the security group rule lookup')
+    parser.add_argument('--rules', type=int, default=5000)
+    parser.add_argument('--lookups', type=int, default=1000)
+    options = parser.parse_args()
+
+    random.seed(42)
+    cls = load_module_class()
+    security_group = build_security_group(options.rules)
+    lookups = get_lookups(security_group, options.lookups)
+
+    class BenchmarkSecurityGroupRule(cls):
+        # skips __init__ connecting to the API
+        def __init__(self, module):
+            self.module = module
+            self.rules_indexes = {}
+
+    module = FakeModule(get_params())
+    acs_sg_rule = BenchmarkSecurityGroupRule(module)
+
+    started = time.time()
+    linear_results = []
+    for params in lookups:
+        linear_results.append(linear_scan(security_group['ingressrule'], params))
+    linear_time = time.time() - started
+
+    started = time.time()
+    acs_sg_rule.get_rules_index(security_group)
+    build_time = time.time() - started
+
+    started = time.time()
+    index_results = []
+    for params in lookups:
+        module.params = params
+        index_results.append(acs_sg_rule._get_rule(security_group))
+    index_time = time.time() - started
+
+    for linear, index in zip(linear_results, index_results):
+        if (linear and linear['ruleid']) != (index and index['ruleid']):
+            print("lookup results differ: %s != %s" % (linear, index))
+            sys.exit(1)
+
+    print("%d rules, %d lookups, %d found" % (options.rules, options.lookups, len([ r for r in index_results if r ])))
+    print("linear scan:  %8.2f ms, %8.4f ms per lookup" % (linear_time * 1000, linear_time * 1000 / options.lookups))
+    print("index build:  %8.2f ms, once per security group" % (build_time * 1000))
+    print("index lookup: %8.2f ms, %8.4f ms per lookup" % (index_time * 1000, index_time * 1000 / options.lookups))
+    print("speedup:      %8.1fx (%.1fx including the index build)" % (linear_time / index_time, linear_time / (index_time + build_time)))
+
+
+if __name__ == '__main__':
+    main()